@@ -1,18 +1,70 @@
-from typing import Dict, List, Optional
-from urllib.parse import urlparse, parse_qs, unquote
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import math
 import os
 from iop.base import IopClient, IopRequest
+from cache import TTLCache, SingleFlight, StaleWhileRevalidateCache
+from keywords import keyword_queries, keyword_terms, title_tokens
+from url_resolver import ProductIdResolver
+from deadline import Deadline, DeadlineExceeded
+from circuit_breaker import CircuitOpenError, UpstreamGuard
+from quota import QuotaScheduler, INTERACTIVE, BACKGROUND, quota_ban_seconds
+from catalog import ProductCatalog
+from pipeline import fire_and_forget
+from ranking import TopK, relevance_scores
+from metrics import observe_iop_request
+from log_pipeline import PAYLOAD
 import logging
-import requests
+import httpx
+import numpy as np
 import re
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
+IOP_SERVER_URL = "https://api-sg.aliexpress.com/sync"
+AFFILIATE_LINK_BATCH_SIZE = 50
+# most ids a single productdetail.get call accepts
+PRODUCT_DETAILS_BATCH_SIZE = 50
+SIMILAR_PRODUCTS_LIMIT = 3
+# cheapest catalog matches scored for relevance before SIMILAR_PRODUCTS_LIMIT are kept
+CATALOG_CANDIDATES = 30
+# most candidates scored for relevance per lookup, cheapest first; scoring
+# costs ~5us per candidate, so this keeps it around a millisecond
+RELEVANCE_CANDIDATES = 200
+SIMILAR_PAGE_SIZE = 10
+# idempotent reads that may be hedged with a duplicate request
+READ_METHODS = ('aliexpress.affiliate.productdetail.get', 'aliexpress.affiliate.product.query')
+# neighbouring price buckets differ by 25%, so close prices share cached searches
+PRICE_BUCKET_RATIO = 1.25
+
+logger = logging.getLogger(__name__)
+
+def is_gateway_failure(response) -> bool:
+    # ISV errors are our own bad requests; ISP and SYSTEM errors are the gateway's
+    return response.type in ("ISP", "SYSTEM")
+
+def price_bucket(price: float) -> int:
+    if price <= 0:
+        return 0
+    return math.floor(math.log(price, PRICE_BUCKET_RATIO))
 
 class AliExpressClient:
-    def __init__(self, api_key: str, affiliate_id: str, app_secret: Optional[str] = None):
+    def __init__(self, api_key: str, affiliate_id: str, app_secret: Optional[str] = None,
+                 max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30, target_currency: str = 'USD', country: str = 'US',
+                 product_cache_size: int = 1024, product_cache_ttl: float = 600,
+                 similar_cache_size: int = 512, similar_cache_soft_ttl: float = 300,
+                 similar_cache_hard_ttl: float = 3600, max_redirect_hops: int = 5,
+                 short_link_cache_size: int = 4096, timeout: float = 30,
+                 hedge_reads: bool = False, breaker_options: Optional[Dict] = None,
+                 extra_credentials: Optional[List[Tuple[str, str]]] = None,
+                 quota_rate: float = 5, quota_burst: float = 10,
+                 quota_method_rates: Optional[Dict[str, Tuple[float, float]]] = None,
+                 catalog_path: Optional[str] = None, catalog_max_age: float = 3600,
+                 catalog_min_overlap: float = 0.6, similar_pages: int = 1, similar_top_k: int = 10,
+                 similar_min_relevance: float = 0.4, similar_min_score: float = 0.1, server_url: str = IOP_SERVER_URL,
+                 recorder: Optional[Callable] = None, catalog_recorder: Optional[Callable] = None,
+                 catalog: Optional[ProductCatalog] = None):
         if not api_key:
             raise ValueError("API Key is required")
         if not affiliate_id:
@@ -20,48 +72,89 @@ class AliExpressClient:
         
         self.api_key = api_key
         self.affiliate_id = affiliate_id
+        self.target_currency = target_currency
+        self.country = country
         self.app_secret = app_secret or os.getenv("ALIEXPRESS_APP_SECRET")
         if not self.app_secret:
             raise ValueError("App Secret is required")
         
-        self.client = IopClient(
-            server_url="https://api-sg.aliexpress.com/sync",
-            app_key=self.api_key,
-            app_secret=self.app_secret
+        def iop_client(app_key, app_secret):
+            return IopClient(
+                server_url=server_url,
+                app_key=app_key,
+                app_secret=app_secret,
+                timeout=timeout,
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+                observer=observe_iop_request,
+                recorder=recorder,
+            )
+
+        self.client = iop_client(self.api_key, self.app_secret)
+        # async calls rotate over every configured app key to spread the quota
+        self.clients = [self.client] + [iop_client(key, secret) for key, secret in extra_credentials or []]
+        self.quota = QuotaScheduler(
+            self.clients,
+            rate=quota_rate,
+            burst=quota_burst,
+            method_rates=quota_method_rates,
+        )
+        self._http_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.gateway = UpstreamGuard(
+            max_timeout=timeout,
+            hedge_methods=READ_METHODS if hedge_reads else (),
+            **(breaker_options or {}),
+        )
+
+        self._http = None
+        self.url_resolver = ProductIdResolver(
+            self._get_http,
+            max_hops=max_redirect_hops,
+            cache_size=short_link_cache_size,
+        )
+
+        self.product_cache = TTLCache(maxsize=product_cache_size, ttl=product_cache_ttl)
+        self._product_flight = SingleFlight()
+        self.similar_cache = StaleWhileRevalidateCache(
+            maxsize=similar_cache_size,
+            soft_ttl=similar_cache_soft_ttl,
+            hard_ttl=similar_cache_hard_ttl,
         )
+        # every product payload seen is kept locally so similar searches can skip the API
+        # a replay passes in a catalog that answers from the recording
+        self.catalog = catalog
+        if self.catalog is None and catalog_path:
+            self.catalog = ProductCatalog(catalog_path, catalog_max_age, recorder=catalog_recorder)
+        self.catalog_max_age = catalog_max_age
+        self.catalog_min_overlap = catalog_min_overlap
+        # product.query pages fetched concurrently per similar search, and how
+        # many of the cheapest candidates are kept from them
+        self.similar_pages = similar_pages
+        self.similar_top_k = max(similar_top_k, SIMILAR_PRODUCTS_LIMIT)
+        # candidates whose title similarity to the original is below this
+        # fraction of the best candidate's are dropped before the price sort, so
+        # cheap accessories don't crowd out real alternatives. It's relative
+        # because absolute TF-IDF scores shift with how long and varied titles are
+        self.similar_min_relevance = similar_min_relevance
+        # ...and below this absolute score, so a page where no candidate looks
+        # like the original doesn't pass just because its best match is poor
+        self.similar_min_score = similar_min_score
 
     def extract_product_id_from_url_legacy(self, url: str) -> Optional[str]:
-        try:
-            parsed_url = urlparse(url)
-            path_parts = parsed_url.path.split('/')
-            for part in path_parts:
-                if part.startswith(('item-', 'product-')):
-                    print(part.split('-')[1])
-                if part.endswith('.html'):
-                    part = part[:-5]
-                if part.isdigit() and len(part) > 8:
-                    print(part)
-            query_params = parse_qs(parsed_url.query)
-            return query_params.get('productId', [None])[0]
-        except Exception as e:
-            logging.error(f"Failed to extract product ID: {e}")
-            return None
+        # kept for callers of the old name; the resolver covers every shape it looked for
+        return self.url_resolver.extract(url)
 
     def extract_product_id_from_url(self, url):
-        match = re.search(r'/item/(\d+)\.html', url)
-        if match:
-            return match.group(1)
-        return None
+        return self.url_resolver.extract(url)
+
+    async def resolve_product_id_async(self, url: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        return await self.url_resolver.resolve(url, deadline)
 
-    # async def expand_shortlink(self, url):
-    #     try:
-    #         async with httpx.AsyncClient(follow_redirects=True, timeout=10) as client:
-    #             response = await client.head(url)
-    #             return str(response.url)
-    #     except Exception as e:
-    #         print(f"Error expanding shortlink: {e}")
-    #         return None
-        
     def extract_url_from_text(self, text):
     # Find first http or https URL
         match = re.search(r'https?://\S+', text)
@@ -69,116 +162,545 @@ class AliExpressClient:
             return match.group(0)
         return None
     
-    def get_redirected_url_info(self, url):
-        try:
-            response = requests.get(url, allow_redirects=True)
-            final_url = response.url
-            return unquote(final_url)
-        except requests.RequestException as e:
-            logging.error(f"Error fetching redirected URL: {e}")
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(follow_redirects=True, timeout=10, limits=self._http_limits)
+        return self._http
+
+    async def _execute_async(self, request: IopRequest, deadline: Optional[Deadline] = None,
+                             priority: int = INTERACTIVE):
+        method = request._api_pame
+        # waiting for quota counts against the deadline but not the breaker's latency
+        acquire = self.quota.acquire(method, priority)
+        if deadline is None:
+            client = await acquire
+        else:
+            try:
+                client = await asyncio.wait_for(acquire, deadline.timeout())
+            except asyncio.TimeoutError as e:
+                raise DeadlineExceeded(f"deadline exceeded waiting for {method} quota") from e
+
+        async def attempt(client, timeout):
+            # the key that answered is the one a quota error bans
+            return client, await client.execute_async(request, timeout=timeout)
+
+        def hedge(timeout):
+            # a hedged duplicate is a call of its own and needs its own token
+            spare = self.quota.try_acquire(method)
+            return None if spare is None else attempt(spare, timeout)
+
+        answered_by, response = await self.gateway.call(
+            method,
+            lambda timeout: attempt(client, timeout),
+            deadline=deadline,
+            is_failure=lambda answer: is_gateway_failure(answer[1]),
+            hedge=hedge,
+        )
+        ban_seconds = quota_ban_seconds(response)
+        if ban_seconds is not None:
+            self.quota.ban(answered_by, ban_seconds)
+        return response
+
+    def _product_details_request(self, product_ids: str) -> IopRequest:
+        request = IopRequest('aliexpress.affiliate.productdetail.get')
+        request.add_api_param('fields', 'product_id,product_title,product_price,product_url,commission_rate,sale_price,product_detail_url')
+        request.add_api_param('product_ids', product_ids)
+        request.add_api_param('target_currency', self.target_currency)
+        request.add_api_param('target_language', 'EN')
+        request.add_api_param('tracking_id', self.affiliate_id)
+        request.add_api_param('country', self.country)
+        return request
+
+    def _parse_product_details(self, response) -> Optional[List[Dict]]:
+        products = response.body.get('aliexpress_affiliate_productdetail_get_response', {}) \
+                               .get('resp_result', {}) \
+                               .get('result', {}) \
+                               .get('products', {}) \
+                               .get('product', [])
+
+        logger.info("Response from product details API: %s", response.body, extra=PAYLOAD)
+
+        if not products:
+            logger.warning("No product data found in response")
             return None
-        
+
+        logger.info("Fetched product details: %s", products, extra=PAYLOAD)
+        return products
 
     def _fetch_product_details(self, product_ids: str) -> Optional[List[Dict]]:
         try:
-            request = IopRequest('aliexpress.affiliate.productdetail.get')
-            request.add_api_param('fields', 'product_id,product_title,product_price,product_url,commission_rate,sale_price,product_detail_url')
-            request.add_api_param('product_ids', product_ids)
-            request.add_api_param('target_currency', 'USD')
-            request.add_api_param('target_language', 'EN')
-            request.add_api_param('tracking_id', self.affiliate_id)
-            request.add_api_param('country', 'US')
-
-            response = self.client.execute(request)
-            products = response.body.get('aliexpress_affiliate_productdetail_get_response', {}) \
-                                   .get('resp_result', {}) \
-                                   .get('result', {}) \
-                                   .get('products', {}) \
-                                   .get('product', [])
-
-            logging.info(f"Response from product details API: {response.body}")
-            
-            if not products:
-                logging.warning("No product data found in response")
-                return None
-
-            logging.info(f"Fetched product details: {products}")
+            response = self.client.execute(self._product_details_request(product_ids))
+            products = self._parse_product_details(response)
+            self._remember(products)
             return products
+        except Exception as e:
+            logger.exception("Error fetching product details: %s", e)
+            return None
 
+    async def _fetch_product_details_async(self, product_ids: str, deadline: Optional[Deadline] = None,
+                                           priority: int = INTERACTIVE) -> Optional[List[Dict]]:
+        try:
+            response = await self._execute_async(self._product_details_request(product_ids), deadline, priority)
+            products = self._parse_product_details(response)
+            self._remember_async(products)
+            return products
+        except DeadlineExceeded:
+            raise
+        except CircuitOpenError as e:
+            # one line per rejected call; the breaker already logged why it opened
+            logger.warning("Not fetching product details: %s", e)
+            return None
         except Exception as e:
-            logging.exception(f"Error fetching product details: {e}")
+            logger.exception("Error fetching product details: %s", e)
             return None
 
+    def _remember(self, products: Optional[List[Dict]], affiliate_links: Optional[Dict[str, str]] = None):
+        if self.catalog is None:
+            return
+        try:
+            if products:
+                self.catalog.upsert(products, self.target_currency)
+            if affiliate_links:
+                self.catalog.set_affiliate_links(affiliate_links)
+        except Exception as e:
+            logger.error("Failed to update the product catalog: %s", e)
+
+    def _remember_async(self, products: Optional[List[Dict]], affiliate_links: Optional[Dict[str, str]] = None):
+        # catalog writes stay off the request's critical path
+        if self.catalog is not None and (products or affiliate_links):
+            fire_and_forget(asyncio.to_thread(self._remember, products, affiliate_links), "catalog-upsert")
+
+    def _product_cache_key(self, product_id: str):
+        return (product_id, self.target_currency, self.country)
+
     def get_single_product_details(self, product_id: str) -> Optional[Dict]:
-        logging.info(f"Fetching details for product ID: {product_id}")
+        key = self._product_cache_key(product_id)
+        product = self.product_cache.get(key)
+        if product is not None:
+            return product
+
+        logger.info("Fetching details for product ID: %s", product_id)
         results = self._fetch_product_details(product_id)
-        return results[0] if results else None
+        if not results:
+            return None
+        self.product_cache.set(key, results[0])
+        return results[0]
+
+    async def get_single_product_details_async(self, product_id: str, deadline: Optional[Deadline] = None) -> Optional[Dict]:
+        key = self._product_cache_key(product_id)
+        product = self.product_cache.get(key)
+        if product is not None:
+            return product
+
+        async def fetch():
+            logger.info("Fetching details for product ID: %s", product_id)
+            results = await self._fetch_product_details_async(product_id, deadline)
+            if not results:
+                return None
+            self.product_cache.set(key, results[0])
+            return results[0]
+
+        return await self._product_flight.do(key, fetch)
+
+    async def get_products_details_async(self, product_ids: List[str], deadline: Optional[Deadline] = None,
+                                         priority: int = INTERACTIVE) -> Dict[str, Dict]:
+        """Details for many products, keyed by product id.
+
+        Cached products are served locally; the rest are fetched with as few
+        multi-id productdetail.get calls as possible, sent concurrently.
+        """
+        results = {}
+        missing = []
+        for product_id in dict.fromkeys(product_ids):
+            product = self.product_cache.get(self._product_cache_key(product_id))
+            if product is not None:
+                results[product_id] = product
+            else:
+                missing.append(product_id)
+
+        chunks = [missing[i:i + PRODUCT_DETAILS_BATCH_SIZE] for i in range(0, len(missing), PRODUCT_DETAILS_BATCH_SIZE)]
+        fetched = await asyncio.gather(*[
+            self._fetch_product_details_async(','.join(chunk), deadline, priority) for chunk in chunks
+        ])
+        for products in fetched:
+            for product in products or []:
+                product_id = str(product.get('product_id'))
+                self.product_cache.set(self._product_cache_key(product_id), product)
+                results[product_id] = product
+        return results
+
+    def _affiliate_link_request(self, product_urls: List[str]) -> IopRequest:
+        request = IopRequest('aliexpress.affiliate.link.generate')
+        request.add_api_param('source_values', ','.join(product_urls))
+        request.add_api_param("promotion_link_type", 2);
+        request.add_api_param('tracking_id', self.affiliate_id)
+        return request
+
+    def _parse_affiliate_links(self, response):
+        links = response.body.get('aliexpress_affiliate_link_generate_response', {}) \
+                             .get('resp_result', {}) \
+                             .get('result', {}) \
+                             .get('promotion_links', [])
+
+        logger.info("Generated affiliate links: %s", links, extra=PAYLOAD)
+
+        return links.get('promotion_link') if links else None
+
+    def _map_affiliate_links(self, product_urls: List[str], links: Optional[List[Dict]]) -> Dict[str, str]:
+        if not links:
+            return {}
+        by_source = {link.get('source_value'): link.get('promotion_link') for link in links}
+        mapped = {url: by_source[url] for url in product_urls if url in by_source}
+        if len(mapped) < len(product_urls) and len(links) == len(product_urls):
+            # the gateway may echo a normalized source_value; it keeps request order
+            for url, link in zip(product_urls, links):
+                mapped.setdefault(url, link.get('promotion_link'))
+        return mapped
+
+    def _affiliate_link_batches(self, product_urls: List[str]) -> List[List[str]]:
+        unique_urls = list(dict.fromkeys(url for url in product_urls if url))
+        return [unique_urls[i:i + AFFILIATE_LINK_BATCH_SIZE]
+                for i in range(0, len(unique_urls), AFFILIATE_LINK_BATCH_SIZE)]
 
     def generate_affiliate_link(self, product_url: str) -> Optional[str]:
         try:
-            request = IopRequest('aliexpress.affiliate.link.generate')
-            request.add_api_param('source_values', product_url)
-            request.add_api_param("promotion_link_type", 2);
-            request.add_api_param('tracking_id', self.affiliate_id)
-            response = self.client.execute(request)
-
-            links = response.body.get('aliexpress_affiliate_link_generate_response', {}) \
-                                 .get('resp_result', {}) \
-                                 .get('result', {}) \
-                                 .get('promotion_links', [])
-            
-            logging.info(f"Generated affiliate links: {links}")
-
-            return links.get('promotion_link') if links else None
+            response = self.client.execute(self._affiliate_link_request([product_url]))
+            return self._parse_affiliate_links(response)
         except Exception as e:
-            logging.exception(f"Error generating affiliate link: {e}")
+            logger.exception("Error generating affiliate link: %s", e)
+            return None
+
+    def generate_affiliate_links(self, product_urls: List[str]) -> Dict[str, str]:
+        """Generates affiliate links for many urls, one signed request per batch.
+
+        Returns a mapping of source url to promotion link; urls the gateway
+        could not convert are missing from the mapping.
+        """
+        results = {}
+        for batch in self._affiliate_link_batches(product_urls):
+            try:
+                response = self.client.execute(self._affiliate_link_request(batch))
+                results.update(self._map_affiliate_links(batch, self._parse_affiliate_links(response)))
+            except Exception as e:
+                logger.exception("Error generating affiliate links: %s", e)
+        return results
+
+    async def generate_affiliate_links_async(self, product_urls: List[str], deadline: Optional[Deadline] = None,
+                                             priority: int = INTERACTIVE) -> Dict[str, str]:
+        async def generate_batch(batch):
+            try:
+                response = await self._execute_async(self._affiliate_link_request(batch), deadline, priority)
+                return self._map_affiliate_links(batch, self._parse_affiliate_links(response))
+            except DeadlineExceeded:
+                raise
+            except CircuitOpenError as e:
+                logger.warning("Not generating affiliate links: %s", e)
+                return {}
+            except Exception as e:
+                logger.exception("Error generating affiliate links: %s", e)
+                return {}
+
+        results = {}
+        for mapped in await asyncio.gather(*[generate_batch(b) for b in self._affiliate_link_batches(product_urls)]):
+            results.update(mapped)
+        return results
+
+    def _similar_products_request(self, keywords: str, page_no: int = 1) -> IopRequest:
+        request = IopRequest('aliexpress.affiliate.product.query')
+        request.add_api_param('keywords', keywords)
+        request.add_api_param('sort', 'SALE_PRICE_ASC')
+        request.add_api_param('page_no', page_no)
+        request.add_api_param('page_size', SIMILAR_PAGE_SIZE)
+        request.add_api_param('target_currency', self.target_currency)
+        request.add_api_param('target_language', 'EN')
+
+        logger.info("Requesting similar products for: %s", keywords)
+        return request
+
+    def _parse_similar_products(self, response) -> Optional[List[Tuple[float, Dict]]]:
+        """Valid candidates of one product.query page as (price, product) pairs, in page order"""
+        products = response.body.get('aliexpress_affiliate_product_query_response', {}) \
+                               .get('resp_result', {}) \
+                               .get('result', {}) \
+                               .get('products', {}) \
+                               .get('product', [])
+
+        if not products:
+            logger.warning("No similar products found")
             return None
 
-    def similar_products(self, product: Dict) -> Optional[str]:
+        logger.info("Response from similar products API: %s", response.body, extra=PAYLOAD)
+
+        candidates = []
+        for p in products:
+            if not p.get('product_id'):
+                continue
+            try:
+                candidates.append((float(p['target_sale_price']), p))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return candidates
+
+    def _cheapest_similar_products(self, product: Dict, response) -> Optional[List[Dict]]:
+        candidates = self._parse_similar_products(response)
+        if candidates is None:
+            return None
+
+        self._remember([p for _, p in candidates])
+        price = float(product.get('target_sale_price'))
+        top = TopK(SIMILAR_PRODUCTS_LIMIT)
+        for candidate_price, p in self._relevant(product, candidates):
+            if candidate_price < price:
+                top.push(candidate_price, p)
+        return top.items()
+
+    def _similar_product_result(self, p: Dict, affiliate_url: Optional[str]) -> Dict:
+        logger.info("Generated affiliate link: %s", affiliate_url)
+        return {
+            "id": p.get('product_id'),
+            "title": p.get('product_title'),
+            "price": float(p.get('target_sale_price', 0)),
+            "url": p.get('product_detail_url'),
+            "commission_rate": p.get('commission_rate', 0),
+            "affiliate_url": affiliate_url,
+        }
+
+    def _with_links(self, results: List[Dict]) -> List[Dict]:
+        """Results ready to send: the product url stands in for a link the gateway didn't generate.
+
+        Link generation failures are logged and swallowed, so without this a
+        reply would carry "None" where the link goes.
+        """
+        linked = []
+        for result in results:
+            if not result["affiliate_url"]:
+                if not result["url"]:
+                    continue
+                result = dict(result, affiliate_url=result["url"])
+            linked.append(result)
+        return linked
+
+    def similar_products(self, product: Dict) -> Optional[List[Dict]]:
         try:
-            request = IopRequest('aliexpress.affiliate.product.query')
-            request.add_api_param('keywords', product["product_title"])
-            request.add_api_param('sort', 'SALE_PRICE_ASC')
-            request.add_api_param('page_no', 1)
-            request.add_api_param('page_size', 10)
-            request.add_api_param('target_currency', 'USD')
-            request.add_api_param('target_language', 'EN')
-
-            logging.info(f"Requesting similar products for: {product['product_title']}")
-
-            response = self.client.execute(request)
-            products = response.body.get('aliexpress_affiliate_product_query_response', {}) \
-                                   .get('resp_result', {}) \
-                                   .get('result', {}) \
-                                   .get('products', {}) \
-                                   .get('product', [])
-
-            if not products:
-                logging.warning("No similar products found")
+            local = self._similar_from_catalog(product)
+            if local is not None:
+                missing = [p.get('product_detail_url') for p in local if not p.get('affiliate_url')]
+                affiliate_links = self.generate_affiliate_links(missing) if missing else {}
+                self._remember(None, affiliate_links)
+                return self._with_links([
+                    self._similar_product_result(p, p.get('affiliate_url') or affiliate_links.get(p.get('product_detail_url')))
+                    for p in local
+                ])
+
+            response = self.client.execute(self._similar_products_request(self._similar_queries(product)[0]))
+            sort_cheaper_products = self._cheapest_similar_products(product, response)
+            if sort_cheaper_products is None:
                 return None
-            
-            logging.info(f"Response from similar products API: {response.body}")
 
-            cheaper_products = [p for p in products if p.get('product_id') and float(p.get('target_sale_price')) < float(product.get('target_sale_price'))]
-            sort_cheaper_products = sorted(cheaper_products, key=lambda x: float(x.get('target_sale_price', 0)))[:min(3, len(cheaper_products))]
+            affiliate_links = self.generate_affiliate_links([p.get('product_detail_url') for p in sort_cheaper_products])
+            self._remember(None, affiliate_links)
 
-            # logging.info(f"Cheaper products found: {sort_cheaper_products}")
+            return self._with_links([
+                self._similar_product_result(p, affiliate_links.get(p.get('product_detail_url')))
+                for p in sort_cheaper_products
+            ])
+        except Exception as e:
+            logger.exception("similar failed: %s", e)
+            return None
 
-            results = []
-            for p in sort_cheaper_products:
-                affiliate_link = self.generate_affiliate_link(p.get('product_detail_url'))[0]
-                logging.info(f"Generated affiliate link: {affiliate_link.get('promotion_link')}")
-                results.append({
-                    "id": p.get('product_id'),
-                    "title": p.get('product_title'),
-                    "price": float(p.get('target_sale_price', 0)),
-                    "url": p.get('product_detail_url'),
-                    "commission_rate": p.get('commission_rate', 0),
-                    "affiliate_url": affiliate_link.get('promotion_link'),
-                })
+    def _similar_from_catalog(self, product: Dict) -> Optional[List[Dict]]:
+        """Cheapest fresh, relevant catalog matches, or None when there aren't enough of them."""
+        if self.catalog is None:
+            return None
+        try:
+            matches = self.catalog.cheaper_matching(
+                keyword_terms(product.get("product_title", "")),
+                float(product.get('target_sale_price')),
+                self.target_currency,
+                max_age=self.catalog_max_age,
+                limit=CATALOG_CANDIDATES,
+                min_overlap=self.catalog_min_overlap,
+                exclude=product.get('product_id'),
+            )
+        except Exception as e:
+            logger.error("Product catalog lookup failed: %s", e)
+            self.catalog.record_lookup(hit=False)
+            return None
+        # shared title tokens alone also match accessories; matches come cheapest first
+        relevant = self._relevant(product, [(float(p['target_sale_price']), p) for p in matches])
+        local = [p for _, p in relevant[:SIMILAR_PRODUCTS_LIMIT]]
+        hit = len(local) >= SIMILAR_PRODUCTS_LIMIT
+        self.catalog.record_lookup(hit)
+        return local if hit else None
 
+    async def _similar_from_catalog_async(self, product: Dict, deadline: Optional[Deadline] = None,
+                                          priority: int = INTERACTIVE) -> Optional[List[Dict]]:
+        local = await asyncio.to_thread(self._similar_from_catalog, product)
+        if local is None:
+            return None
 
-            return results
+        missing = [p.get('product_detail_url') for p in local if not p.get('affiliate_url')]
+        affiliate_links = await self.generate_affiliate_links_async(missing, deadline, priority) if missing else {}
+        self._remember_async(None, affiliate_links)
+        return [
+            self._similar_product_result(p, p.get('affiliate_url') or affiliate_links.get(p.get('product_detail_url')))
+            for p in local
+        ]
+
+    def _similar_queries(self, product: Dict) -> List[str]:
+        # a title without any word characters still gets searched as it is
+        return keyword_queries(product.get("product_title", "")) or [product["product_title"]]
+
+    def _similar_cache_key(self, product: Dict):
+        # products whose titles compact to the same query share one search
+        return (
+            self._similar_queries(product)[0],
+            self.target_currency,
+            price_bucket(float(product.get('target_sale_price'))),
+        )
+
+    async def _similar_page_async(self, keywords: str, page_no: int, deadline: Optional[Deadline] = None,
+                                  priority: int = INTERACTIVE) -> Tuple[int, Optional[List[Tuple[float, Dict]]]]:
+        try:
+            response = await self._execute_async(self._similar_products_request(keywords, page_no), deadline, priority)
+            return page_no, self._parse_similar_products(response)
+        except DeadlineExceeded:
+            raise
+        except CircuitOpenError as e:
+            logger.warning("Not fetching similar products page %s: %s", page_no, e)
+            return page_no, None
+        except Exception as e:
+            logger.exception("Error fetching similar products page %s: %s", page_no, e)
+            return page_no, None
+
+    def _relevant(self, product: Dict, candidates: List[Tuple[float, Dict]]) -> List[Tuple[float, Dict]]:
+        if not candidates or (self.similar_min_relevance <= 0 and self.similar_min_score <= 0):
+            return candidates
+        if len(candidates) > RELEVANCE_CANDIDATES:
+            # only the cheapest can make the cut anyway; keep them in their original order
+            keep = heapq.nsmallest(RELEVANCE_CANDIDATES, range(len(candidates)), key=lambda i: candidates[i][0])
+            candidates = [candidates[i] for i in sorted(keep)]
+        scores = relevance_scores(product.get('product_title', ''), [p.get('product_title', '') for _, p in candidates])
+        # a candidate sharing no term with the title is never similar
+        cutoff = max(self.similar_min_relevance * scores.max(), self.similar_min_score)
+        return [candidates[i] for i in np.flatnonzero((scores >= cutoff) & (scores > 0))]
+
+    def _likely_relevant_cheaper(self, terms: set, candidates: List[Tuple[float, Dict]], price: float) -> int:
+        """Cheaper candidates sharing catalog_min_overlap of the title's key terms.
+
+        A stand-in for _relevant while pages arrive: each candidate is looked
+        at once, and TF-IDF runs a single time over everything collected.
+        """
+        needed = math.ceil(len(terms) * self.catalog_min_overlap)
+        return sum(
+            1 for candidate_price, p in candidates
+            if candidate_price < price and len(terms.intersection(title_tokens(p.get('product_title', '')))) >= needed
+        )
+
+    async def _search_similar_async(self, keywords: str, terms: set, price: float, seen: set,
+                                    deadline: Optional[Deadline] = None,
+                                    priority: int = INTERACTIVE) -> Tuple[List[Tuple[float, Dict]], int]:
+        """Candidates for one query, not already in ``seen``, in page order, and how many are likely relevant and cheaper"""
+        pages, cheaper = {}, {}
+        tasks = [
+            asyncio.ensure_future(self._similar_page_async(keywords, page_no, deadline, priority))
+            for page_no in range(1, self.similar_pages + 1)
+        ]
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    page_no, candidates = task.result()
+                    # listings shift between pages while they are fetched
+                    pages[page_no] = [c for c in candidates or [] if c[1]['product_id'] not in seen]
+                    seen.update(p['product_id'] for _, p in pages[page_no])
+                    cheaper[page_no] = self._likely_relevant_cheaper(terms, pages[page_no], price)
+                # pages are sorted by price, so once pages 1..n hold k relevant
+                # cheaper products nothing on a later page can displace them
+                prefix = itertools.takewhile(lambda page_no: page_no in pages, itertools.count(1))
+                if sum(cheaper[page_no] for page_no in prefix) >= self.similar_top_k:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        return [c for page_no in sorted(pages) for c in pages[page_no]], sum(cheaper.values())
+
+    async def _load_similar_candidates_async(self, product: Dict, deadline: Optional[Deadline] = None,
+                                             priority: int = INTERACTIVE) -> Optional[List[Dict]]:
+        price = float(product.get('target_sale_price'))
+        terms = set(keyword_terms(product.get('product_title', '')))
+        collected, seen, cheaper = [], set(), 0
+        for keywords in self._similar_queries(product):
+            candidates, likely = await self._search_similar_async(keywords, terms, price, seen, deadline, priority)
+            collected.extend(candidates)
+            cheaper += likely
+            if cheaper >= SIMILAR_PRODUCTS_LIMIT:
+                break
+            logger.info("Only %s cheaper products for '%s', broadening the search", cheaper, keywords)
+
+        if not collected:
+            return None
+        top = TopK(self.similar_top_k)
+        for candidate_price, p in self._relevant(product, collected):
+            top.push(candidate_price, p)
+        candidates = top.items()
+
+        # links for the whole candidate list cost a single batched call and let
+        # every product in the same price bucket reuse the cached entry
+        affiliate_links = await self.generate_affiliate_links_async([p.get('product_detail_url') for p in candidates], deadline, priority)
+        self._remember_async([p for _, p in collected], affiliate_links)
+
+        return [
+            self._similar_product_result(p, affiliate_links.get(p.get('product_detail_url')))
+            for p in candidates
+        ]
+
+    async def similar_products_async(self, product: Dict, deadline: Optional[Deadline] = None,
+                                     priority: int = INTERACTIVE) -> Optional[List[Dict]]:
+        try:
+            local = await self._similar_from_catalog_async(product, deadline, priority)
+            if local is not None:
+                return self._with_links(local)
+
+            candidates = await self.similar_cache.get_or_load(
+                self._similar_cache_key(product),
+                lambda: self._load_similar_candidates_async(product, deadline, priority),
+                # background refreshes aren't bound to the request that triggered them
+                refresher=lambda: self._load_similar_candidates_async(product, priority=BACKGROUND),
+                # every product in the bucket would get the missing links until hard_ttl
+                cacheable=lambda candidates: all(c["affiliate_url"] for c in candidates),
+            )
+            if candidates is None:
+                return None
+
+            price = float(product.get('target_sale_price'))
+            return self._with_links([c for c in candidates if c["price"] < price])[:SIMILAR_PRODUCTS_LIMIT]
+        except DeadlineExceeded:
+            raise
+        except CircuitOpenError as e:
+            logger.warning("similar failed: %s", e)
+            return None
         except Exception as e:
-            logging.exception(f"similar failed: {e}")
+            logger.exception("similar failed: %s", e)
             return None
+
+    def cache_stats(self) -> Dict[str, Dict]:
+        stats = {"product_details": self.product_cache.stats()}
+        stats["product_details"]["coalesced"] = self._product_flight.coalesced
+        stats["similar_products"] = self.similar_cache.stats()
+        stats["short_links"] = self.url_resolver.cache.stats()
+        if self.catalog is not None:
+            stats["catalog"] = self.catalog.stats()
+        return stats
+
+    async def warm_up(self, connections: int = 1):
+        await self.client.warm_up(connections)
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
+        if self._http is not None:
+            await self._http.aclose()
+        if self.catalog is not None:
+            self.catalog.close()
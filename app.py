@@ -1,26 +1,53 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import hmac
 import logging
+from contextlib import nullcontext
 import os
+import random
 import time
+import uuid
 from dotenv import load_dotenv
-from aliexpress_client import AliExpressClient
+from aliexpress_client import AliExpressClient, PRODUCT_DETAILS_BATCH_SIZE
+from job_queue import JobQueue, QueueFullError
+from dedup import DedupStore
+from pipeline import Pipeline, fire_and_forget
+from deadline import Deadline, DeadlineExceeded
+from quota import BATCH, BACKGROUND
+from watch_store import WatchStore
+from watch_scheduler import WatchScheduler
+from metrics import REGISTRY, WEBHOOK_SECONDS, InFlightMiddleware
+from traffic_log import RecordedCatalog, TrafficRecorder, read_traffic
+from profiler import RequestProfiler, collapsed, sample_process
+from log_pipeline import PAYLOAD, parse_settings, setup_logging
 import twilio_client
 import json
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from urllib.parse import urlparse
 
-# Setup logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
-logger = logging.getLogger(__name__)
-
 # Load environment variables
 load_dotenv()
 
+# Setup logging: records are queued and written by a background thread, so a
+# slow stderr or log file never blocks the event loop. Messages are capped at
+# LOG_MAX_MESSAGE characters, and the records marked PAYLOAD (full gateway
+# responses, webhook forms) are kept at LOG_PAYLOAD_SAMPLE, e.g.
+# "0.01,aliexpress_client=0.1". LOG_LEVELS overrides single loggers.
+log_pipeline = setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    structured=os.getenv("LOG_FORMAT", "json") == "json",
+    max_length=int(os.getenv("LOG_MAX_MESSAGE", "2000")),
+    payload_rates={name: float(rate)
+                   for name, rate in parse_settings(os.getenv("LOG_PAYLOAD_SAMPLE", "0.01")).items()},
+    # twilio's client logs every request's headers and body at INFO
+    logger_levels=parse_settings(os.getenv("LOG_LEVELS", "twilio.http_client=WARNING")),
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+)
+logger = logging.getLogger(__name__)
+
 # Initialize FastAPI app
 app = FastAPI()
 
@@ -35,6 +62,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(InFlightMiddleware)
 
 # Initialize AliExpress client
 api_key = os.getenv("ALIEXPRESS_API_KEY", "")
@@ -45,16 +73,220 @@ logger.info(f"API Key length: {len(api_key)}")
 logger.info(f"Affiliate ID length: {len(affiliate_id)}")
 logger.info(f"App Secret length: {len(app_secret)}")
 
+def parse_credentials(value):
+    """Parses "key1:secret1,key2:secret2" into (key, secret) pairs"""
+    pairs = [item.split(":", 1) for item in value.split(",") if item.strip()]
+    return [(key.strip(), secret.strip()) for key, secret in pairs]
+
+def parse_method_rates(value):
+    """Parses "method=rate/burst,..." into {method: (rate, burst)}"""
+    rates = {}
+    for item in value.split(","):
+        if item.strip():
+            method, limits = item.split("=", 1)
+            rate, burst = limits.split("/", 1)
+            rates[method.strip()] = (float(rate), float(burst))
+    return rates
+
+# opt-in capture of webhooks and gateway calls for benchmarks/replay.py
+TRAFFIC_LOG_PATH = os.getenv("TRAFFIC_LOG_PATH", "")
+traffic_recorder = TrafficRecorder(TRAFFIC_LOG_PATH, os.getenv("TRAFFIC_LOG_SALT")) if TRAFFIC_LOG_PATH else None
+# set by benchmarks/replay.py: catalog lookups are answered from the recording
+CATALOG_REPLAY_PATH = os.getenv("CATALOG_REPLAY_PATH", "")
+
 aliexpress_client = AliExpressClient(
     api_key=api_key,
     affiliate_id=affiliate_id,
-    app_secret=app_secret
+    app_secret=app_secret,
+    # the benchmarks point this at a local stand-in of the gateway
+    server_url=os.getenv("IOP_SERVER_URL", "https://api-sg.aliexpress.com/sync"),
+    max_connections=int(os.getenv("IOP_POOL_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("IOP_POOL_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("IOP_POOL_KEEPALIVE_EXPIRY", "30")),
+    product_cache_size=int(os.getenv("PRODUCT_CACHE_SIZE", "1024")),
+    product_cache_ttl=float(os.getenv("PRODUCT_CACHE_TTL", "600")),
+    similar_cache_size=int(os.getenv("SIMILAR_CACHE_SIZE", "512")),
+    similar_cache_soft_ttl=float(os.getenv("SIMILAR_CACHE_SOFT_TTL", "300")),
+    similar_cache_hard_ttl=float(os.getenv("SIMILAR_CACHE_HARD_TTL", "3600")),
+    max_redirect_hops=int(os.getenv("MAX_REDIRECT_HOPS", "5")),
+    short_link_cache_size=int(os.getenv("SHORT_LINK_CACHE_SIZE", "4096")),
+    timeout=float(os.getenv("IOP_TIMEOUT", "30")),
+    hedge_reads=os.getenv("IOP_HEDGE_READS", "false").lower() == "true",
+    breaker_options={
+        "error_rate": float(os.getenv("IOP_BREAKER_ERROR_RATE", "0.5")),
+        "p99_latency": float(os.getenv("IOP_BREAKER_P99_LATENCY", "10")),
+        "open_seconds": float(os.getenv("IOP_BREAKER_OPEN_SECONDS", "30")),
+    },
+    extra_credentials=parse_credentials(os.getenv("ALIEXPRESS_EXTRA_CREDENTIALS", "")),
+    quota_rate=float(os.getenv("IOP_QUOTA_RATE", "5")),
+    quota_burst=float(os.getenv("IOP_QUOTA_BURST", "10")),
+    quota_method_rates=parse_method_rates(os.getenv("IOP_QUOTA_METHOD_RATES", "")),
+    catalog_path=os.getenv("CATALOG_PATH", "catalog.db") or None,
+    catalog_max_age=float(os.getenv("CATALOG_MAX_AGE", "3600")),
+    catalog_min_overlap=float(os.getenv("CATALOG_MIN_OVERLAP", "0.6")),
+    similar_pages=int(os.getenv("SIMILAR_PAGES", "3")),
+    similar_top_k=int(os.getenv("SIMILAR_TOP_K", "10")),
+    similar_min_relevance=float(os.getenv("SIMILAR_MIN_RELEVANCE", "0.4")),
+    similar_min_score=float(os.getenv("SIMILAR_MIN_SCORE", "0.1")),
+    recorder=traffic_recorder.record_iop if traffic_recorder else None,
+    catalog_recorder=traffic_recorder.record_catalog if traffic_recorder else None,
+    catalog=RecordedCatalog(read_traffic(CATALOG_REPLAY_PATH)) if CATALOG_REPLAY_PATH else None,
 )
 
+job_queue = JobQueue(
+    concurrency=int(os.getenv("WEBHOOK_WORKERS", "16")),
+    max_depth=int(os.getenv("WEBHOOK_QUEUE_DEPTH", "1000")),
+)
+
+# end-to-end budget of one webhook; the lookups stop WEBHOOK_FALLBACK_RESERVE
+# seconds early so the degraded reply still has time to get an affiliate link
+WEBHOOK_DEADLINE = float(os.getenv("WEBHOOK_DEADLINE", "8"))
+WEBHOOK_FALLBACK_RESERVE = float(os.getenv("WEBHOOK_FALLBACK_RESERVE", "1.5"))
+
+BATCH_API_KEY = os.getenv("BATCH_API_KEY", "")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# seconds each item gets to resolve its link, and again to find cheaper products
+BATCH_ITEM_DEADLINE = float(os.getenv("BATCH_ITEM_DEADLINE", "10"))
+
+# the /admin endpoints, and X-Profile on webhooks, need this key in X-API-Key
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# fraction of webhooks profiled without being asked to
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+request_profiler = RequestProfiler(
+    interval=float(os.getenv("PROFILE_REQUEST_INTERVAL", "0.001")),
+    keep=int(os.getenv("PROFILE_KEEP", "20")),
+)
+process_profile_lock = asyncio.Lock()
+
+watch_store = WatchStore(os.getenv("WATCH_DB_PATH", "watches.db"))
+
+dedup_store = DedupStore(
+    maxsize=int(os.getenv("DEDUP_MAX_ENTRIES", "10000")),
+    window=float(os.getenv("DEDUP_WINDOW", "600")),
+    fallback_window=float(os.getenv("DEDUP_FALLBACK_WINDOW", "30")),
+)
+
+async def notify_price_drops(drops):
+    """Sends one WhatsApp message per watch whose product got cheaper"""
+    urls = {product_id: f"https://www.aliexpress.com/item/{product_id}.html" for _, product_id, _, _, _ in drops}
+    links = await aliexpress_client.generate_affiliate_links_async(list(urls.values()), priority=BACKGROUND)
+    for user, product_id, title, old_price, new_price in drops:
+        url = urls[product_id]
+        twilio_client.send_price_drop_message(user, title, old_price, new_price, links.get(url, url))
+
+watch_scheduler = WatchScheduler(
+    aliexpress_client,
+    watch_store,
+    notify_price_drops,
+    interval=float(os.getenv("WATCH_REFRESH_INTERVAL", "21600")),
+    batch_size=int(os.getenv("WATCH_BATCH_SIZE", "50")),
+    min_tick=float(os.getenv("WATCH_MIN_TICK", "5")),
+)
+
+@app.on_event("startup")
+async def startup():
+    if ADMIN_API_KEY or PROFILE_SAMPLE_RATE > 0:
+        request_profiler.install(asyncio.get_running_loop())
+    await twilio_client.dispatcher.start()
+    await job_queue.start()
+    await watch_scheduler.start()
+    await asyncio.gather(
+        aliexpress_client.warm_up(int(os.getenv("IOP_POOL_WARM_CONNECTIONS", "2"))),
+        run_in_threadpool(twilio_client.warm_up),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await watch_scheduler.stop()
+    await job_queue.stop()
+    await twilio_client.dispatcher.stop()
+    await aliexpress_client.aclose()
+    watch_store.close()
+    if traffic_recorder:
+        traffic_recorder.close()
+    log_pipeline.stop()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return {
+        # an open breaker means lookups are failing fast or degrading
+        "status": "healthy" if aliexpress_client.gateway.healthy else "degraded",
+        "gateway": aliexpress_client.gateway.stats(),
+        "quota": aliexpress_client.quota.stats(),
+        "caches": aliexpress_client.cache_stats(),
+        "webhook_queue": job_queue.stats(),
+        "dedup": dedup_store.stats(),
+        "pipeline": lookup_pipeline.stats(),
+        "twilio_dispatcher": twilio_client.dispatcher.stats(),
+        "watches": watch_scheduler.stats(),
+        "traffic_log": traffic_recorder.stats() if traffic_recorder else None,
+        "logging": log_pipeline.stats(),
+    }
+
+@REGISTRY.collector
+def collect_state():
+    """Counters the components already keep, read at scrape time"""
+    caches = aliexpress_client.cache_stats()
+    yield ("cache_hits_total", "counter", "Cache hits by cache",
+           [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    yield ("cache_misses_total", "counter", "Cache misses by cache",
+           [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    queue = job_queue.stats()
+    yield ("webhook_jobs_in_progress", "gauge", "Webhook jobs being processed", [({}, queue["in_progress"])])
+    yield ("webhook_queue_depth", "gauge", "Webhook jobs waiting for a worker", [({}, queue["depth"])])
+    yield ("twilio_messages_pending", "gauge", "Twilio messages queued or being sent",
+           [({}, twilio_client.dispatcher.pending)])
+    yield ("quota_waiting", "gauge", "Gateway calls waiting for quota by method",
+           [({"method": method}, count) for method, count in aliexpress_client.quota.stats()["waiting"].items()])
+    yield ("circuit_open", "gauge", "1 when the method's circuit breaker isn't closed",
+           [({"method": method}, int(breaker.state != "closed"))
+            for method, breaker in aliexpress_client.gateway.breakers.items()])
+    yield ("log_records_dropped_total", "counter", "Log records dropped because the log queue was full",
+           [({}, log_pipeline.stats()["dropped"])])
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+def has_api_key(request: Request, key: str) -> bool:
+    """Constant-time check of X-API-Key; a key that isn't configured matches nothing"""
+    return bool(key) and hmac.compare_digest(request.headers.get("X-API-Key", "").encode(), key.encode())
+
+def is_admin(request: Request) -> bool:
+    return has_api_key(request, ADMIN_API_KEY)
+
+@app.get("/admin/profile")
+async def profile_process(request: Request, seconds: float = 10, interval: float = 0.01):
+    """Samples every thread for `seconds`; returns collapsed stacks for flamegraph.pl or speedscope"""
+    if not is_admin(request):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    if process_profile_lock.locked():
+        return JSONResponse({"error": "A profile is already running"}, status_code=409)
+    async with process_profile_lock:
+        samples = await asyncio.to_thread(
+            sample_process, min(max(seconds, 0.1), PROFILE_MAX_SECONDS), max(interval, 0.001))
+    return PlainTextResponse(collapsed(samples))
+
+@app.get("/admin/profile/requests")
+async def request_profiles(request: Request):
+    """Most recent per-webhook profiles"""
+    if not is_admin(request):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return request_profiler.finished()
+
+@app.get("/admin/profile/requests/{profile_id}")
+async def request_profile(request: Request, profile_id: str):
+    """Collapsed event loop stacks sampled while one webhook was processed"""
+    if not is_admin(request):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        return JSONResponse({"error": "Unknown or unfinished profile"}, status_code=404)
+    return PlainTextResponse(collapsed(profile.samples))
 
 @app.post("/")
 async def root():
@@ -63,13 +295,13 @@ async def root():
 @app.post("/webhook")
 async def webhook(request: Request):
     """Handle incoming WhatsApp messages from Twilio"""
-    start = time.time()
     try:
         form_data = await request.form()
-        logger.info(f"Received Twilio webhook form data: {form_data}")
+        logger.info("Received Twilio webhook form data: %s", form_data, extra=PAYLOAD)
 
         body = form_data.get("Body")
         from_number = form_data.get("From")
+        message_sid = form_data.get("MessageSid")
 
         if not body or not from_number:
             # Check if this is a fallback error payload
@@ -80,111 +312,395 @@ async def webhook(request: Request):
                     params = payload.get("webhook", {}).get("request", {}).get("parameters", {})
                     body = params.get("Body")
                     from_number = params.get("From")
+                    message_sid = params.get("MessageSid")
                 except Exception as e:
                     logger.exception("Failed to parse fallback Payload")
 
         if not body or not from_number:
             logger.warning("Missing 'Body' or 'From' in all sources")
-            twilio_client.send_generic_error_message(from_number)
+            if from_number:
+                twilio_client.send_generic_error_message(from_number)
             return JSONResponse({"error": "Invalid Twilio webhook data"}, status_code=400)
 
-        logger.info(f"Incoming message from {from_number}: {body}")
-        twilio_client.send_user_messaged_bot(from_number, body)
-
-        if body.lower() == 'start':
-            twilio_client.send_instruction_message(from_number)
-            return JSONResponse({"message": "Instructions sent"}, status_code=200)
-        
-        url = body
+        if traffic_recorder:
+            traffic_recorder.record_webhook(from_number, body, message_sid)
 
-        url = aliexpress_client.extract_url_from_text(url)
-        # Check if the message is a valid URL
-        if not is_valid_url(url):
-            logger.warning("Invalid URL format")
-            twilio_client.send_input_error_message(from_number)
-            return JSONResponse({"error": "Invalid URL format"}, status_code=400)
+        dedup_key = dedup_store.key_for(message_sid, from_number, body)
+        existing = dedup_store.claim(dedup_key)
+        if existing is not None:
+            logger.info("Duplicate delivery %s (%s)", dedup_key, existing["state"])
+            return JSONResponse({"status": "duplicate", **existing}, status_code=200)
 
-        twilio_client.send_thinking_message(from_number)
+        profile_id = None
+        if (request.headers.get("X-Profile") and is_admin(request)) or random.random() < PROFILE_SAMPLE_RATE:
+            profile_id = message_sid or uuid.uuid4().hex
 
+        # Twilio only needs the ack; the replies are sent from the worker pool
         try:
-            product_id = aliexpress_client.extract_product_id_from_url(url)
-            if not product_id:
-                logger.warning("Could not extract product ID from URL")
-                logger.info("Trying to expand shortlink")
-                expanded_url = aliexpress_client.get_redirected_url_info(url)
-                if expanded_url:
-                    logger.info(f"Expanded URL: {expanded_url}")
-                    product_id = aliexpress_client.extract_product_id_from_url(expanded_url)
-                    if not product_id:
-                        logger.warning("Could not extract product ID from expanded URL - giving it another tru with legacy method")
-                        product_id = aliexpress_client.extract_product_id_from_url_legacy(expanded_url)
-                        if not product_id:
-                            twilio_client.send_input_error_message(from_number)
-                            return JSONResponse({"error": "Invalid AliExpress URL"}, status_code=400)
-                else:
-                    logger.error("Failed to expand shortlink")
-                    twilio_client.send_input_error_message(from_number)
-                    return JSONResponse({"error": "Invalid AliExpress URL"}, status_code=400)
-
-            product = aliexpress_client.get_single_product_details(product_id)
-            if not product:
-                logger.error("Failed to get product details")
-                aff_url =  aliexpress_client.generate_affiliate_link(url)
-                if not aff_url:
-                    logger.error("Failed to generate affiliate link")
-                    twilio_client.send_cant_find_product(from_number, url)
-                    return JSONResponse({"error": "Failed to get product details"}, status_code=500)
-                twilio_client.send_cant_find_product(from_number, aff_url[0]['promotion_link'])
-                return JSONResponse({"error": "Failed to get product details"}, status_code=500)
-
-            similar_products_with_affiliate = aliexpress_client.similar_products(product)
-
-            end = time.time()
-
-            twilio_client.send_template_message(
-                to_number=from_number,
-                product_title_1=similar_products_with_affiliate[0]["title"],
-                product_title_2=similar_products_with_affiliate[1]["title"],
-                product_title_3=similar_products_with_affiliate[2]["title"],
-                product_url_1=similar_products_with_affiliate[0]["affiliate_url"],
-                product_url_2=similar_products_with_affiliate[1]["affiliate_url"],
-                product_url_3=similar_products_with_affiliate[2]["affiliate_url"] ,
-                product_price_1=similar_products_with_affiliate[0]["price"],
-                product_price_2=similar_products_with_affiliate[1]["price"],
-                product_price_3=similar_products_with_affiliate[2]["price"]
-            )
-
-            twilio_client.send_result_message(
-                to_number=from_number,
-                original_price=product["target_sale_price"],
-                product_title_1=similar_products_with_affiliate[0]["title"],
-                product_title_2=similar_products_with_affiliate[1]["title"],
-                product_title_3=similar_products_with_affiliate[2]["title"],
-                product_url_1=similar_products_with_affiliate[0]["affiliate_url"],
-                product_url_2=similar_products_with_affiliate[1]["affiliate_url"],
-                product_url_3=similar_products_with_affiliate[2]["affiliate_url"] ,
-                product_price_1=similar_products_with_affiliate[0]["price"],
-                product_price_2=similar_products_with_affiliate[1]["price"],
-                product_price_3=similar_products_with_affiliate[2]["price"]
-            )
-
-            logging.info({
-                "took": end - start,
-                "original_product": {product["product_title"]: product["target_sale_price"]},
-                "cheaper_products": [{p["affiliate_url"]: p["price"]} for p in similar_products_with_affiliate],
-            })
-
-            return PlainTextResponse("OK", status_code=200)
-
-        except Exception as e:
-            logger.exception(f"Error processing product: {e}")
-            twilio_client.send_generic_error_message(from_number)
-            return JSONResponse({"error": str(e)}, status_code=500)
+            # the budget starts now so time spent queued counts against it
+            job_queue.submit(process_message, dedup_key, from_number, body, Deadline(WEBHOOK_DEADLINE),
+                             profile_id=profile_id)
+        except QueueFullError:
+            # let Twilio's retry of this delivery through
+            dedup_store.release(dedup_key)
+            raise
+        if profile_id:
+            return PlainTextResponse("OK", status_code=200, headers={"X-Profile-Id": profile_id})
+        return PlainTextResponse("OK", status_code=200)
 
+    except QueueFullError as e:
+        logger.error("Rejecting webhook: %s", e)
+        return JSONResponse({"error": "Server busy"}, status_code=503)
     except Exception as e:
         logger.exception(f"Webhook error: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
-    
+
+async def process_message(dedup_key, from_number, body, deadline=None, profile_id=None):
+    # a profiled message samples the event loop while its tasks run; it's
+    # read back from /admin/profile/requests/{profile_id}
+    try:
+        with request_profiler.profile(profile_id) if profile_id else nullcontext():
+            started = time.monotonic()
+            outcome = "exception"
+            try:
+                result = await handle_message(from_number, body, deadline)
+                outcome = "error" if "error" in result else "ok"
+            finally:
+                WEBHOOK_SECONDS.observe(time.monotonic() - started, outcome)
+    except BaseException:
+        # left "processing", every redelivery would be acked as a duplicate
+        # for the whole window and never answered
+        dedup_store.release(dedup_key)
+        raise
+    dedup_store.complete(dedup_key, result)
+
+async def within_deadline(ctx, coro, what):
+    try:
+        return await coro
+    except DeadlineExceeded:
+        logger.warning("Deadline exceeded while %s", what)
+        ctx["deadline_exceeded"] = True
+        return None
+
+lookup_pipeline = Pipeline("lookup")
+
+@lookup_pipeline.stage("notify_admin", background=True)
+async def notify_admin_stage(ctx):
+    twilio_client.send_user_messaged_bot(ctx["from_number"], ctx["body"])
+
+@lookup_pipeline.stage("thinking")
+async def thinking_stage(ctx):
+    twilio_client.send_thinking_message(ctx["from_number"])
+
+@lookup_pipeline.stage("product_id")
+async def product_id_stage(ctx):
+    product_id = await within_deadline(
+        ctx, aliexpress_client.resolve_product_id_async(ctx["url"], ctx["lookup_deadline"]), "resolving the product ID")
+    if not product_id:
+        logger.warning("Could not resolve a product ID from %s", ctx["url"])
+    return product_id
+
+@lookup_pipeline.stage("product", after=["product_id"])
+async def product_stage(ctx):
+    if not ctx["product_id"]:
+        return None
+    product = await within_deadline(
+        ctx, aliexpress_client.get_single_product_details_async(ctx["product_id"], ctx["lookup_deadline"]), "fetching product details")
+    if not product:
+        logger.error("Failed to get product details")
+    return product
+
+@lookup_pipeline.stage("similar", after=["product"])
+async def similar_stage(ctx):
+    if not ctx["product"]:
+        return None
+    return await within_deadline(
+        ctx, aliexpress_client.similar_products_async(ctx["product"], ctx["lookup_deadline"]), "searching similar products")
+
+def needs_fallback_link(ctx):
+    # no product details, or no cheaper products (including running out of
+    # time before the similar search finished)
+    if not ctx["product_id"]:
+        return False
+    return not ctx["product"] or not ctx["similar"]
+
+@lookup_pipeline.stage("fallback_link", after=["similar"])
+async def fallback_link_stage(ctx):
+    if not needs_fallback_link(ctx):
+        return None
+    url = (ctx["product"] or {}).get("product_detail_url") or ctx["url"]
+    # runs on the full deadline: the lookups stop early to leave it this reserve
+    links = await within_deadline(
+        ctx, aliexpress_client.generate_affiliate_links_async([url], ctx["deadline"]), "generating the fallback link")
+    aff_url = (links or {}).get(url)
+    if not aff_url:
+        logger.error("Failed to generate affiliate link")
+    return aff_url
+
+@lookup_pipeline.stage("reply", after=["thinking", "similar", "fallback_link"])
+async def reply_stage(ctx):
+    from_number = ctx["from_number"]
+
+    if not ctx["product_id"]:
+        if ctx.get("deadline_exceeded"):
+            twilio_client.send_cant_find_product(from_number, ctx["url"])
+            return {"error": "Deadline exceeded"}
+        twilio_client.send_input_error_message(from_number)
+        return {"error": "Invalid AliExpress URL"}
+
+    product = ctx["product"]
+    if needs_fallback_link(ctx):
+        aff_url = ctx["fallback_link"]
+        twilio_client.send_cant_find_product(from_number, aff_url or ctx["url"])
+        if ctx.get("deadline_exceeded"):
+            error = "Deadline exceeded"
+        elif product:
+            error = "No cheaper products found"
+        else:
+            error = "Failed to get product details"
+        if aff_url:
+            return {"error": error, "affiliate_url": aff_url}
+        return {"error": error}
+
+    similar_products_with_affiliate = ctx["similar"]
+    if len(similar_products_with_affiliate) < 3:
+        # the WhatsApp template has exactly three product slots
+        twilio_client.send_partial_result_message(from_number, product["target_sale_price"], similar_products_with_affiliate)
+        return {
+            "original_product": {product["product_title"]: product["target_sale_price"]},
+            "cheaper_products": [{p["affiliate_url"]: p["price"]} for p in similar_products_with_affiliate],
+        }
+
+    twilio_client.send_template_message(
+        to_number=from_number,
+        product_title_1=similar_products_with_affiliate[0]["title"],
+        product_title_2=similar_products_with_affiliate[1]["title"],
+        product_title_3=similar_products_with_affiliate[2]["title"],
+        product_url_1=similar_products_with_affiliate[0]["affiliate_url"],
+        product_url_2=similar_products_with_affiliate[1]["affiliate_url"],
+        product_url_3=similar_products_with_affiliate[2]["affiliate_url"] ,
+        product_price_1=similar_products_with_affiliate[0]["price"],
+        product_price_2=similar_products_with_affiliate[1]["price"],
+        product_price_3=similar_products_with_affiliate[2]["price"]
+    )
+
+    twilio_client.send_result_message(
+        to_number=from_number,
+        original_price=product["target_sale_price"],
+        product_title_1=similar_products_with_affiliate[0]["title"],
+        product_title_2=similar_products_with_affiliate[1]["title"],
+        product_title_3=similar_products_with_affiliate[2]["title"],
+        product_url_1=similar_products_with_affiliate[0]["affiliate_url"],
+        product_url_2=similar_products_with_affiliate[1]["affiliate_url"],
+        product_url_3=similar_products_with_affiliate[2]["affiliate_url"] ,
+        product_price_1=similar_products_with_affiliate[0]["price"],
+        product_price_2=similar_products_with_affiliate[1]["price"],
+        product_price_3=similar_products_with_affiliate[2]["price"]
+    )
+
+    return {
+        "original_product": {product["product_title"]: product["target_sale_price"]},
+        "cheaper_products": [{p["affiliate_url"]: p["price"]} for p in similar_products_with_affiliate],
+    }
+
+async def handle_message(from_number, body, deadline=None):
+    """Run the price lookup for one incoming message and send the WhatsApp replies"""
+    logger.info("Incoming message from %s (%d characters)", from_number, len(body))
+    logger.info("Message body from %s: %s", from_number, body, extra=PAYLOAD)
+
+    if body.lower() == 'start':
+        twilio_client.send_user_messaged_bot(from_number, body)
+        twilio_client.send_instruction_message(from_number)
+        return {"message": "Instructions sent"}
+
+    command = body.split(maxsplit=1)[0].lower() if body.strip() else ""
+    if command == 'watch':
+        return await handle_watch(from_number, body, deadline or Deadline(WEBHOOK_DEADLINE))
+    if command == 'unwatch':
+        return await handle_unwatch(from_number, body, deadline or Deadline(WEBHOOK_DEADLINE))
+
+    url = aliexpress_client.extract_url_from_text(body)
+    # Check if the message is a valid URL
+    if not url or not is_valid_url(url):
+        logger.warning("Invalid URL format")
+        twilio_client.send_user_messaged_bot(from_number, body)
+        twilio_client.send_input_error_message(from_number)
+        return {"error": "Invalid URL format"}
+
+    try:
+        deadline = deadline or Deadline(WEBHOOK_DEADLINE)
+        run = await lookup_pipeline.run({
+            "from_number": from_number,
+            "body": body,
+            "url": url,
+            "deadline": deadline,
+            "lookup_deadline": deadline.shrink(WEBHOOK_FALLBACK_RESERVE),
+        })
+    except Exception as e:
+        logger.exception(f"Error processing product: {e}")
+        twilio_client.send_generic_error_message(from_number)
+        return {"error": str(e)}
+
+    result = dict(run.context["reply"], took=run.total, stages=run.timings)
+    logger.info("Lookup result: %s", result)
+    return result
+
+async def handle_watch(from_number, body, deadline):
+    """'watch <link>': remember the product's current price and report when it drops"""
+    twilio_client.send_user_messaged_bot(from_number, body)
+    url = aliexpress_client.extract_url_from_text(body)
+    if not url or not is_valid_url(url):
+        twilio_client.send_input_error_message(from_number)
+        return {"error": "Invalid URL format"}
+
+    try:
+        product_id = await aliexpress_client.resolve_product_id_async(url, deadline)
+        product = await aliexpress_client.get_single_product_details_async(product_id, deadline) if product_id else None
+        if not product or not product.get("target_sale_price"):
+            twilio_client.send_cant_find_product_message(from_number)
+            return {"error": "Failed to get product details"}
+
+        price = float(product["target_sale_price"])
+        await asyncio.to_thread(watch_store.add, from_number, product_id, price, product.get("product_title"))
+    except Exception as e:
+        logger.exception("Error adding watch: %s", e)
+        twilio_client.send_generic_error_message(from_number)
+        return {"error": str(e)}
+
+    twilio_client.send_watch_started_message(from_number, product.get("product_title"), price)
+    return {"watching": product_id, "price": price}
+
+async def handle_unwatch(from_number, body, deadline):
+    """'unwatch <link>' stops one watch, a bare 'unwatch' stops all of them"""
+    url = aliexpress_client.extract_url_from_text(body)
+    try:
+        product_id = await aliexpress_client.resolve_product_id_async(url, deadline) if url else None
+    except DeadlineExceeded:
+        logger.warning("Deadline exceeded while resolving the product ID to unwatch")
+        twilio_client.send_generic_error_message(from_number)
+        return {"error": "Deadline exceeded"}
+    if url and not product_id:
+        twilio_client.send_input_error_message(from_number)
+        return {"error": "Invalid URL format"}
+
+    removed = await asyncio.to_thread(watch_store.remove, from_number, product_id)
+    twilio_client.send_watch_stopped_message(from_number, removed)
+    return {"unwatched": removed}
+
+@app.post("/compare/batch")
+async def compare_batch(request: Request):
+    """Price-check many AliExpress links or product IDs, streamed back as NDJSON"""
+    # open to nobody until a key is configured: every batch spends the shared gateway quota
+    if not has_api_key(request, BATCH_API_KEY):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    try:
+        payload = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Body must be JSON"}, status_code=400)
+    items = payload.get("items") if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        return JSONResponse({"error": "Expected a non-empty list of 'items'"}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"At most {BATCH_MAX_ITEMS} items per batch"}, status_code=413)
+
+    return StreamingResponse(compare_items(items), media_type="application/x-ndjson")
+
+async def resolve_batch_item(item, deadline):
+    if isinstance(item, int) or (isinstance(item, str) and item.strip().isdigit()):
+        return str(item).strip()
+    if not isinstance(item, str):
+        return None
+    url = aliexpress_client.extract_url_from_text(item)
+    return await aliexpress_client.resolve_product_id_async(url, deadline) if url else None
+
+async def compare_items(items):
+    """Yields one NDJSON line per item, in the order the items finish
+
+    Ids are collected into multi-id productdetail.get calls, each sent once
+    it is full or once every item is resolved, so one slow short link only
+    holds back the items sharing its chunk.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    # ids of the chunk being filled, and the future its details call resolves
+    chunk, chunk_details = {}, loop.create_future()
+    unresolved = len(items)
+
+    async def fetch_details(product_ids, details):
+        products = {}
+        try:
+            products = await aliexpress_client.get_products_details_async(product_ids, priority=BATCH)
+        except Exception as e:
+            logger.exception("Batch product details failed: %s", e)
+        finally:
+            # every item of the chunk waits on this, even if the call was cancelled
+            details.set_result(products)
+
+    def send_chunk():
+        nonlocal chunk, chunk_details
+        if chunk:
+            fire_and_forget(fetch_details(list(chunk), chunk_details), "batch-details")
+            chunk, chunk_details = {}, loop.create_future()
+
+    async def resolved(product_id):
+        nonlocal unresolved
+        unresolved -= 1
+        details = None
+        if product_id:
+            details = chunk_details
+            chunk[product_id] = True
+        if len(chunk) >= PRODUCT_DETAILS_BATCH_SIZE or not unresolved:
+            send_chunk()
+        if details is None:
+            return None
+        # shielded: one item being cancelled mustn't cancel the chunk for the others
+        return (await asyncio.shield(details)).get(product_id)
+
+    async def compare(item):
+        error = "Invalid AliExpress URL"
+        try:
+            async with semaphore:
+                product_id = await resolve_batch_item(item, Deadline(BATCH_ITEM_DEADLINE))
+        except DeadlineExceeded:
+            product_id, error = None, "Timed out resolving the link"
+        except BaseException:
+            await resolved(None)
+            raise
+        # not under the semaphore: the chunk may wait on items still queued for it
+        product = await resolved(product_id)
+        if not product_id:
+            return {"item": item, "error": error}
+        if not product:
+            return {"item": item, "product_id": product_id, "error": "Failed to get product details"}
+        try:
+            async with semaphore:
+                similar = await aliexpress_client.similar_products_async(
+                    product, Deadline(BATCH_ITEM_DEADLINE), priority=BATCH)
+        except DeadlineExceeded:
+            return {"item": item, "product_id": product_id, "error": "Timed out finding cheaper products"}
+        return {
+            "item": item,
+            "product_id": product_id,
+            "title": product.get("product_title"),
+            "price": product.get("target_sale_price"),
+            "cheaper_products": similar or [],
+        }
+
+    tasks = [asyncio.ensure_future(compare(item)) for item in items]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                line = await next_done
+            except Exception as e:
+                logger.exception("Batch comparison failed: %s", e)
+                line = {"error": str(e)}
+            yield json.dumps(line) + "\n"
+    finally:
+        # the client may disconnect mid-stream
+        for task in tasks:
+            task.cancel()
+
 def is_valid_url(url):
     parsed = urlparse(url)
     return all([parsed.scheme, parsed.netloc])
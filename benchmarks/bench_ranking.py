@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Time to score similar-product candidates against the original title, by candidate count.
+
+Also times the ranking work of whole similar-product lookups: one answered
+from search pages (gateway stubbed out) and one answered from the catalog.
+
+A lookup scores at most RELEVANCE_CANDIDATES of its cheapest candidates.
+
+Usage: python benchmarks/bench_ranking.py [--sizes 100,200,300,1000] [--repeat 200]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import aliexpress_client
+from aliexpress_client import AliExpressClient, RELEVANCE_CANDIDATES, SIMILAR_PAGE_SIZE
+from catalog import ProductCatalog
+from keywords import title_tokens
+from ranking import relevance_scores
+
+TITLE = "Wireless Bluetooth 5.3 Earbuds Noise Cancelling Headphones with Charging Case IPX7 Waterproof Sports"
+
+PRODUCT_WORDS = ["wireless", "bluetooth", "5", "3", "earbuds", "headphones", "earphones", "noise", "cancelling",
+                 "anc", "hifi", "stereo", "bass", "ipx7", "waterproof", "sports", "tws", "charging", "case",
+                 "mic", "gaming", "low", "latency", "touch", "control", "led", "display"]
+ACCESSORY_WORDS = ["replacement", "ear", "tips", "silicone", "cover", "protective", "shell", "strap", "cable",
+                   "usb", "type", "c", "charger", "adapter", "sticker", "cleaning", "pen", "kit", "for"]
+FILLER_WORDS = ["2024", "new", "hot", "sale", "original", "free", "shipping", "black", "white", "pink", "blue",
+                "mini", "pro", "max", "portable", "universal"]
+
+
+def candidate_titles(n, rng):
+    titles = []
+    for _ in range(n):
+        words = rng.sample(ACCESSORY_WORDS if rng.random() < 0.4 else PRODUCT_WORDS, rng.randint(4, 9))
+        words += rng.sample(FILLER_WORDS, rng.randint(2, 6))
+        rng.shuffle(words)
+        titles.append(" ".join(words))
+    return titles
+
+
+def python_scores(title, titles):
+    # the same TF-IDF cosine, one candidate at a time
+    tokenized = [title_tokens(t) for t in titles]
+    df = {}
+    for tokens in tokenized:
+        for token in tokens:
+            df[token] = df.get(token, 0) + 1
+    idf = lambda token: math.log((1 + len(titles)) / (1 + df.get(token, 0))) + 1
+    query = set(title_tokens(title))
+    query_norm = math.sqrt(sum(idf(t) ** 2 for t in query))
+    scores = []
+    for tokens in tokenized:
+        norm = math.sqrt(sum(idf(t) ** 2 for t in tokens))
+        dot = sum(idf(t) ** 2 for t in tokens if t in query)
+        scores.append(dot / (norm * query_norm) if norm and query_norm else 0.0)
+    return scores
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure(fn, titles, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(TITLE, titles)
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(percentile(samples, 0.5), 3), "p99_ms": round(percentile(samples, 0.99), 3)}
+
+
+def candidate_products(n, rng, prefix):
+    return [{"product_id": f"{prefix}{i}", "product_title": title, "target_sale_price": f"{rng.uniform(1, 40):.2f}",
+             "product_detail_url": f"https://www.aliexpress.com/item/{prefix}{i}.html"}
+            for i, title in enumerate(candidate_titles(n, rng))]
+
+
+def lookup_client(rng, pages):
+    client = AliExpressClient(api_key="bench", affiliate_id="bench", app_secret="bench", similar_pages=pages)
+    page_products = {}
+
+    async def page(keywords, page_no, deadline=None, priority=None):
+        key = (keywords, page_no)
+        if key not in page_products:
+            products = candidate_products(SIMILAR_PAGE_SIZE, rng, f"{len(page_products)}-")
+            page_products[key] = sorted(((float(p["target_sale_price"]), p) for p in products), key=lambda c: c[0])
+        return page_no, page_products[key]
+
+    async def no_links(urls, deadline=None, priority=None):
+        return {}
+
+    client._similar_page_async = page
+    client.generate_affiliate_links_async = no_links
+    return client
+
+
+def measure_lookups(args, rng):
+    """Ranking time of whole lookups, and how many times each one runs TF-IDF."""
+    product = {"product_id": "1", "product_title": TITLE, "target_sale_price": "25"}
+    scored = []
+
+    def counted(title, titles):
+        scored.append(len(titles))
+        return relevance_scores(title, titles)
+
+    aliexpress_client.relevance_scores = counted
+    search = lookup_client(rng, args.pages)
+    search.catalog = ProductCatalog(":memory:")
+    search.catalog.upsert(candidate_products(2000, rng, "c"), "USD")
+
+    loop = asyncio.new_event_loop()
+    searcher = lookup_client(rng, args.pages)
+    lookups = {
+        # no catalog on this client, so every lookup goes through the search pages
+        "search": lambda: loop.run_until_complete(searcher._load_similar_candidates_async(product)),
+        "catalog": lambda: search._similar_from_catalog(product),
+    }
+    for name, lookup in lookups.items():
+        samples = []
+        for _ in range(args.repeat):
+            scored.clear()
+            started = time.perf_counter()
+            lookup()
+            samples.append((time.perf_counter() - started) * 1000)
+        print(json.dumps({
+            "benchmark": "similar_lookup",
+            "source": name,
+            "pages": args.pages,
+            "p50_ms": round(percentile(samples, 0.5), 3),
+            "p99_ms": round(percentile(samples, 0.99), 3),
+            "relevance_passes": len(scored),
+            "candidates_scored": sum(scored),
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=f"100,{RELEVANCE_CANDIDATES},300,1000", help="comma separated candidate counts")
+    parser.add_argument("--repeat", type=int, default=200, help="timed runs per size")
+    parser.add_argument("--pages", type=int, default=3, help="SIMILAR_PAGES for the lookup benchmark")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    defaults = AliExpressClient(api_key="bench", affiliate_id="bench", app_secret="bench")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        titles = candidate_titles(size, rng)
+
+        # both implementations must agree before their speed means anything
+        vectorized = relevance_scores(TITLE, titles)
+        assert all(abs(a - b) < 1e-9 for a, b in zip(vectorized, python_scores(TITLE, titles)))
+
+        print(json.dumps({
+            "benchmark": "relevance_scores",
+            "candidates": size,
+            "numpy": measure(relevance_scores, titles, args.repeat),
+            "python": measure(python_scores, titles, args.repeat),
+            # what AliExpressClient keeps with the default SIMILAR_MIN_RELEVANCE and SIMILAR_MIN_SCORE
+            "kept": int((vectorized >= max(defaults.similar_min_relevance * vectorized.max(),
+                                            defaults.similar_min_score)).sum()),
+        }))
+
+    measure_lookups(args, rng)
+
+
+if __name__ == '__main__':
+    main()
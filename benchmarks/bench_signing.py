@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Requests signed per second by IopClient: the original per-call path against the current one.
+
+Usage: python benchmarks/bench_signing.py [--seconds 2]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import iop
+from iop.base import (P_APPKEY, P_FORMAT, P_METHOD, P_PARTNER_ID, P_SDK_VERSION, P_SIGN,
+                      P_SIGN_METHOD, P_SIMPLIFY, P_TIMESTAMP, sign)
+
+
+def legacy_sign_request(client, request):
+    # IopClient.execute before the fast path: fresh system parameters, a new
+    # HMAC from the secret and the debug url concatenated on every call
+    sys_parameters = {
+        P_APPKEY: client._app_key,
+        P_SIGN_METHOD: "sha256",
+        P_TIMESTAMP: str(int(round(time.time()))) + '000',
+        P_PARTNER_ID: P_SDK_VERSION,
+        P_METHOD: request._api_pame,
+        P_SIMPLIFY: request._simplify,
+        P_FORMAT: request._format
+    }
+    sign_parameter = sys_parameters.copy()
+    sign_parameter.update(request._api_params)
+    sign_parameter[P_SIGN] = sign(client._app_secret, request._api_pame, sign_parameter)
+
+    full_url = client._server_url + "?"
+    for key in sign_parameter:
+        full_url += key + "=" + str(sign_parameter[key]) + "&"
+    full_url = full_url[0:-1]
+    return sign_parameter, full_url
+
+
+def current_sign_request(client, request):
+    return client._sign_request(request)
+
+
+def product_query_request():
+    request = iop.IopRequest('aliexpress.affiliate.product.query')
+    request.add_api_param('keywords', 'Wireless Bluetooth Earbuds Noise Cancelling Headphones Sports')
+    request.add_api_param('sort', 'SALE_PRICE_ASC')
+    request.add_api_param('page_no', 1)
+    request.add_api_param('page_size', 10)
+    request.add_api_param('target_currency', 'USD')
+    request.add_api_param('target_language', 'EN')
+    return request
+
+
+def measure(fn, client, request, seconds):
+    calls = 0
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            fn(client, request)
+        calls += 1000
+    return calls / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration of each measurement")
+    args = parser.parse_args()
+
+    client = iop.IopClient('https://api-sg.aliexpress.com/sync', '12345678', 'e1fed6b34feb26aabc391d187732af93')
+    request = product_query_request()
+
+    # both paths must produce the same signature for the same parameters
+    params = current_sign_request(client, request)
+    assert params[P_SIGN] == sign(client._app_secret, request._api_pame,
+                                  {k: v for k, v in params.items() if k != P_SIGN})
+
+    legacy = measure(legacy_sign_request, client, request, args.seconds)
+    current = measure(current_sign_request, client, request, args.seconds)
+    print(json.dumps({
+        "benchmark": "iop_sign_request",
+        "legacy_per_second": round(legacy),
+        "current_per_second": round(current),
+        "speedup": round(current / legacy, 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Throughput and latency of /webhook against local stand-ins for AliExpress and Twilio.
+
+Starts the fake /sync gateway and Twilio Messages API from fakes.py, runs the
+app under uvicorn in a subprocess pointed at them, and sends product links to
+/webhook from --concurrency simulated users. Each user waits for its reply
+before sending the next link, so the reply latency covers the queue, the
+gateway calls and the Twilio sends.
+
+Usage: python benchmarks/bench_webhook.py [--requests 500] [--concurrency 20] [--baseline last.json]
+"""
+
+from collections import Counter
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import LatencyModel, gateway_app, is_reply, twilio_app
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_KEY, APP_SECRET = "12345678", "e1fed6b34feb26aabc391d187732af93"
+ACCOUNT_SID = "AC" + "0" * 32
+ADMIN_NUMBER = "whatsapp:+15550000000"
+
+# the production limits would measure the limiters, not the code; override with --env
+DEFAULT_ENV = {
+    "IOP_QUOTA_RATE": "10000",
+    "IOP_QUOTA_BURST": "10000",
+    "TWILIO_SENDER_RATE": "10000",
+    "TWILIO_SENDER_BURST": "10000",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+
+def summary(samples):
+    return {f"p{round(q * 100)}_ms": round(percentile(samples, q) * 1000, 1) if samples else None
+            for q in (0.5, 0.95, 0.99)}
+
+
+async def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                           # the replay gateway holds calls the app cancels
+                                           timeout_graceful_shutdown=1))
+    # the driver owns Ctrl-C
+    server.install_signal_handlers = lambda: None
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+def start_app(port, gateway_port, twilio_port, workdir, env_overrides, log):
+    env = dict(os.environ, **DEFAULT_ENV)
+    env.update({
+        "ALIEXPRESS_API_KEY": APP_KEY,
+        "ALIEXPRESS_APP_SECRET": APP_SECRET,
+        "ALIEXPRESS_AFFILIATE_ID": "bench",
+        "IOP_SERVER_URL": f"http://127.0.0.1:{gateway_port}/sync",
+        "TWILIO_SID": ACCOUNT_SID,
+        "TWILIO_AUTH_TOKEN": "bench",
+        "TWILIO_API_URL": f"http://127.0.0.1:{twilio_port}",
+        "FROM_WHATSAPP": "whatsapp:+15551112222",
+        "ADMIN_WHATSAPP": ADMIN_NUMBER,
+        "WATCH_DB_PATH": os.path.join(workdir, "watches.db"),
+        "CATALOG_PATH": os.path.join(workdir, "catalog.db"),
+        "TRAFFIC_LOG_PATH": "",
+        # the iop SDK without needing `pip install -e python/`
+        "PYTHONPATH": os.pathsep.join(filter(None, [os.path.join(ROOT, "python"), os.environ.get("PYTHONPATH")])),
+    })
+    env.update(env_overrides)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_healthy(http, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app exited with status {process.returncode}")
+        try:
+            if (await http.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("app did not become healthy")
+
+
+async def drive(http, replies, args, product_ids, rng):
+    """Sends args.warmup + args.requests links.
+
+    Returns the ack and reply latencies of the measured requests, the errors,
+    and the time from sending the first measured request to the last reply.
+    """
+    total = args.warmup + args.requests
+    counter = iter(range(total))
+    ack_latencies, reply_latencies = [], []
+    errors = Counter()
+    measured_from = []
+
+    async def user():
+        for index in counter:
+            number = f"whatsapp:+1555{index:07d}"
+            replied = replies[number] = asyncio.get_running_loop().create_future()
+            form = {
+                "From": number,
+                "Body": f"https://www.aliexpress.com/item/{rng.choice(product_ids)}.html",
+                "MessageSid": f"SMbench{index:010d}",
+            }
+            started = time.monotonic()
+            if index == args.warmup:
+                measured_from.append(started)
+            try:
+                response = await http.post("/webhook", data=form)
+            except httpx.HTTPError as e:
+                errors[f"ack_{type(e).__name__}"] += 1
+                continue
+            acked = time.monotonic()
+            if response.status_code != 200:
+                errors[f"ack_{response.status_code}"] += 1
+                continue
+            try:
+                finished = await asyncio.wait_for(replied, args.reply_timeout)
+            except asyncio.TimeoutError:
+                errors["reply_timeout"] += 1
+                continue
+            finally:
+                replies.pop(number, None)
+            if index >= args.warmup:
+                ack_latencies.append(acked - started)
+                reply_latencies.append(finished - started)
+
+    await asyncio.gather(*[user() for _ in range(args.concurrency)])
+    elapsed = time.monotonic() - measured_from[0] if measured_from else 0
+    return ack_latencies, reply_latencies, errors, elapsed
+
+
+def regressions(result, baseline, tolerance):
+    """Metrics that got worse than ``baseline`` by more than ``tolerance``."""
+    found = []
+    for name in ("p50_ms", "p95_ms", "p99_ms"):
+        old, new = baseline["reply"].get(name), result["reply"].get(name)
+        if old and new and new > old * (1 + tolerance):
+            found.append(f"reply {name} {old} -> {new}")
+    old, new = baseline["throughput_per_second"], result["throughput_per_second"]
+    if old and new < old * (1 - tolerance):
+        found.append(f"throughput {old} -> {new}")
+    return found
+
+
+async def run(args):
+    stats = Counter()
+    replies = {}
+
+    def on_message(form):
+        if not is_reply(form):
+            return
+        replied = replies.get(form.get("To"))
+        if replied is not None and not replied.done():
+            replied.set_result(time.monotonic())
+
+    gateway_latency = LatencyModel(args.gateway_latency, args.gateway_p99, args.gateway_error_rate, args.seed)
+    twilio_latency = LatencyModel(args.twilio_latency, args.twilio_p99, args.twilio_error_rate, args.seed + 1)
+    gateway_port, twilio_port, app_port = free_port(), free_port(), free_port()
+    servers = [
+        await serve(gateway_app(APP_SECRET, gateway_latency, stats), gateway_port),
+        await serve(twilio_app(twilio_latency, stats, on_message), twilio_port),
+    ]
+
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+    with tempfile.TemporaryDirectory() as workdir, open(os.path.join(workdir, "app.log"), "w+") as log:
+        process = start_app(app_port, gateway_port, twilio_port, workdir, env_overrides, log)
+        try:
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", limits=limits,
+                                         timeout=args.reply_timeout) as http:
+                await wait_until_healthy(http, process)
+                rng = random.Random(args.seed)
+                product_ids = [str(rng.randrange(10 ** 15, 10 ** 16)) for _ in range(args.products)]
+                ack, reply, errors, elapsed = await drive(http, replies, args, product_ids, rng)
+        except Exception:
+            log.seek(0)
+            sys.stderr.write(log.read()[-5000:])
+            raise
+        finally:
+            process.terminate()
+            # the fakes share this loop and may still be answering the app's shutdown
+            try:
+                await asyncio.to_thread(process.wait, 10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            for server, task in servers:
+                server.should_exit = True
+                await task
+
+    return {
+        "benchmark": "webhook",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "products": args.products,
+        "completed": len(reply),
+        "throughput_per_second": round(len(reply) / elapsed, 1) if elapsed else 0,
+        "ack": summary(ack),
+        "reply": summary(reply),
+        "errors": dict(errors),
+        "gateway": {
+            "latency": {"median": args.gateway_latency, "p99": args.gateway_p99},
+            "error_rate": args.gateway_error_rate,
+            "calls": {k.split(".", 1)[1]: v for k, v in stats.items() if k.startswith("gateway.aliexpress.")},
+            "injected_errors": stats["gateway.injected_error"],
+            # anything but 0 means the app signs requests the real gateway would reject
+            "bad_signatures": stats["gateway.bad_signature"],
+        },
+        "twilio": {
+            "latency": {"median": args.twilio_latency, "p99": args.twilio_p99},
+            "error_rate": args.twilio_error_rate,
+            "messages": stats["twilio.messages"],
+            "injected_errors": stats["twilio.injected_error"],
+        },
+        "env": env_overrides,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="measured webhook deliveries")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured deliveries sent first")
+    parser.add_argument("--concurrency", type=int, default=20, help="simulated users sending at once")
+    parser.add_argument("--products", type=int, default=200,
+                        help="distinct product links to pick from; fewer means more cache hits")
+    parser.add_argument("--gateway-latency", type=float, default=0.08, help="median gateway latency, seconds")
+    parser.add_argument("--gateway-p99", type=float, default=0.4, help="99th percentile gateway latency, seconds")
+    parser.add_argument("--gateway-error-rate", type=float, default=0.0, help="fraction of SYSTEM errors")
+    parser.add_argument("--twilio-latency", type=float, default=0.05, help="median Twilio latency, seconds")
+    parser.add_argument("--twilio-p99", type=float, default=0.25, help="99th percentile Twilio latency, seconds")
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="seconds to wait for a reply")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment override for the app, repeatable")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed relative regression against --baseline")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["regressions"] = regressions(result, json.load(f), args.tolerance)
+    print(json.dumps(result))
+    if result.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
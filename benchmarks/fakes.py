@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Local stand-ins for the AliExpress /sync gateway and the Twilio Messages API.
+
+Both answer with the payload shapes the real services return, after a delay
+drawn from a log-normal latency model, and fail a configurable fraction of
+calls the way the real service does. The gateway checks every request's
+signature, so a signing regression shows up as failed lookups instead of
+passing unnoticed.
+"""
+
+from collections import Counter, defaultdict, deque
+from typing import Callable, Dict, Iterable, Optional, Tuple
+import asyncio
+import copy
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.requests import ClientDisconnect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+from iop.base import (P_ACCESS_TOKEN, P_APPKEY, P_DEBUG, P_FORMAT, P_METHOD, P_PARTNER_ID, P_SIGN,
+                      P_SIGN_METHOD, P_SIMPLIFY, P_TIMESTAMP, sign)
+
+SYSTEM_PARAMS = {P_ACCESS_TOKEN, P_APPKEY, P_DEBUG, P_FORMAT, P_METHOD, P_PARTNER_ID, P_SIGN, P_SIGN_METHOD,
+                 P_SIMPLIFY, P_TIMESTAMP, "tracking_id"}
+
+# standard normal quantile of the 99th percentile
+Z_99 = 2.326
+
+TITLE_WORDS = ["wireless", "bluetooth", "earbuds", "headphones", "noise", "cancelling", "stereo", "bass",
+               "waterproof", "sports", "charging", "case", "mic", "gaming", "touch", "control", "led"]
+EXTRA_WORDS = ["2024", "new", "original", "black", "white", "pro", "mini", "portable", "tws", "hifi"]
+
+
+class LatencyModel:
+    """Log-normal service time with the given median and 99th percentile, plus an error rate."""
+
+    def __init__(self, median: float, p99: float, error_rate: float = 0.0, seed: int = 0):
+        self.median = median
+        self.sigma = math.log(p99 / median) / Z_99 if p99 > median > 0 else 0.0
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+
+    def delay(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(self.sigma * self._rng.gauss(0, 1))
+
+    def fails(self) -> bool:
+        return self._rng.random() < self.error_rate
+
+
+def _seeded(*parts) -> random.Random:
+    # stable across processes, unlike hash() of a str
+    return random.Random(hashlib.sha256(":".join(map(str, parts)).encode()).digest())
+
+
+def product_payload(product_id: str) -> Dict:
+    rng = _seeded("product", product_id)
+    title = " ".join(rng.sample(TITLE_WORDS, 6) + rng.sample(EXTRA_WORDS, 2)).title()
+    return {
+        "product_id": product_id,
+        "product_title": title,
+        "target_sale_price": f"{rng.uniform(15, 60):.2f}",
+        "target_sale_price_currency": "USD",
+        "product_detail_url": f"https://www.aliexpress.com/item/{product_id}.html",
+    }
+
+
+def query_page(keywords: str, page_no: int, page_size: int) -> list:
+    # cheapest first like SALE_PRICE_ASC; every page is pricier than the one before
+    rng = _seeded("query", keywords, page_no)
+    products = []
+    for i in range(page_size):
+        product_id = str(rng.randrange(10 ** 12, 10 ** 13))
+        title = " ".join(keywords.split() + rng.sample(EXTRA_WORDS, 3)).title()
+        products.append({
+            "product_id": product_id,
+            "product_title": title,
+            "target_sale_price": f"{(page_no - 1) * 15 + 5 + i * 1.5:.2f}",
+            "target_sale_price_currency": "USD",
+            "product_detail_url": f"https://www.aliexpress.com/item/{product_id}.html",
+        })
+    return products
+
+
+def _result(method: str, result: Dict) -> Dict:
+    # aliexpress.affiliate.product.query answers in aliexpress_affiliate_product_query_response
+    return {method.replace(".", "_") + "_response": {
+        "resp_result": {"resp_code": 200, "resp_msg": "Call succeeds", "result": result}},
+        "request_id": "bench"}
+
+
+def is_reply(form: Dict[str, str]) -> bool:
+    """Whether a message sent to Twilio is the text that ends a lookup.
+
+    Every incoming message gets exactly one: the "Thinking..." ack before it
+    and the template card before a full result are not counted.
+    """
+    body = form.get("Body")
+    return bool(body) and not body.startswith("Thinking")
+
+
+async def _signed_params(request: Request, app_secret: str, stats: Counter):
+    """The request's parameters, or None when the signature doesn't match them."""
+    params = dict(request.query_params)
+    if request.method == "POST":
+        params.update((await request.form()).items())
+    stats[f"gateway.{params.get(P_METHOD, '')}"] += 1
+    signature = params.pop(P_SIGN, None)
+    if signature != sign(app_secret, params.get(P_METHOD, ""), params):
+        stats["gateway.bad_signature"] += 1
+        return None
+    return params
+
+
+BAD_SIGNATURE = {"type": "ISV", "code": "IncompleteSignature", "request_id": "bench",
+                 "message": "The request signature does not conform to platform standards"}
+
+
+def gateway_app(app_secret: str, latency: LatencyModel, stats: Counter) -> FastAPI:
+    """The /sync endpoint for product details, product search and affiliate links."""
+    app = FastAPI()
+
+    @app.api_route("/sync", methods=["GET", "POST", "HEAD"])
+    async def sync(request: Request):
+        if request.method == "HEAD":
+            # connection warm up
+            return Response()
+        params = await _signed_params(request, app_secret, stats)
+        if params is None:
+            return JSONResponse(BAD_SIGNATURE)
+        method = params.get(P_METHOD, "")
+
+        await asyncio.sleep(latency.delay())
+        if latency.fails():
+            stats["gateway.injected_error"] += 1
+            return JSONResponse({"type": "SYSTEM", "code": "ServiceUnavailable", "request_id": "bench",
+                                 "message": "The request has failed due to a temporary failure of the server"})
+
+        if method == "aliexpress.affiliate.productdetail.get":
+            products = [product_payload(i) for i in params.get("product_ids", "").split(",") if i]
+            result = {"current_record_count": len(products), "products": {"product": products}}
+        elif method == "aliexpress.affiliate.product.query":
+            products = query_page(params.get("keywords", ""), int(params.get("page_no", 1)),
+                                  int(params.get("page_size", 10)))
+            result = {"current_record_count": len(products), "products": {"product": products}}
+        elif method == "aliexpress.affiliate.link.generate":
+            links = [{"source_value": url, "promotion_link": "https://s.click.aliexpress.com/e/_bench"
+                      + hashlib.sha1(url.encode()).hexdigest()[:8]}
+                     for url in params.get("source_values", "").split(",") if url]
+            result = {"total_result_count": len(links), "promotion_links": {"promotion_link": links}}
+        else:
+            return JSONResponse({"type": "ISV", "code": "InvalidApiPath", "request_id": "bench",
+                                 "message": f"Unknown method {method}"})
+        return JSONResponse(_result(method, result))
+
+    return app
+
+
+def request_key(method: str, params: Dict) -> Tuple[str, str]:
+    # what identifies a gateway call across runs: the method and its own parameters
+    return method, json.dumps({k: str(v) for k, v in params.items() if k not in SYSTEM_PARAMS}, sort_keys=True)
+
+
+# seconds a call cancelled in the recording is held open past its recorded time
+CANCELLED_GRACE = 5.0
+
+# multi-item calls are batched by whatever happened to be in flight together,
+# so their items are also matched one by one:
+# method -> (parameter listing the items, path to the item list in the body, item id field)
+ITEM_CALLS = {
+    "aliexpress.affiliate.productdetail.get":
+        ("product_ids", ("resp_result", "result", "products", "product"), "product_id"),
+    "aliexpress.affiliate.link.generate":
+        ("source_values", ("resp_result", "result", "promotion_links", "promotion_link"), "source_value"),
+}
+
+
+def _item_list(body: Dict, method: str, path: Tuple[str, ...]) -> Dict:
+    # the dict holding the item list, so it can be read or replaced
+    node = body.get(method.replace(".", "_") + "_response", {})
+    for key in path[:-1]:
+        node = node.get(key) or {}
+    return node
+
+
+class RecordedGateway:
+    """Answers gateway calls with the responses of a traffic log.
+
+    A call with the same method and parameters as a recorded one gets its
+    responses in recorded order, and the last one again once they run out.
+    Product details and affiliate links are also answered item by item, from
+    whichever recorded batch held each item.
+    """
+
+    def __init__(self, calls: Iterable[Dict]):
+        self._calls = defaultdict(deque)
+        self._items = {}
+        self._templates = {}
+        for call in calls:
+            self._calls[request_key(call["method"], call["params"])].append(call)
+            if call["method"] in ITEM_CALLS and "body" in call:
+                self._index_items(call)
+
+    def _index_items(self, call: Dict) -> None:
+        method = call["method"]
+        param, path, id_field = ITEM_CALLS[method]
+        rest = request_key(method, {k: v for k, v in call["params"].items() if k != param})
+        for item in _item_list(call["body"], method, path).get(path[-1]) or []:
+            self._items[rest, str(item.get(id_field))] = (item, call["seconds"])
+        self._templates[method] = call
+
+    def answer(self, method: str, params: Dict) -> Optional[Dict]:
+        """A recorded call, or one assembled from recorded items, with ``body`` or ``error`` and ``seconds``."""
+        responses = self._calls.get(request_key(method, params))
+        if responses:
+            return responses.popleft() if len(responses) > 1 else responses[0]
+        if method not in ITEM_CALLS or method not in self._templates:
+            return None
+
+        param, path, _ = ITEM_CALLS[method]
+        rest = request_key(method, {k: v for k, v in params.items() if k != param})
+        found = [self._items[key] for key in ((rest, i) for i in params.get(param, "").split(",")) if key in self._items]
+        if not found:
+            return None
+        body = copy.deepcopy(self._templates[method]["body"])
+        _item_list(body, method, path)[path[-1]] = [item for item, _ in found]
+        return {"body": body, "seconds": max(seconds for _, seconds in found)}
+
+
+def replay_gateway_app(app_secret: str, calls: Iterable[Dict], stats: Counter, recorded_latency: bool = True) -> FastAPI:
+    """The /sync endpoint answering from a traffic log through RecordedGateway.
+
+    With ``recorded_latency`` each answer takes as long as it did when it was
+    recorded. A call that was cancelled when recorded is held open for
+    CANCELLED_GRACE past its recorded time; one the app still waits for then
+    counts as unmatched.
+    """
+    recorded = RecordedGateway(calls)
+    app = FastAPI()
+
+    @app.api_route("/sync", methods=["GET", "POST", "HEAD"])
+    async def sync(request: Request):
+        if request.method == "HEAD":
+            return Response()
+        try:
+            params = await _signed_params(request, app_secret, stats)
+        except ClientDisconnect:
+            # cancelled by the app before the body arrived
+            stats["gateway.disconnected"] += 1
+            return Response()
+        if params is None:
+            return JSONResponse(BAD_SIGNATURE)
+
+        call = recorded.answer(params.get(P_METHOD, ""), params)
+        if call is None:
+            stats["gateway.unmatched"] += 1
+            return JSONResponse({"type": "ISV", "code": "NotRecorded", "request_id": "replay",
+                                 "message": "No recorded response for this call"})
+        if call.get("cancelled"):
+            # the app gave up on this call when it was recorded; it should again
+            give_up = time.monotonic() + call["seconds"] + CANCELLED_GRACE
+            while time.monotonic() < give_up:
+                if await request.is_disconnected():
+                    stats["gateway.matched"] += 1
+                    stats["gateway.cancelled"] += 1
+                    return Response()
+                await asyncio.sleep(0.05)
+            stats["gateway.unmatched"] += 1
+            stats["gateway.cancelled_awaited"] += 1
+            return JSONResponse({"type": "ISV", "code": "NotRecorded", "request_id": "replay",
+                                 "message": "The recorded call was cancelled"})
+        stats["gateway.matched"] += 1
+        if recorded_latency:
+            await asyncio.sleep(call["seconds"])
+        if "error" in call:
+            # the client sees a transport failure, as it did when recorded
+            return Response(call["error"], status_code=502)
+        return JSONResponse(call["body"])
+
+    return app
+
+
+def twilio_app(latency: LatencyModel, stats: Counter, on_message: Callable[[Dict[str, str]], None]) -> FastAPI:
+    """The Messages resource; ``on_message`` sees the form of every accepted message."""
+    app = FastAPI()
+
+    @app.head("/")
+    async def warm_up():
+        return Response()
+
+    @app.post("/2010-04-01/Accounts/{account_sid}/Messages.json")
+    async def create_message(account_sid: str, request: Request):
+        form = dict((await request.form()).items())
+        await asyncio.sleep(latency.delay())
+        if latency.fails():
+            stats["twilio.injected_error"] += 1
+            return JSONResponse({"code": 20429, "message": "Too Many Requests", "status": 429}, status_code=429)
+
+        stats["twilio.messages"] += 1
+        on_message(form)
+        sid = "SM" + hashlib.md5(f"{time.time_ns()}{form.get('To')}".encode()).hexdigest()
+        return JSONResponse({
+            "sid": sid,
+            "account_sid": account_sid,
+            "to": form.get("To"),
+            "from": form.get("From"),
+            "body": form.get("Body", ""),
+            "status": "queued",
+            "num_segments": "1",
+            "direction": "outbound-api",
+            "api_version": "2010-04-01",
+            "uri": f"/2010-04-01/Accounts/{account_sid}/Messages/{sid}.json",
+        }, status_code=201)
+
+    return app
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Replays a recorded traffic log against the app, with the recorded gateway responses.
+
+Record with TRAFFIC_LOG_PATH=traffic.jsonl on the server. The replay runs the
+app under uvicorn against a stand-in gateway that answers every call with its
+recorded response, and a fake Twilio. It re-sends the recorded webhooks at
+their original pace (--speed 1), faster or slower (--speed 4, --speed 0.5), or
+as fast as --concurrency allows (--speed 0). Two versions replayed from the
+same log see an identical workload as long as every gateway call matches a
+recorded one; a run with unmatched calls exits 1 unless --allow-unmatched.
+What the product catalog holds depends on timing, so the app answers each
+catalog lookup with the result recorded for it (CATALOG_REPLAY_PATH); a log
+recorded with the catalog off replays with every lookup missing, as it did.
+
+Usage: python benchmarks/replay.py traffic.jsonl [--speed 1] [--concurrency 50] [--no-upstream-latency]
+"""
+
+from collections import Counter, defaultdict, deque
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_webhook import APP_SECRET, free_port, serve, start_app, summary, wait_until_healthy
+from fakes import LatencyModel, is_reply, replay_gateway_app, twilio_app
+from traffic_log import read_traffic
+
+
+async def send_all(http, webhooks, replies, args):
+    """Sends every recorded webhook on schedule; returns reply latencies, outcomes and wall time."""
+    limit = asyncio.Semaphore(args.concurrency) if args.speed <= 0 else None
+    latencies = []
+    outcomes = Counter()
+    first = webhooks[0]["t"]
+    started = time.monotonic()
+
+    async def deliver(record):
+        if args.speed > 0:
+            await asyncio.sleep(max(0, started + (record["t"] - first) / args.speed - time.monotonic()))
+        form = record["form"]
+        if limit:
+            await limit.acquire()
+        try:
+            # registered before sending: the reply can beat the ack back
+            replied = asyncio.get_running_loop().create_future()
+            replies[form["From"]].append(replied)
+            sent = time.monotonic()
+            try:
+                response = await http.post("/webhook", data=form)
+            except httpx.HTTPError as e:
+                outcomes[f"ack_{type(e).__name__}"] += 1
+                replied.cancel()
+                return
+            if response.status_code != 200:
+                outcomes[f"ack_{response.status_code}"] += 1
+                replied.cancel()
+                return
+            if response.text != "OK":
+                # a redelivery the app answered from its dedup store, as it did live
+                outcomes["duplicate"] += 1
+                replied.cancel()
+                return
+            try:
+                latencies.append(await asyncio.wait_for(replied, args.reply_timeout) - sent)
+                outcomes["replied"] += 1
+            except asyncio.TimeoutError:
+                outcomes["reply_timeout"] += 1
+        finally:
+            if limit:
+                limit.release()
+
+    await asyncio.gather(*[deliver(record) for record in webhooks])
+    return latencies, outcomes, time.monotonic() - started
+
+
+async def run(args):
+    records = list(read_traffic(args.log))
+    webhooks = [r for r in records if r.get("type") == "webhook"]
+    calls = [r for r in records if r.get("type") == "iop"]
+    if not webhooks:
+        raise SystemExit(f"{args.log} has no recorded webhooks")
+
+    stats = Counter()
+    # a user's replies arrive in the order the messages were sent
+    replies = defaultdict(deque)
+
+    def on_message(form):
+        waiting = replies.get(form.get("To"))
+        while is_reply(form) and waiting:
+            replied = waiting.popleft()
+            if not replied.done():
+                replied.set_result(time.monotonic())
+                return
+
+    gateway_port, twilio_port, app_port = free_port(), free_port(), free_port()
+    servers = [
+        await serve(replay_gateway_app(APP_SECRET, calls, stats, args.upstream_latency), gateway_port),
+        await serve(twilio_app(LatencyModel(args.twilio_latency, args.twilio_latency), stats, on_message),
+                    twilio_port),
+    ]
+
+    env_overrides = dict({"CATALOG_REPLAY_PATH": os.path.abspath(args.log)},
+                         **dict(item.split("=", 1) for item in args.env))
+    with tempfile.TemporaryDirectory() as workdir, open(os.path.join(workdir, "app.log"), "w+") as log:
+        process = start_app(app_port, gateway_port, twilio_port, workdir, env_overrides, log)
+        try:
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", limits=limits,
+                                         timeout=args.reply_timeout) as http:
+                await wait_until_healthy(http, process)
+                latencies, outcomes, elapsed = await send_all(http, webhooks, replies, args)
+                catalog = (await http.get("/health")).json()["caches"].get("catalog")
+        except Exception:
+            log.seek(0)
+            sys.stderr.write(log.read()[-5000:])
+            raise
+        finally:
+            process.terminate()
+            try:
+                await asyncio.to_thread(process.wait, 10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            for server, task in servers:
+                server.should_exit = True
+                await task
+
+    return {
+        "benchmark": "replay",
+        # the app saw a different workload than the recording when any call went unmatched
+        "valid": not stats["gateway.unmatched"],
+        "log": args.log,
+        "speed": args.speed,
+        "webhooks": len(webhooks),
+        "recorded_seconds": round(webhooks[-1]["t"] - webhooks[0]["t"], 1),
+        "replay_seconds": round(elapsed, 1),
+        "throughput_per_second": round(outcomes["replied"] / elapsed, 1) if elapsed else 0,
+        "reply": summary(latencies),
+        "outcomes": dict(outcomes),
+        "gateway": {
+            "recorded_calls": len(calls),
+            "matched": stats["gateway.matched"],
+            # calls the recording has no answer for: the code under test calls the gateway differently
+            "unmatched": stats["gateway.unmatched"],
+            "cancelled": stats["gateway.cancelled"],
+            # cancelled when recorded, but waited for in the replay
+            "cancelled_awaited": stats["gateway.cancelled_awaited"],
+            "bad_signatures": stats["gateway.bad_signature"],
+        },
+        # lookups answered from the recording; unmatched ones weren't recorded
+        "catalog": catalog,
+        "twilio_messages": stats["twilio.messages"],
+        "env": env_overrides,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="traffic log written with TRAFFIC_LOG_PATH")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the recorded pace; 0 sends as fast as --concurrency allows")
+    parser.add_argument("--concurrency", type=int, default=50, help="webhooks in flight at --speed 0")
+    parser.add_argument("--no-upstream-latency", dest="upstream_latency", action="store_false",
+                        help="answer gateway calls at once instead of taking their recorded time")
+    parser.add_argument("--twilio-latency", type=float, default=0.05, help="Twilio latency, seconds")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="seconds to wait for a reply")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment override for the app, repeatable")
+    parser.add_argument("--allow-unmatched", action="store_true",
+                        help="exit 0 even when some gateway calls had no recorded response")
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result))
+    if not result["valid"] and not args.allow_unmatched:
+        sys.stderr.write(f"{result['gateway']['unmatched']} gateway calls had no recorded response; "
+                         f"this run isn't comparable to the recording\n")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded in-process cache with a per-entry TTL and LRU eviction."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600, clock: Callable[[], float] = time.monotonic):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight call.
+
+    The call runs as a task of its own that every caller, the first one
+    included, waits on through a shield, so a cancelled caller only stops
+    its own wait.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # mark retrieved so a failure nobody waited for doesn't warn on garbage collection
+        if not task.cancelled():
+            task.exception()
+
+
+class StaleWhileRevalidateCache:
+    """TTL cache that serves stale entries while refreshing them in the background.
+
+    Entries are fresh until soft_ttl, then served stale while one background
+    refresh runs, and dropped entirely after hard_ttl.
+    """
+
+    def __init__(self, maxsize: int = 512, soft_ttl: float = 300, hard_ttl: float = 3600,
+                 clock: Callable[[], float] = time.monotonic):
+        if hard_ttl < soft_ttl:
+            raise ValueError("hard_ttl must not be shorter than soft_ttl")
+        self.soft_ttl = soft_ttl
+        self._clock = clock
+        self._cache = TTLCache(maxsize=maxsize, ttl=hard_ttl, clock=clock)
+        self._flight = SingleFlight()
+        self._refreshing: Dict[Hashable, asyncio.Task] = {}
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.uncached = 0
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          refresher: Optional[Callable[[], Awaitable[Any]]] = None,
+                          cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """Returns the cached value, calling ``loader`` on a miss.
+
+        Stale entries are refreshed in the background with ``refresher``, or
+        ``loader`` when none is given. Loaded values ``cacheable`` rejects are
+        returned without being stored, and a stale entry stays in place.
+        """
+        entry = self._cache.get(key)
+        if entry is not None:
+            value, fresh_until = entry
+            if fresh_until <= self._clock():
+                self.stale_hits += 1
+                self._schedule_refresh(key, refresher or loader, cacheable)
+            return value
+        return await self._flight.do(key, lambda: self._load(key, loader, cacheable))
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                    cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        value = await loader()
+        if value is not None and (cacheable is None or cacheable(value)):
+            self._cache.set(key, (value, self._clock() + self.soft_ttl))
+        elif value is not None:
+            self.uncached += 1
+        return value
+
+    def _schedule_refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          cacheable: Optional[Callable[[Any], bool]] = None) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing[key] = asyncio.get_running_loop().create_task(self._refresh(key, loader, cacheable))
+
+    async def _refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                       cacheable: Optional[Callable[[Any], bool]] = None) -> None:
+        try:
+            self.refreshes += 1
+            await self._flight.do(key, lambda: self._load(key, loader, cacheable))
+        except Exception:
+            # the stale entry keeps being served until hard_ttl
+            self.refresh_failures += 1
+            logger.exception("Background refresh failed for %s", key)
+        finally:
+            del self._refreshing[key]
+
+    def stats(self) -> Dict[str, int]:
+        stats = self._cache.stats()
+        stats.update({
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "uncached": self.uncached,
+            "coalesced": self._flight.coalesced,
+        })
+        return stats
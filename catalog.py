@@ -0,0 +1,171 @@
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+import json
+import math
+import sqlite3
+import threading
+import time
+
+from keywords import canonical_tokens
+
+# seconds between deletions of products older than max_age
+PRUNE_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    product_id TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    title TEXT,
+    price REAL NOT NULL,
+    detail_url TEXT,
+    affiliate_url TEXT,
+    payload TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (product_id, currency)
+);
+CREATE INDEX IF NOT EXISTS products_price ON products (currency, price);
+CREATE INDEX IF NOT EXISTS products_detail_url ON products (detail_url);
+CREATE INDEX IF NOT EXISTS products_updated_at ON products (updated_at);
+CREATE TABLE IF NOT EXISTS product_tokens (
+    token TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    PRIMARY KEY (token, product_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS product_tokens_product_id ON product_tokens (product_id);
+"""
+
+
+def lookup_query(tokens: Sequence[str], max_price: float, currency: str, limit: int, min_overlap: float,
+                 exclude: Optional[str]) -> Dict:
+    """What identifies a cheaper_matching lookup across runs; max_age is left out, it follows the clock."""
+    return {"tokens": list(tokens), "max_price": max_price, "currency": currency, "limit": limit,
+            "min_overlap": min_overlap, "exclude": str(exclude or "")}
+
+
+class ProductCatalog:
+    """Persistent SQLite catalog of every product payload the gateway returned.
+
+    Products are indexed by id, by price and by their normalized title tokens,
+    so "cheaper products sharing most of these tokens" can be answered locally.
+    Prices are kept per target currency. Products not seen for ``max_age``
+    are never served, and writes delete them at most every PRUNE_INTERVAL.
+    ``recorder(query, results)``, when given, sees every cheaper_matching
+    lookup, so a traffic log can replay catalog answers that depend on timing.
+    """
+
+    def __init__(self, path: str = "catalog.db", max_age: float = 3600, recorder: Optional[Callable] = None):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.max_age = max_age
+        self._recorder = recorder
+        self._pruned_at = 0.0
+        self.upserted = 0
+        self.pruned = 0
+        self.hits = 0
+        self.misses = 0
+        # kept up to date by upsert and prune, so stats never has to scan the table
+        self._products, = self._conn.execute("SELECT COUNT(*) FROM products").fetchone()
+
+    def upsert(self, products: Iterable[Dict], currency: str) -> int:
+        now = time.time()
+        rows, tokens = [], []
+        for p in products:
+            product_id, price = p.get('product_id'), p.get('target_sale_price')
+            if not product_id or not price:
+                continue
+            product_id = str(product_id)
+            rows.append((product_id, currency, p.get('product_title'), float(price),
+                         p.get('product_detail_url'), json.dumps(p), now))
+            tokens.extend((token, product_id) for token in canonical_tokens(p.get('product_title', '')))
+        if not rows:
+            return 0
+
+        product_ids = list({row[0] for row in rows})
+        placeholders = ",".join("?" * len(product_ids))
+        with self._lock, self._conn:
+            known, = self._conn.execute(
+                f"SELECT COUNT(*) FROM products WHERE currency = ? AND product_id IN ({placeholders})",
+                [currency, *product_ids]).fetchone()
+            # the affiliate link of a known product survives a payload refresh
+            self._conn.executemany(
+                "INSERT INTO products (product_id, currency, title, price, detail_url, payload, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (product_id, currency) DO UPDATE SET "
+                "title = excluded.title, price = excluded.price, detail_url = excluded.detail_url, "
+                "payload = excluded.payload, updated_at = excluded.updated_at",
+                rows)
+            # titles can change, so the token rows are rebuilt
+            self._conn.executemany("DELETE FROM product_tokens WHERE product_id = ?", [(row[0],) for row in rows])
+            self._conn.executemany("INSERT OR IGNORE INTO product_tokens (token, product_id) VALUES (?, ?)", tokens)
+            self._products += len(product_ids) - known
+        self.upserted += len(rows)
+        if now - self._pruned_at >= PRUNE_INTERVAL:
+            self.prune()
+        return len(rows)
+
+    def prune(self) -> int:
+        """Deletes products older than max_age, and the tokens of ids no currency still has."""
+        self._pruned_at = now = time.time()
+        cutoff = now - self.max_age
+        with self._lock, self._conn:
+            stale = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT product_id FROM products WHERE updated_at < ?", (cutoff,))]
+            if not stale:
+                return 0
+            deleted = self._conn.execute("DELETE FROM products WHERE updated_at < ?", (cutoff,)).rowcount
+            self._conn.executemany(
+                "DELETE FROM product_tokens WHERE product_id = ? "
+                "AND NOT EXISTS (SELECT 1 FROM products WHERE product_id = ?)",
+                [(product_id, product_id) for product_id in stale])
+            self._products -= deleted
+        self.pruned += deleted
+        return deleted
+
+    def set_affiliate_links(self, links: Dict[str, str]) -> None:
+        """Stores affiliate links keyed by product detail url."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE products SET affiliate_url = ? WHERE detail_url = ?",
+                [(link, url) for url, link in links.items() if link])
+
+    def cheaper_matching(self, tokens: Sequence[str], max_price: float, currency: str, max_age: float,
+                         limit: int, min_overlap: float = 0.6, exclude: Optional[str] = None) -> List[Dict]:
+        """Fresh products under ``max_price`` sharing at least ``min_overlap`` of ``tokens``, cheapest first.
+
+        Each result is the stored payload plus its ``affiliate_url`` when one is known.
+        """
+        if not tokens:
+            return []
+        placeholders = ",".join("?" * len(tokens))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT p.payload, p.affiliate_url FROM product_tokens t "
+                f"JOIN products p ON p.product_id = t.product_id AND p.currency = ? "
+                f"WHERE t.token IN ({placeholders}) AND p.price < ? AND p.updated_at >= ? AND p.product_id != ? "
+                f"GROUP BY p.product_id HAVING COUNT(*) >= ? ORDER BY p.price LIMIT ?",
+                [currency, *tokens, max_price, time.time() - max_age, str(exclude or ""),
+                 math.ceil(len(tokens) * min_overlap), limit]).fetchall()
+
+        results = [dict(json.loads(payload), affiliate_url=affiliate_url) for payload, affiliate_url in rows]
+        if self._recorder is not None:
+            self._recorder(lookup_query(tokens, max_price, currency, limit, min_overlap, exclude), results)
+        return results
+
+    def record_lookup(self, hit: bool) -> None:
+        """Counts a lookup as answered from the catalog or not.
+
+        Only the caller knows how many matches survive its own filtering, so
+        cheaper_matching leaves the accounting to it.
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"products": self._products, "upserted": self.upserted, "pruned": self.pruned,
+                "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self._conn.close()
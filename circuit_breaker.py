@@ -0,0 +1,224 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Optional
+import asyncio
+import logging
+import time
+
+from deadline import Deadline, DeadlineExceeded
+from job_queue import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Trips on a high error rate or p99 latency over the most recent calls.
+
+    An open breaker rejects calls for ``open_seconds``, then lets a single probe
+    through; the probe's outcome closes it or opens it again.
+    """
+
+    def __init__(self, name: str, window: int = 100, min_calls: int = 20,
+                 error_rate: float = 0.5, p99_latency: float = 10.0, open_seconds: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate
+        self.p99_latency_threshold = p99_latency
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self.latency = LatencyWindow(window)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self) -> None:
+        if self.state == OPEN:
+            if self._clock() - self._opened_at < self.open_seconds:
+                self.rejected += 1
+                raise CircuitOpenError(f"circuit for {self.name} is open")
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError(f"circuit for {self.name} is half open")
+            self._probing = True
+
+    def abandon(self) -> None:
+        """Call that passed allow() but never finished, e.g. because it was cancelled."""
+        if self.state == HALF_OPEN:
+            self._probing = False
+
+    def record(self, ok: bool, latency: float) -> None:
+        self.latency.observe(latency)
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if ok:
+                self._close()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(ok)
+        if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+            if self.error_rate() >= self.error_rate_threshold or \
+                    self.latency.percentile(0.99) >= self.p99_latency_threshold:
+                self._open()
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def _open(self) -> None:
+        logger.warning(f"Opening circuit for {self.name} (error rate {self.error_rate():.2f}, "
+                       f"p99 {self.latency.percentile(0.99):.2f}s)")
+        self.state = OPEN
+        self._opened_at = self._clock()
+        self.trips += 1
+
+    def _close(self) -> None:
+        logger.info(f"Closing circuit for {self.name}")
+        self.state = CLOSED
+        self._outcomes.clear()
+        self.latency = LatencyWindow(self.window)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "p95": round(self.latency.percentile(0.95), 3),
+            "p99": round(self.latency.percentile(0.99), 3),
+            "calls": len(self._outcomes),
+            "rejected": self.rejected,
+            "trips": self.trips,
+        }
+
+
+class UpstreamGuard:
+    """Per-method circuit breakers, latency-adaptive timeouts and optional hedging.
+
+    Timeouts follow the observed p99 of each method (times ``timeout_multiplier``,
+    clamped to [min_timeout, max_timeout]). For methods in ``hedge_methods`` a
+    duplicate request is started once the first has been running longer than the
+    method's p95, and whichever answers first wins. The duplicate comes from
+    ``hedge(timeout)`` when given, which may return None to skip it.
+    """
+
+    def __init__(self, max_timeout: float = 30, min_timeout: float = 1.0, timeout_multiplier: float = 3.0,
+                 min_samples: int = 20, hedge_methods: Iterable[str] = (), **breaker_options):
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.min_samples = min_samples
+        self.hedge_methods = set(hedge_methods)
+        self._breaker_options = breaker_options
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+
+    def breaker(self, method: str) -> CircuitBreaker:
+        breaker = self.breakers.get(method)
+        if breaker is None:
+            breaker = self.breakers[method] = CircuitBreaker(method, **self._breaker_options)
+        return breaker
+
+    def timeout_for(self, method: str) -> float:
+        latency = self.breaker(method).latency
+        if latency.count < self.min_samples:
+            return self.max_timeout
+        adaptive = latency.percentile(0.99) * self.timeout_multiplier
+        return min(self.max_timeout, max(self.min_timeout, adaptive))
+
+    async def call(self, method: str, fn: Callable[[float], Awaitable[Any]],
+                   deadline: Optional[Deadline] = None,
+                   is_failure: Callable[[Any], bool] = lambda result: False,
+                   hedge: Optional[Callable[[float], Optional[Awaitable[Any]]]] = None) -> Any:
+        """Runs ``fn(timeout)`` under the method's breaker and timeout."""
+        breaker = self.breaker(method)
+        timeout = self.timeout_for(method)
+        # a timeout cut short by the request's own deadline says nothing about the gateway
+        capped = False
+        if deadline is not None:
+            capped = deadline.remaining() < timeout
+            timeout = deadline.timeout(timeout)
+        breaker.allow()
+
+        started = time.monotonic()
+        try:
+            if method in self.hedge_methods and breaker.latency.count >= self.min_samples:
+                hedge_after = breaker.latency.percentile(0.95)
+                coro = self._hedged(fn, hedge or fn, timeout, hedge_after)
+            else:
+                coro = fn(timeout)
+            # httpx timeouts apply per phase, so the total is enforced with wait_for
+            result = await asyncio.wait_for(coro, timeout)
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as e:
+            if capped and deadline.expired:
+                breaker.abandon()
+                raise DeadlineExceeded(f"deadline exceeded calling {method}") from e
+            breaker.record(False, time.monotonic() - started)
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"deadline exceeded calling {method}") from e
+            raise
+        breaker.record(not is_failure(result), time.monotonic() - started)
+        return result
+
+    async def _hedged(self, fn: Callable[[float], Awaitable[Any]], hedge: Callable[[float], Optional[Awaitable[Any]]],
+                      timeout: float, hedge_after: float) -> Any:
+        first = asyncio.ensure_future(fn(timeout))
+        second = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=hedge_after)
+            if done:
+                return first.result()
+
+            duplicate = hedge(max(timeout - hedge_after, 0.001))
+            if duplicate is None:
+                self.hedges_skipped += 1
+                return await first
+            self.hedges += 1
+            second = asyncio.ensure_future(duplicate)
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # both attempts failed; surface the original one's error
+            return first.result()
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    @property
+    def healthy(self) -> bool:
+        return all(b.state == CLOSED for b in self.breakers.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breakers": {method: b.stats() for method, b in self.breakers.items()},
+            "timeouts": {method: round(self.timeout_for(method), 3) for method in self.breakers},
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+        }
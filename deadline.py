@@ -0,0 +1,38 @@
+from typing import Callable, Optional
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """Absolute point in time by which a piece of work has to finish.
+
+    Every upstream call takes its timeout from the budget that is left, so one
+    slow call can't push the whole request past its deadline.
+    """
+
+    def __init__(self, budget: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.expires_at = clock() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self._clock())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """Timeout for the next call: the remaining budget, at most ``cap``."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        return remaining if cap is None else min(cap, remaining)
+
+    def shrink(self, reserve: float) -> "Deadline":
+        """A deadline ``reserve`` seconds earlier, leaving that time for a fallback."""
+        child = Deadline(0, self._clock)
+        child.expires_at = self.expires_at - reserve
+        return child
@@ -0,0 +1,55 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+import threading
+import time
+
+from cache import TTLCache
+
+PROCESSING = "processing"
+DONE = "done"
+
+
+class DedupStore:
+    """Bounded, time-windowed record of webhook deliveries already accepted.
+
+    Deliveries are keyed on Twilio's MessageSid. Payloads without one fall back
+    to From+Body, remembered for a shorter window so a user deliberately
+    resending the same link later is still served.
+    """
+
+    def __init__(self, maxsize: int = 10000, window: float = 600, fallback_window: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.fallback_window = fallback_window
+        self._entries = TTLCache(maxsize=maxsize, ttl=window, clock=clock)
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    @staticmethod
+    def key_for(message_sid: Optional[str], from_number: str, body: str) -> Hashable:
+        if message_sid:
+            return ("sid", message_sid)
+        return ("from_body", from_number, body.strip())
+
+    def claim(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Records the delivery as processing, or returns the existing entry if it is a duplicate."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.duplicates += 1
+                return entry
+            self._entries.set(key, {"state": PROCESSING, "result": None}, ttl=self._ttl_for(key))
+            return None
+
+    def complete(self, key: Hashable, result: Any) -> None:
+        self._entries.set(key, {"state": DONE, "result": result}, ttl=self._ttl_for(key))
+
+    def release(self, key: Hashable) -> None:
+        self._entries.pop(key)
+
+    def _ttl_for(self, key: Hashable) -> float:
+        return self.window if key[0] == "sid" else self.fallback_window
+
+    def stats(self) -> Dict[str, int]:
+        stats = self._entries.stats()
+        stats["duplicates"] = self.duplicates
+        return stats
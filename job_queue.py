@@ -0,0 +1,127 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class LatencyWindow:
+    """Running count/sum/max plus percentiles over the most recent samples."""
+
+    def __init__(self, window: int = 1024):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class JobQueue:
+    """Bounded asyncio queue drained by a fixed pool of worker tasks."""
+
+    def __init__(self, concurrency: int = 8, max_depth: int = 1000):
+        if concurrency <= 0:
+            raise ValueError("concurrency must be positive")
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self.wait_time = LatencyWindow()
+        self.processing_time = LatencyWindow()
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_depth)
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+
+    async def stop(self, timeout: float = 10) -> None:
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping job queue with {self._queue.qsize()} jobs still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> None:
+        if self._queue is None:
+            raise RuntimeError("JobQueue.start() must be awaited before submitting jobs")
+        try:
+            self._queue.put_nowait((time.monotonic(), fn, args, kwargs))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(f"job queue is full ({self.max_depth} jobs)")
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            enqueued_at, fn, args, kwargs = await self._queue.get()
+            started = time.monotonic()
+            self.wait_time.observe(started - enqueued_at)
+            self.in_progress += 1
+            try:
+                await fn(*args, **kwargs)
+                self.completed += 1
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # cancellation that leaked out of the job; the worker keeps going
+                self.failed += 1
+                logger.error(f"Job {getattr(fn, '__name__', fn)} failed: cancelled")
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Job {getattr(fn, '__name__', fn)} failed: {e}")
+            finally:
+                self.in_progress -= 1
+                self.processing_time.observe(time.monotonic() - started)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "max_depth": self.max_depth,
+            "concurrency": self.concurrency,
+            "in_progress": self.in_progress,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_time.stats(),
+            "processing_seconds": self.processing_time.stats(),
+        }
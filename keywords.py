@@ -0,0 +1,80 @@
+from typing import List, Tuple
+import re
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+    a an and are as at be by for from in into is it of on or the to with without your
+    women men womens mens kids girls boys adult unisex
+""".split())
+
+# marketing terms AliExpress sellers pad titles with for search ranking
+FILLER = frozenset("""
+    new newest latest hot sale sales selling best bestseller top quality high premium original genuine
+    official authentic brand free shipping fast delivery dropshipping wholesale cheap discount promotion
+    gift gifts luxury fashion fashionable style stylish trendy popular classic arrival arrivals upgraded
+    upgrade version edition pcs pc piece pieces set lot pack size sizes
+""".split())
+
+COLORS = frozenset("""
+    black white red green blue yellow orange purple pink brown grey gray silver gold golden beige navy
+    khaki rose transparent clear multicolor colorful colour color colors colours
+""".split())
+
+# clothing sizes, measurements and bare years; model numbers such as "15" or
+# "128gb" stay because they tell products apart, and so do network generations:
+# grams need two digits, so "5g" is kept and "500g" is dropped
+_SIZE_RE = re.compile(
+    r"^(?:x{0,3}[sl]|x{1,4}l|\d*xl|m|"
+    r"\d+(?:cm|mm|m|inch|in|ft|ml|l|kg)|\d{2,}g|"
+    r"(?:19|20)\d\d)$"
+)
+
+# single letters are noise, except right after these: "usb c", "type c"
+LETTER_PREFIXES = frozenset(("usb", "type"))
+
+QUERY_MAX_TERMS = 6
+QUERY_MIN_TERMS = 2
+
+
+def title_tokens(title: str) -> List[str]:
+    """Lower-cased alphanumeric tokens of a title, in order, without duplicates."""
+    if not title:
+        return []
+    return list(dict.fromkeys(_TOKEN_RE.findall(title.lower())))
+
+
+def canonical_tokens(title: str) -> Tuple[str, ...]:
+    """Order-insensitive token set of a title, usable as a cache key."""
+    return tuple(sorted(title_tokens(title)))
+
+
+def keyword_terms(title: str, max_terms: int = QUERY_MAX_TERMS) -> List[str]:
+    """The leading product terms of a title, without stopwords, filler, colors and sizes."""
+    tokens = title_tokens(title)
+    terms = [
+        t for previous, t in zip([None] + tokens, tokens)
+        if (len(t) > 1 and t not in STOPWORDS and t not in FILLER and t not in COLORS and not _SIZE_RE.match(t))
+        or (len(t) == 1 and t.isalpha() and previous in LETTER_PREFIXES)
+    ]
+    # a title made only of filler still needs some query
+    return (terms or tokens)[:max_terms]
+
+
+def keyword_queries(title: str, max_terms: int = QUERY_MAX_TERMS, min_terms: int = QUERY_MIN_TERMS) -> List[str]:
+    """Search queries for a title, most specific first, each broader than the one before.
+
+    Terms are sorted within a query, so titles that differ only in word order,
+    filler, colors or sizes produce the same query strings.
+    """
+    terms = keyword_terms(title, max_terms)
+    queries = []
+    count = len(terms)
+    while count >= 1:
+        query = " ".join(sorted(terms[:count]))
+        if query not in queries:
+            queries.append(query)
+        if count <= min_terms:
+            break
+        count = max(min_terms, count // 2)
+    return queries
@@ -0,0 +1,202 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+import atexit
+import json
+import logging
+import queue
+import random
+import reprlib
+
+# extra= for records that carry a whole upstream payload; they are sampled per logger
+PAYLOAD = {"payload": True}
+
+# attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 6
+_repr.maxdict = _repr.maxlist = _repr.maxtuple = _repr.maxset = 8
+_repr.maxstring = _repr.maxother = 200
+
+
+def _bounded(value: Any) -> Any:
+    # payload dicts and lists are rendered a bounded amount deep and wide instead of in full
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return _repr.repr(value)
+
+
+def parse_settings(spec: str) -> Dict[str, str]:
+    """'name=value,other=value' as a dict; a bare value is stored under ''."""
+    settings = {}
+    for item in spec.split(","):
+        if item.strip():
+            name, _, value = item.rpartition("=")
+            settings[name.strip()] = value.strip()
+    return settings
+
+
+class PayloadSampler(logging.Filter):
+    """Keeps a fraction of the PAYLOAD records of each logger.
+
+    Rates apply to a logger and its children; the longest matching name wins
+    and '' is the default. Runs before the record is queued, so a dropped
+    payload is never formatted.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._by_logger: Dict[str, float] = {}
+        self.dropped = 0
+
+    def rate(self, name: str) -> float:
+        rate = self._by_logger.get(name)
+        if rate is None:
+            matches = [n for n in self.rates if not n or name == n or name.startswith(n + ".")]
+            rate = self._by_logger[name] = self.rates[max(matches, key=len)] if matches else 1.0
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "payload", False):
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class BoundedFormatter(logging.Formatter):
+    """Formats records with the message capped at ``max_length`` characters.
+
+    Arguments that aren't plain strings or numbers are rendered with reprlib,
+    so logging a large response costs a bounded amount of work. With
+    ``structured`` every record is one JSON object, including the fields
+    passed in through extra=.
+    """
+
+    def __init__(self, structured: bool = True, max_length: int = 2000,
+                 fmt: str = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"):
+        super().__init__(fmt)
+        self.structured = structured
+        self.max_length = max_length
+
+    def bounded_message(self, record: logging.LogRecord) -> str:
+        message = str(record.msg)
+        if record.args:
+            if isinstance(record.args, dict):
+                # logging unpacks a lone dict argument, which may be a value for %s or a mapping for %(key)s
+                args = {k: _bounded(v) for k, v in record.args.items()} if "%(" in message \
+                    else _bounded(record.args)
+            else:
+                args = tuple(_bounded(arg) for arg in record.args)
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = record.getMessage()
+        if len(message) > self.max_length:
+            message = f"{message[:self.max_length]}... [{len(message) - self.max_length} more chars]"
+        return message
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = self.bounded_message(record)
+        record.asctime = self.formatTime(record, self.datefmt)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if not self.structured:
+            text = self.formatMessage(record)
+            return f"{text}\n{record.exc_text}" if record.exc_text else text
+
+        entry = {"ts": record.asctime, "level": record.levelname, "logger": record.name, "msg": record.message}
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS and k != "payload")
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queues records for a listener thread, unformatted, and drops them when the queue is full.
+
+    The stock QueueHandler formats the message in the calling thread; here
+    only a traceback is rendered up front, while its frames still exist.
+    Arguments are formatted later, so they should not be mutated after logging.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    def __init__(self, handlers: List[NonBlockingQueueHandler], listeners: List[QueueListener],
+                 sampler: PayloadSampler):
+        self.handlers = handlers
+        self.listeners = listeners
+        self.sampler = sampler
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": sum(h.queue.qsize() for h in self.handlers),
+            "dropped": sum(h.dropped for h in self.handlers),
+            "payloads_sampled_out": self.sampler.dropped,
+        }
+
+    def stop(self) -> None:
+        # drains what's queued
+        for listener in self.listeners:
+            if listener._thread is not None:
+                listener.stop()
+
+
+def setup_logging(level: str = "INFO", structured: bool = True, max_length: int = 2000,
+                  payload_rates: Optional[Dict[str, float]] = None,
+                  logger_levels: Optional[Dict[str, str]] = None, queue_size: int = 10000) -> LogPipeline:
+    """Routes all logging through queues drained by background threads.
+
+    The root logger's handlers are replaced by one that queues records and a
+    listener thread that formats and writes them to stderr. Loggers with
+    handlers of their own, like the iop SDK's log file, get a queue and
+    listener of their own, so no handler does I/O on the calling thread.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in (logger_levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    sampler = PayloadSampler(payload_rates or {})
+    stream = logging.StreamHandler()
+    stream.setFormatter(BoundedFormatter(structured, max_length))
+    root_queue = NonBlockingQueueHandler(queue.Queue(queue_size))
+    root_queue.addFilter(sampler)
+    root.addHandler(root_queue)
+    handlers, listeners = [root_queue], [QueueListener(root_queue.queue, stream)]
+
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if not isinstance(logger, logging.Logger) or not logger.handlers:
+            continue
+        own = NonBlockingQueueHandler(queue.Queue(queue_size))
+        listeners.append(QueueListener(own.queue, *logger.handlers, respect_handler_level=True))
+        logger.handlers = [own]
+        handlers.append(own)
+
+    for listener in listeners:
+        listener.start()
+    pipeline = LogPipeline(handlers, listeners, sampler)
+    atexit.register(pipeline.stop)
+    return pipeline
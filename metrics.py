@@ -0,0 +1,192 @@
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import bisect
+import math
+import threading
+
+# seconds; covers a cache hit through a gateway call at the timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# (name, type, help, [(labels, value)]) as produced by a collector callback
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues: Sequence[str]) -> Tuple[str, ...]:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(v) for v in labelvalues)
+
+    def _label_dict(self, key: Tuple[str, ...], **extra: str) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key), **extra)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self._label_dict(key))} {_number(v)}" for key, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: a count for each bucket plus +Inf, then the sum
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        lines = []
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self._label_dict(key, le=_number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self._label_dict(key))} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self._label_dict(key))} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text format.
+
+    Recording is a dict update under a per-metric lock. Values that components
+    already track, such as cache hit counts, are read through collector
+    callbacks only when /metrics is scraped, so they cost nothing per request.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], Iterable[Family]]) -> Callable[[], Iterable[Family]]:
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, documentation, samples in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{_labels(labels)} {_number(value)}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+IOP_REQUEST_SECONDS = REGISTRY.histogram(
+    "iop_request_duration_seconds", "AliExpress gateway calls by API method and result code", ("method", "code"))
+TWILIO_SEND_SECONDS = REGISTRY.histogram(
+    "twilio_send_duration_seconds", "Twilio messages.create calls by outcome", ("outcome",))
+REDIRECT_SECONDS = REGISTRY.histogram(
+    "redirect_expansion_duration_seconds", "Short link expansions by outcome", ("outcome",))
+STAGE_SECONDS = REGISTRY.histogram(
+    "pipeline_stage_duration_seconds", "Pipeline stages by pipeline and stage", ("pipeline", "stage"))
+WEBHOOK_SECONDS = REGISTRY.histogram(
+    "webhook_duration_seconds", "Processing of one incoming message, failed ones included", ("outcome",))
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("path",))
+
+
+def observe_iop_request(method: str, code: str, seconds: float) -> None:
+    IOP_REQUEST_SECONDS.observe(seconds, method, code)
+
+
+class InFlightMiddleware:
+    """ASGI middleware tracking requests in flight per route path.
+
+    Unlike an @app.middleware("http") function it sees streamed responses to
+    the end. Paths that match no route share the "other" label, so scanners
+    can't blow up the label set.
+    """
+
+    def __init__(self, app, gauge: Gauge = HTTP_IN_FLIGHT):
+        self.app = app
+        self.gauge = gauge
+        self._routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self._routes is None:
+            self._routes = {route.path for route in scope["app"].routes}
+        path = scope["path"] if scope["path"] in self._routes else "other"
+        self.gauge.inc(path)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.gauge.dec(path)
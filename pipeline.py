@@ -0,0 +1,116 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+import asyncio
+import logging
+import time
+
+from job_queue import LatencyWindow
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+StageFn = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def fire_and_forget(coro: Awaitable[Any], name: Optional[str] = None) -> asyncio.Task:
+    """Runs a coroutine off the critical path, keeping a reference and logging its failure."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+
+    def done(t: asyncio.Task) -> None:
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"Background task {name or t.get_name()} failed", exc_info=t.exception())
+
+    task.add_done_callback(done)
+    return task
+
+
+class Stage:
+    def __init__(self, name: str, fn: StageFn, after: Iterable[str] = (), background: bool = False):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.background = background
+
+
+class PipelineRun:
+    def __init__(self, context: Dict[str, Any]):
+        self.context = context
+        self.timings: Dict[str, float] = {}
+        self.total = 0.0
+
+
+class Pipeline:
+    """Small dependency graph of async stages.
+
+    Every stage starts as soon as the stages listed in its ``after`` finish, so
+    independent stages run concurrently. Each stage reads its inputs from, and
+    stores its return value under its name in, a shared context dict. Background
+    stages are started with the others but the run doesn't wait for them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: Dict[str, Stage] = {}
+        self.stage_times: Dict[str, LatencyWindow] = {}
+        self.total_time = LatencyWindow()
+
+    def stage(self, name: str, after: Iterable[str] = (), background: bool = False) -> Callable[[StageFn], StageFn]:
+        def register(fn: StageFn) -> StageFn:
+            self.add(Stage(name, fn, after, background))
+            return fn
+        return register
+
+    def add(self, stage: Stage) -> None:
+        if stage.name in self.stages:
+            raise ValueError(f"Stage {stage.name} is already registered")
+        for dep in stage.after:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+            if self.stages[dep].background:
+                raise ValueError(f"Stage {stage.name} can't depend on background stage {dep}")
+        self.stages[stage.name] = stage
+        self.stage_times[stage.name] = LatencyWindow()
+
+    async def run(self, context: Dict[str, Any]) -> PipelineRun:
+        run = PipelineRun(context)
+        started = time.monotonic()
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_stage(stage: Stage) -> Any:
+            if stage.after:
+                await asyncio.gather(*[tasks[dep] for dep in stage.after])
+            stage_started = time.monotonic()
+            try:
+                result = await stage.fn(context)
+                context[stage.name] = result
+                return result
+            finally:
+                elapsed = time.monotonic() - stage_started
+                run.timings[stage.name] = elapsed
+                self.stage_times[stage.name].observe(elapsed)
+                STAGE_SECONDS.observe(elapsed, self.name, stage.name)
+
+        critical: List[asyncio.Task] = []
+        for stage in self.stages.values():
+            if stage.background:
+                fire_and_forget(run_stage(stage), name=f"{self.name}.{stage.name}")
+            else:
+                tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+                critical.append(tasks[stage.name])
+
+        try:
+            await asyncio.gather(*critical)
+        finally:
+            for task in critical:
+                task.cancel()
+            run.total = time.monotonic() - started
+            self.total_time.observe(run.total)
+        return run
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {name: window.stats() for name, window in self.stage_times.items()}
+        stats["total"] = self.total_time.stats()
+        return stats
@@ -0,0 +1,164 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from types import CodeType, FrameType
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+import weakref
+
+Stack = Tuple[str, ...]
+
+_labels: Dict[CodeType, str] = {}
+_short_paths: Dict[str, str] = {}
+
+
+def _short_path(filename: str) -> str:
+    # relative to the sys.path entry it was imported from, e.g. twilio/http/http_client.py
+    short = _short_paths.get(filename)
+    if short is None:
+        roots = [p for p in sys.path if p and filename.startswith(os.path.join(p, ""))]
+        short = os.path.relpath(filename, max(roots, key=len)) if roots else os.path.basename(filename)
+        _short_paths[filename] = short
+    return short
+
+
+def _label(code: CodeType) -> str:
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def stack_of(frame: Optional[FrameType]) -> Stack:
+    """Function labels from the outermost frame to ``frame``."""
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return tuple(reversed(labels))
+
+
+def collapsed(samples: Counter) -> str:
+    """Brendan Gregg's collapsed stack format, as read by flamegraph.pl and speedscope."""
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in samples.most_common())
+
+
+def sample_process(seconds: float, interval: float = 0.01) -> Counter:
+    """Samples the stack of every other thread every ``interval`` for ``seconds``.
+
+    Blocking; run it in a worker thread. Each stack is rooted at its thread's
+    name, so the event loop and the worker pools show up separately.
+    """
+    me = threading.get_ident()
+    samples: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                samples[(names.get(ident, str(ident)),) + stack_of(frame)] += 1
+        time.sleep(interval)
+    return samples
+
+
+class RequestProfile:
+    def __init__(self, profile_id: str):
+        self.id = profile_id
+        self.started = time.time()
+        self.seconds = 0.0
+        self.samples: Counter = Counter()
+
+    def summary(self) -> Dict[str, Any]:
+        return {"id": self.id, "started": self.started, "seconds": round(self.seconds, 3),
+                "samples": sum(self.samples.values())}
+
+
+class RequestProfiler:
+    """Samples the event loop on behalf of individual requests.
+
+    Inside ``profile()`` the current task, and every task it or its children
+    create, belongs to the profile. The tasks are tracked by a task factory,
+    which has to be installed on the loop. A sampler thread runs while any
+    profile is open. Each sample records the loop thread's stack, and it is
+    kept only when the task on the CPU belongs to a profile, so concurrent
+    requests don't pollute each other. Work sent to threads isn't attributed;
+    sample_process covers it.
+    """
+
+    def __init__(self, interval: float = 0.001, keep: int = 20):
+        self.interval = interval
+        self.keep = keep
+        self._current: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar(
+            "request_profile", default=None)
+        self._tasks: "weakref.WeakKeyDictionary[asyncio.Task, RequestProfile]" = weakref.WeakKeyDictionary()
+        self._open = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self._finished: "OrderedDict[str, RequestProfile]" = OrderedDict()
+
+    def install(self, loop: asyncio.AbstractEventLoop) -> None:
+        loop.set_task_factory(self._task_factory)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        # runs in the creating task's context, so children inherit the profile
+        profile = self._current.get()
+        if profile is not None:
+            self._tasks[task] = profile
+        return task
+
+    @contextmanager
+    def profile(self, profile_id: str) -> Iterator[RequestProfile]:
+        profile = RequestProfile(profile_id)
+        task = asyncio.current_task()
+        token = self._current.set(profile)
+        self._tasks[task] = profile
+        started = time.monotonic()
+        with self._lock:
+            self._open += 1
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._sampler.start()
+        try:
+            yield profile
+        finally:
+            self._current.reset(token)
+            self._tasks.pop(task, None)
+            profile.seconds = time.monotonic() - started
+            with self._lock:
+                self._open -= 1
+                self._finished[profile.id] = profile
+                while len(self._finished) > self.keep:
+                    self._finished.popitem(last=False)
+
+    def _sample(self) -> None:
+        # asyncio keeps the task each loop is running in a module level dict
+        current_tasks = getattr(asyncio.tasks, "_current_tasks", {})
+        while True:
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+            task = current_tasks.get(self._loop)
+            profile = self._tasks.get(task) if task is not None else None
+            if profile is not None:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    profile.samples[stack_of(frame)] += 1
+            time.sleep(self.interval)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        with self._lock:
+            return self._finished.get(profile_id)
+
+    def finished(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._finished.values())]
@@ -6,6 +6,9 @@ Created on 2018-03-21
 '''
 
 import requests
+import requests.adapters
+import httpx
+import asyncio
 import time
 import hmac
 import hashlib
@@ -32,6 +35,12 @@ handler.setLevel(logging.ERROR)
 formatter = logging.Formatter('%(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
+# the logger above only writes API errors to the SDK's log file; non-fatal
+# client events go to the package logger and the application's handlers
+client_logger = logging.getLogger("iop")
+
+# seconds a warm-up connection may take; an unreachable gateway must not hold up startup
+WARM_UP_TIMEOUT = 3
 
 P_SDK_VERSION = "iop-sdk-python-20220609"
 
@@ -81,13 +90,28 @@ def mixStr(pstr):
     else:
         return str(pstr)
 
+_hostInfo = None
+
+def localHostInfo():
+    # resolving the host name can block on DNS; neither value changes while we run
+    global _hostInfo
+    if _hostInfo is None:
+        try:
+            localIp = socket.gethostbyname(socket.gethostname())
+        except socket.error:
+            localIp = "unknown"
+        _hostInfo = (localIp, platform.platform())
+    return _hostInfo
+
 def logApiError(appkey, sdkVersion, requestUrl, code, message):
-    localIp = socket.gethostbyname(socket.gethostname())
-    platformType = platform.platform()
-    logger.error("%s^_^%s^_^%s^_^%s^_^%s^_^%s^_^%s^_^%s" % (
+    if not logger.isEnabledFor(logging.ERROR):
+        return
+    localIp, platformType = localHostInfo()
+    # formatted by the handler, off the calling thread when app.py's log pipeline is set up
+    logger.error("%s^_^%s^_^%s^_^%s^_^%s^_^%s^_^%s^_^%s",
         appkey, sdkVersion,
         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
-        localIp, platformType, requestUrl, code, message))
+        localIp, platformType, requestUrl, code, message)
 
 class IopRequest(object):
     def __init__(self,api_pame,http_method = 'POST'):
@@ -125,57 +149,66 @@ class IopResponse(object):
 class IopClient(object):
     
     log_level = P_LOG_LEVEL_ERROR
-    def __init__(self, server_url,app_key,app_secret,timeout=30):
+    def __init__(self, server_url,app_key,app_secret,timeout=30,
+                 max_connections=100,max_keepalive_connections=20,keepalive_expiry=30,observer=None,recorder=None):
         self._server_url = server_url
         self._app_key = app_key
         self._app_secret = app_secret
         self._timeout = timeout
-    
-    def execute(self, request,access_token = None):
-
-        sys_parameters = {
-            P_APPKEY: self._app_key,
+        self._max_connections = max_connections
+        self._max_keepalive_connections = max_keepalive_connections
+        self._keepalive_expiry = keepalive_expiry
+        # per-client signing state, computed once instead of on every execute()
+        self._hmac = hmac.new(app_secret.encode(encoding="utf-8"), digestmod=hashlib.sha256)
+        self._sys_parameters = {
+            P_APPKEY: app_key,
             P_SIGN_METHOD: "sha256",
-            P_TIMESTAMP: str(int(round(time.time()))) + '000',
             P_PARTNER_ID: P_SDK_VERSION,
-            P_METHOD: request._api_pame,
-            P_SIMPLIFY: request._simplify,
-            P_FORMAT:request._format
         }
+        self._session = None
+        self._async_client = None
+        # optional observer(api_name, code, seconds), called after every call
+        self._observer = observer
+        # optional recorder(api_name, api_params, body, error, seconds), called
+        # after every call with the response json or the transport error
+        self._recorder = recorder
+    
+    def _sign(self, api, parameters):
+        # same digest as sign(), reusing the keyed HMAC state instead of rebuilding it
+        parameters_str = "".join("%s%s" % item for item in sorted(parameters.items()))
+        if("/" in api):
+            parameters_str = api + parameters_str
+        h = self._hmac.copy()
+        h.update(parameters_str.encode(encoding="utf-8"))
+        return h.hexdigest().upper()
+
+    def _sign_request(self, request, access_token = None):
+
+        sign_parameter = self._sys_parameters.copy()
+        sign_parameter[P_TIMESTAMP] = "%d000" % round(time.time())
+        sign_parameter[P_METHOD] = request._api_pame
+        sign_parameter[P_SIMPLIFY] = request._simplify
+        sign_parameter[P_FORMAT] = request._format
 
         if(self.log_level == P_LOG_LEVEL_DEBUG):
-            sys_parameters[P_DEBUG] = 'true'
+            sign_parameter[P_DEBUG] = 'true'
 
         if(access_token):
-            sys_parameters[P_ACCESS_TOKEN] = access_token
-
-        application_parameter = request._api_params;
+            sign_parameter[P_ACCESS_TOKEN] = access_token
 
-        sign_parameter = sys_parameters.copy()
-        sign_parameter.update(application_parameter)
+        sign_parameter.update(request._api_params)
 
-        sign_parameter[P_SIGN] = sign(self._app_secret,request._api_pame,sign_parameter)
-
-        api_url = self._server_url
+        sign_parameter[P_SIGN] = self._sign(request._api_pame, sign_parameter)
 
-        full_url = api_url + "?";
-        for key in sign_parameter:
-            full_url += key + "=" + str(sign_parameter[key]) + "&";
-        full_url = full_url[0:-1]
+        return sign_parameter
 
-        try:
-            if(request._http_method == 'POST' or len(request._file_params) != 0) :
-                r = requests.post(api_url,sign_parameter,files=request._file_params, timeout=self._timeout)
-            else:
-                r = requests.get(api_url,sign_parameter, timeout=self._timeout)
-        except Exception as err:
-            logApiError(self._app_key, P_SDK_VERSION, full_url, "HTTP_ERROR", str(err))
-            raise err
+    def _debug_url(self, sign_parameter):
+        # only needed when logApiError fires, so it is never built on the happy path
+        return self._server_url + "?" + "&".join("%s=%s" % item for item in sign_parameter.items())
 
+    def _build_response(self, jsonobj, sign_parameter):
         response = IopResponse()
 
-        jsonobj = r.json()
-
         if P_CODE in jsonobj:
             response.code = jsonobj[P_CODE]
         if P_TYPE in jsonobj:
@@ -186,11 +219,105 @@ class IopClient(object):
             response.request_id = jsonobj[P_REQUEST_ID]
 
         if response.code is not None and response.code != "0":
-            logApiError(self._app_key, P_SDK_VERSION, full_url, response.code, response.message)
+            logApiError(self._app_key, P_SDK_VERSION, self._debug_url(sign_parameter), response.code, response.message)
         else:
             if(self.log_level == P_LOG_LEVEL_DEBUG or self.log_level == P_LOG_LEVEL_INFO):
-                logApiError(self._app_key, P_SDK_VERSION, full_url, "", "")
+                logApiError(self._app_key, P_SDK_VERSION, self._debug_url(sign_parameter), "", "")
 
         response.body = jsonobj
 
         return response
+
+    def _observe(self, request, code, started, body=None, error=None):
+        elapsed = time.monotonic() - started
+        if self._observer is not None:
+            self._observer(request._api_pame, code, elapsed)
+        if self._recorder is not None:
+            self._recorder(request._api_pame, request._api_params, body, error, elapsed)
+
+    def execute(self, request,access_token = None,timeout = None):
+
+        sign_parameter = self._sign_request(request, access_token)
+        api_url = self._server_url
+        timeout = self._timeout if timeout is None else timeout
+
+        started = time.monotonic()
+        try:
+            if(request._http_method == 'POST' or len(request._file_params) != 0) :
+                r = self._get_session().post(api_url,sign_parameter,files=request._file_params, timeout=timeout)
+            else:
+                r = self._get_session().get(api_url,sign_parameter, timeout=timeout)
+        except Exception as err:
+            logApiError(self._app_key, P_SDK_VERSION, self._debug_url(sign_parameter), "HTTP_ERROR", str(err))
+            self._observe(request, "HTTP_ERROR", started, error=err)
+            raise err
+
+        body = r.json()
+        response = self._build_response(body, sign_parameter)
+        self._observe(request, response.code or "0", started, body=body)
+        return response
+
+    def _get_session(self):
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._max_keepalive_connections)
+            self._session = requests.Session()
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+        return self._session
+
+    def _get_async_client(self):
+        # created lazily so the client binds to the running event loop
+        if self._async_client is None or self._async_client.is_closed:
+            limits = httpx.Limits(
+                max_connections=self._max_connections,
+                max_keepalive_connections=self._max_keepalive_connections,
+                keepalive_expiry=self._keepalive_expiry,
+            )
+            self._async_client = httpx.AsyncClient(timeout=self._timeout, limits=limits)
+        return self._async_client
+
+    async def warm_up(self, connections=1, timeout=WARM_UP_TIMEOUT):
+        # opens keep-alive connections to the gateway ahead of the first request;
+        # the response itself is irrelevant, only the TCP+TLS handshake is
+        client = self._get_async_client()
+        results = await asyncio.gather(
+            *[client.head(self._server_url, timeout=timeout) for _ in range(connections)],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                client_logger.warning("warm up of %s failed: %r", self._server_url, result)
+
+    async def execute_async(self, request, access_token = None, timeout = None):
+
+        sign_parameter = self._sign_request(request, access_token)
+        api_url = self._server_url
+        client = self._get_async_client()
+        timeout = self._timeout if timeout is None else timeout
+
+        started = time.monotonic()
+        try:
+            if(request._http_method == 'POST' or len(request._file_params) != 0) :
+                r = await client.post(api_url, data=sign_parameter, files=request._file_params or None, timeout=timeout)
+            else:
+                r = await client.get(api_url, params=sign_parameter, timeout=timeout)
+        except asyncio.CancelledError as err:
+            # the caller gave up on it, e.g. a search page after an early stop; a recording still needs the call
+            self._observe(request, "CANCELLED", started, error=err)
+            raise
+        except Exception as err:
+            logApiError(self._app_key, P_SDK_VERSION, self._debug_url(sign_parameter), "HTTP_ERROR", str(err))
+            self._observe(request, "HTTP_ERROR", started, error=err)
+            raise err
+
+        body = r.json()
+        response = self._build_response(body, sign_parameter)
+        self._observe(request, response.code or "0", started, body=body)
+        return response
+
+    async def aclose(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
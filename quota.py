@@ -0,0 +1,143 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+import time
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# lower runs first
+INTERACTIVE = 0
+BATCH = 5
+BACKGROUND = 10
+
+# gateway codes returned once an app key has exhausted its call quota
+QUOTA_ERROR_CODES = {"ApiCallLimit", "AppCallLimit"}
+_BAN_SECONDS_RE = re.compile(r"(\d+) more seconds?")
+
+
+def quota_ban_seconds(response, default: float = 1.0) -> Optional[float]:
+    """How long the gateway banned the key for, or None if the response isn't a quota error."""
+    if response.code not in QUOTA_ERROR_CODES:
+        return None
+    match = _BAN_SECONDS_RE.search(response.message or "")
+    return float(match.group(1)) if match else default
+
+
+class QuotaScheduler:
+    """Hands out gateway calls within per-key, per-method token bucket quotas.
+
+    Each configured client (one per app key) has its own bucket for every API
+    method, and calls are spread round-robin over the keys with tokens left.
+    When no key has a token, callers wait in a priority queue, so interactive
+    lookups are granted before background work such as cache refreshes.
+    """
+
+    def __init__(self, clients: Sequence[Any], rate: float = 5, burst: float = 10,
+                 method_rates: Optional[Dict[str, Tuple[float, float]]] = None):
+        if not clients:
+            raise ValueError("at least one client is required")
+        self.clients = list(clients)
+        self.rate = rate
+        self.burst = burst
+        self.method_rates = method_rates or {}
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self._banned_until: Dict[int, float] = {}
+        self._waiters: Dict[str, List[Tuple[int, int, asyncio.Future]]] = {}
+        self._pumps: Dict[str, asyncio.Task] = {}
+        self._next = 0
+        self._seq = itertools.count()
+        self.granted = 0
+        self.queued = 0
+        self.bans = 0
+
+    def _bucket(self, index: int, method: str) -> TokenBucket:
+        bucket = self._buckets.get((index, method))
+        if bucket is None:
+            rate, burst = self.method_rates.get(method, (self.rate, self.burst))
+            bucket = self._buckets[(index, method)] = TokenBucket(rate, burst)
+        return bucket
+
+    def _try_take(self, method: str) -> Optional[int]:
+        now = time.monotonic()
+        for offset in range(len(self.clients)):
+            index = (self._next + offset) % len(self.clients)
+            if self._banned_until.get(index, 0) > now:
+                continue
+            if self._bucket(index, method).try_acquire():
+                self._next = (index + 1) % len(self.clients)
+                return index
+        return None
+
+    def _delay(self, method: str) -> float:
+        now = time.monotonic()
+        return min(
+            max(self._banned_until.get(i, 0) - now, self._bucket(i, method).delay_until())
+            for i in range(len(self.clients))
+        )
+
+    def try_acquire(self, method: str) -> Optional[Any]:
+        """The client of a key with a token to spare right now, or None; never waits or jumps the queue."""
+        if self._waiters.get(method):
+            return None
+        index = self._try_take(method)
+        if index is None:
+            return None
+        self.granted += 1
+        return self.clients[index]
+
+    async def acquire(self, method: str, priority: int = INTERACTIVE) -> Any:
+        """Waits for quota on any key and returns the client to send the call with."""
+        waiters = self._waiters.setdefault(method, [])
+        if not waiters:
+            index = self._try_take(method)
+            if index is not None:
+                self.granted += 1
+                return self.clients[index]
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(waiters, (priority, next(self._seq), future))
+        self.queued += 1
+        if method not in self._pumps:
+            self._pumps[method] = asyncio.create_task(self._pump(method))
+        return self.clients[await future]
+
+    async def _pump(self, method: str) -> None:
+        waiters = self._waiters[method]
+        try:
+            while waiters:
+                if waiters[0][2].done():
+                    # the caller gave up, e.g. its deadline passed
+                    heapq.heappop(waiters)
+                    continue
+                index = self._try_take(method)
+                if index is None:
+                    await asyncio.sleep(max(self._delay(method), 0.001))
+                    continue
+                _, _, future = heapq.heappop(waiters)
+                self.granted += 1
+                future.set_result(index)
+        finally:
+            del self._pumps[method]
+
+    def ban(self, client: Any, seconds: float) -> None:
+        """Takes a key out of rotation after the gateway reported its quota exhausted."""
+        index = self.clients.index(client)
+        self._banned_until[index] = time.monotonic() + seconds
+        self.bans += 1
+        logger.warning(f"App key #{index} hit its quota, pausing it for {seconds}s")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "keys": len(self.clients),
+            "banned_keys": sum(1 for until in self._banned_until.values() if until > now),
+            "waiting": {method: len(w) for method, w in self._waiters.items() if w},
+            "granted": self.granted,
+            "queued": self.queued,
+            "bans": self.bans,
+        }
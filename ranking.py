@@ -0,0 +1,101 @@
+from typing import Generic, List, Optional, Sequence, Tuple, TypeVar
+import heapq
+import itertools
+
+import numpy as np
+
+from keywords import title_tokens
+
+# splits ASCII bytes into the tokens of keywords.title_tokens: anything that
+# isn't [a-z0-9] becomes a space, except the marker between joined titles
+_BREAK = b"\x00"
+_TOKEN_BYTES = set(b"abcdefghijklmnopqrstuvwxyz0123456789" + _BREAK)
+_SPLIT_TABLE = bytes(c if c in _TOKEN_BYTES else ord(" ") for c in range(256))
+
+T = TypeVar("T")
+
+
+class TopK(Generic[T]):
+    """Keeps the ``k`` items with the lowest score seen so far.
+
+    Backed by a max-heap of size ``k``, so pushing n items costs O(n log k)
+    and items that can't make the cut are rejected with one comparison.
+    """
+
+    def __init__(self, k: int):
+        if k <= 0:
+            raise ValueError("k must be positive")
+        self.k = k
+        self._heap: List[Tuple[float, int, T]] = []
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def full(self) -> bool:
+        return len(self._heap) >= self.k
+
+    @property
+    def threshold(self) -> Optional[float]:
+        """Score an item has to beat to get in, once the heap is full."""
+        return -self._heap[0][0] if self.full else None
+
+    def push(self, score: float, item: T) -> bool:
+        # the sequence number keeps equal scores in arrival order and never compares items
+        entry = (-score, -next(self._seq), item)
+        if not self.full:
+            heapq.heappush(self._heap, entry)
+            return True
+        if score >= -self._heap[0][0]:
+            return False
+        heapq.heapreplace(self._heap, entry)
+        return True
+
+    def items(self) -> List[T]:
+        """Kept items, lowest score first."""
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+
+def relevance_scores(title: str, candidate_titles: Sequence[str]) -> np.ndarray:
+    """TF-IDF cosine similarity of each candidate title to ``title``, in [0, 1].
+
+    Document frequencies come from the candidate set itself, so tokens every
+    candidate shares (the search keywords) weigh little and the ones that set
+    a real alternative apart from an accessory weigh more. Titles are sparse,
+    so the vectors are kept as (row, token) pairs and reduced with bincount
+    instead of building a dense candidates x vocabulary matrix.
+    """
+    n = len(candidate_titles)
+    query = title_tokens(title)
+    if n == 0 or not query:
+        return np.zeros(n)
+
+    # tokenize every title in one pass; non-ASCII characters are separators
+    # for title_tokens too, so replacing them with '?' keeps the same tokens
+    joined = " \x00 ".join(candidate_titles).lower().encode("ascii", "replace")
+    tokens = joined.translate(_SPLIT_TABLE).split()
+    vocabulary = {token: i for i, token in enumerate(dict.fromkeys([_BREAK, *tokens]))}
+    query = [token.encode("ascii") for token in query]
+    ids = np.fromiter(map(vocabulary.__getitem__, tokens), dtype=np.intp, count=len(tokens))
+    is_break = ids == 0
+    rows = np.cumsum(is_break)[~is_break]
+    # binary term frequency: a token repeated in one title counts once
+    pairs = np.sort(rows * len(vocabulary) + ids[~is_break])
+    pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+    rows, cols = np.divmod(pairs, len(vocabulary))
+
+    df = np.bincount(cols, minlength=len(vocabulary))
+    idf = np.log((1 + n) / (1 + df)) + 1
+    weights = idf[cols] ** 2
+
+    in_query = np.zeros(len(vocabulary), dtype=bool)
+    in_query[[vocabulary[token] for token in query if token in vocabulary]] = True
+    dot = np.bincount(rows, weights=weights * in_query[cols], minlength=n)
+    candidate_norms = np.sqrt(np.bincount(rows, weights=weights, minlength=n))
+    # query tokens no candidate has still count towards the query's norm
+    missing = sum(1 for token in query if token not in vocabulary)
+    query_norm = np.sqrt(np.sum(idf[in_query] ** 2) + missing * (np.log(1 + n) + 1) ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = dot / (candidate_norms * query_norm)
+    return np.nan_to_num(scores)
@@ -0,0 +1,45 @@
+from typing import Callable
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate and capacity must be positive")
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay_until(self, tokens: float = 1) -> float:
+        """Seconds until ``tokens`` will be available, 0 if they already are."""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # the lock keeps waiters first-come first-served
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep(self.delay_until(tokens))
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
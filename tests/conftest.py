@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# the app's modules are top level, and the iop SDK is vendored under python/
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "python"))
+
+# what app.py needs to import, without touching the network or the working directory
+APP_ENV = {
+    "ALIEXPRESS_API_KEY": "key",
+    "ALIEXPRESS_AFFILIATE_ID": "affiliate",
+    "ALIEXPRESS_APP_SECRET": "secret",
+    "TWILIO_SID": "AC" + "0" * 32,
+    "TWILIO_AUTH_TOKEN": "token",
+    "CATALOG_PATH": "",
+    "WATCH_DB_PATH": ":memory:",
+    "TRAFFIC_LOG_PATH": "",
+}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    for name, value in APP_ENV.items():
+        monkeypatch.setenv(name, value)
+    import app
+    return app
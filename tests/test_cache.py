@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from cache import SingleFlight, StaleWhileRevalidateCache
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*[flight.do("key", load) for _ in range(5)])
+        return results, calls, flight.coalesced
+
+    assert asyncio.run(main()) == (["value"] * 5, 1, 4)
+
+
+def test_single_flight_cancelled_leader_leaves_waiters_the_result():
+    async def main():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def load():
+            await release.wait()
+            return "value"
+
+        leader = asyncio.create_task(flight.do("key", load))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do("key", load))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(main()) == "value"
+
+
+
+def test_rejected_values_are_returned_but_not_cached():
+    async def main():
+        cache = StaleWhileRevalidateCache()
+        loads = []
+
+        async def load():
+            loads.append(len(loads))
+            return {"links": len(loads) > 1}
+
+        first = await cache.get_or_load("key", load, cacheable=lambda value: value["links"])
+        second = await cache.get_or_load("key", load, cacheable=lambda value: value["links"])
+        third = await cache.get_or_load("key", load, cacheable=lambda value: value["links"])
+        return first, second, third, len(loads), cache.stats()["uncached"]
+
+    assert asyncio.run(main()) == ({"links": False}, {"links": True}, {"links": True}, 2, 1)
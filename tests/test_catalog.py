@@ -0,0 +1,60 @@
+import time
+
+from catalog import ProductCatalog
+from traffic_log import RecordedCatalog, TrafficRecorder, read_traffic
+
+
+def product(product_id, title, price):
+    return {"product_id": product_id, "product_title": title, "target_sale_price": str(price),
+            "product_detail_url": f"https://www.aliexpress.com/item/{product_id}.html"}
+
+
+def test_affiliate_links_are_stored_by_detail_url():
+    catalog = ProductCatalog(":memory:")
+    catalog.upsert([product("1", "red wireless earbuds", 5), product("2", "red wireless earbuds case", 6)], "USD")
+    catalog.set_affiliate_links({"https://www.aliexpress.com/item/1.html": "https://s.click/1"})
+
+    matches = catalog.cheaper_matching(["red", "wireless", "earbuds"], 10, "USD", max_age=60, limit=5)
+    assert [(m["product_id"], m["affiliate_url"]) for m in matches] == [("1", "https://s.click/1"), ("2", None)]
+
+
+def test_prune_deletes_products_older_than_max_age():
+    catalog = ProductCatalog(":memory:", max_age=60)
+    catalog.upsert([product("1", "red wireless earbuds", 5), product("2", "blue wireless earbuds", 6)], "USD")
+    catalog._conn.execute("UPDATE products SET updated_at = ? WHERE product_id = '1'", (time.time() - 120,))
+
+    assert catalog.prune() == 1
+    assert catalog.stats()["products"] == 1
+    tokens = {row[0] for row in catalog._conn.execute("SELECT DISTINCT product_id FROM product_tokens")}
+    assert tokens == {"2"}
+
+
+def test_product_count_follows_inserts_refreshes_and_reopens(tmp_path):
+    path = str(tmp_path / "catalog.db")
+    catalog = ProductCatalog(path)
+    catalog.upsert([product("1", "red wireless earbuds", 5), product("2", "blue wireless earbuds", 6)], "USD")
+    # a refresh, a new product, and the same products in another currency
+    catalog.upsert([product("2", "blue wireless earbuds", 5), product("3", "green wireless earbuds", 7)], "USD")
+    catalog.upsert([product("1", "red wireless earbuds", 4), product("1", "red wireless earbuds", 4)], "EUR")
+
+    assert catalog.stats()["products"] == 4
+    catalog.close()
+    assert ProductCatalog(path).stats()["products"] == 4
+
+
+def test_recorded_lookups_replay_in_order(tmp_path):
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = TrafficRecorder(path)
+    catalog = ProductCatalog(":memory:", recorder=recorder.record_catalog)
+    tokens = ["red", "wireless", "earbuds"]
+    catalog.cheaper_matching(tokens, 10, "USD", max_age=60, limit=5)
+    catalog.upsert([product("1", "red wireless earbuds", 5)], "USD")
+    catalog.cheaper_matching(tokens, 10, "USD", max_age=60, limit=5)
+    recorder.close()
+
+    replayed = RecordedCatalog(read_traffic(path))
+    assert replayed.cheaper_matching(tokens, 10, "USD", max_age=3600, limit=5) == []
+    assert [m["product_id"] for m in replayed.cheaper_matching(tokens, 10, "USD", max_age=3600, limit=5)] == ["1"]
+    # a lookup the recording never made finds nothing
+    assert replayed.cheaper_matching(tokens, 20, "USD", max_age=3600, limit=5) == []
+    assert replayed.stats()["unmatched"] == 1
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from circuit_breaker import UpstreamGuard
+from deadline import Deadline, DeadlineExceeded
+
+
+async def healthy_upstream(timeout):
+    await asyncio.sleep(0.05)
+    return "ok"
+
+
+def test_short_deadlines_dont_open_the_breaker():
+    async def main():
+        guard = UpstreamGuard(error_rate=0.5, min_calls=5)
+        for _ in range(20):
+            with pytest.raises(DeadlineExceeded):
+                await guard.call("method", healthy_upstream, deadline=Deadline(0.02))
+        return await guard.call("method", healthy_upstream, deadline=Deadline(5)), guard.breaker("method")
+
+    result, breaker = asyncio.run(main())
+    assert result == "ok"
+    assert breaker.state == "closed"
+
+
+def test_upstream_timeouts_open_the_breaker():
+    async def main():
+        guard = UpstreamGuard(max_timeout=0.02, min_timeout=0.02, error_rate=0.5, min_calls=5)
+        for _ in range(20):
+            with pytest.raises(Exception):
+                await guard.call("method", healthy_upstream, deadline=Deadline(5))
+        return guard.breaker("method")
+
+    assert asyncio.run(main()).state != "closed"
+
+
+def test_hedge_is_skipped_when_it_cannot_be_sent():
+    async def main():
+        guard = UpstreamGuard(min_samples=1, hedge_methods=["method"])
+        guard.breaker("method").record(True, 0.01)
+        hedges = []
+
+        def no_quota(timeout):
+            hedges.append(timeout)
+            return None
+
+        result = await guard.call("method", healthy_upstream, hedge=no_quota)
+        return result, hedges, guard.stats()
+
+    result, hedges, stats = asyncio.run(main())
+    assert result == "ok"
+    assert len(hedges) == 1
+    assert (stats["hedges"], stats["hedges_skipped"]) == (0, 1)
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+
+def product(product_id, price=10):
+    return {"product_id": product_id, "product_title": f"product {product_id}", "target_sale_price": str(price)}
+
+
+def stub_client(app_module, monkeypatch, details=None, similar=None):
+    """Replaces the gateway-facing client calls; returns the id lists of the details calls."""
+    calls = []
+
+    async def get_products_details_async(product_ids, deadline=None, priority=None):
+        calls.append(list(product_ids))
+        if details:
+            return await details(product_ids)
+        return {product_id: product(product_id) for product_id in product_ids}
+
+    async def similar_products_async(product, deadline=None, priority=None):
+        return await similar(product) if similar else []
+
+    client = app_module.aliexpress_client
+    monkeypatch.setattr(client, "get_products_details_async", get_products_details_async)
+    monkeypatch.setattr(client, "similar_products_async", similar_products_async)
+    return calls
+
+
+async def collect(lines):
+    return [json.loads(line) async for line in lines]
+
+
+def test_ids_are_fetched_in_chunks_of_the_batch_size(app_module, monkeypatch):
+    calls = stub_client(app_module, monkeypatch)
+    size = app_module.PRODUCT_DETAILS_BATCH_SIZE
+    items = [str(1000 + i) for i in range(size + 5)] + ["not a link"]
+
+    lines = asyncio.run(collect(app_module.compare_items(items)))
+
+    assert sorted(len(ids) for ids in calls) == [5, size]
+    assert sum(1 for line in lines if line.get("cheaper_products") == []) == size + 5
+    assert [line for line in lines if "error" in line] == [{"item": "not a link", "error": "Invalid AliExpress URL"}]
+
+
+def test_a_failed_details_call_fails_only_its_chunk(app_module, monkeypatch):
+    async def details(product_ids):
+        if "1000" in product_ids:
+            raise RuntimeError("gateway down")
+        return {product_id: product(product_id) for product_id in product_ids}
+
+    calls = stub_client(app_module, monkeypatch, details=details)
+    size = app_module.PRODUCT_DETAILS_BATCH_SIZE
+    items = [str(1000 + i) for i in range(size + 2)]
+
+    lines = asyncio.run(collect(app_module.compare_items(items)))
+
+    assert len(calls) == 2
+    failed = [line for line in lines if line.get("error") == "Failed to get product details"]
+    assert len(failed) == len(next(ids for ids in calls if "1000" in ids))
+    assert len(lines) - len(failed) == len(next(ids for ids in calls if "1000" not in ids))
+
+
+def test_a_client_disconnect_cancels_the_items_still_running(app_module, monkeypatch):
+    cancelled = []
+
+    async def similar(product):
+        if product["product_id"] == "1000":
+            return []
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(product["product_id"])
+            raise
+
+    stub_client(app_module, monkeypatch, similar=similar)
+
+    async def main():
+        lines = app_module.compare_items(["1000", "1001", "1002"])
+        first = json.loads(await lines.__anext__())
+        # what StreamingResponse does when the client goes away
+        await lines.aclose()
+        await asyncio.sleep(0)
+        return first
+
+    assert asyncio.run(main())["product_id"] == "1000"
+    assert sorted(cancelled) == ["1001", "1002"]
+
+
+def test_batches_need_the_batch_key(app_module, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    stub_client(app_module, monkeypatch)
+    monkeypatch.setattr(app_module, "BATCH_API_KEY", "batch-key")
+    client = TestClient(app_module.app)
+
+    for headers in ({}, {"X-API-Key": "wrong"}, {"X-API-Key": "batch-kéy".encode("latin-1")}):
+        assert client.post("/compare/batch", json=["1000"], headers=headers).status_code == 401
+    response = client.post("/compare/batch", json=["1000"], headers={"X-API-Key": "batch-key"})
+    assert response.status_code == 200
+    assert json.loads(response.text.splitlines()[0])["product_id"] == "1000"
@@ -0,0 +1,45 @@
+from dedup import DONE, PROCESSING, DedupStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_claim_then_complete():
+    store = DedupStore()
+    key = store.key_for("SM1", "whatsapp:+15550000001", "link")
+
+    assert store.claim(key) is None
+    store.complete(key, {"message": "sent"})
+    assert store.claim(key) == {"state": DONE, "result": {"message": "sent"}}
+    assert store.duplicates == 1
+
+
+def test_redelivery_while_processing_is_a_duplicate_until_released():
+    store = DedupStore()
+    key = store.key_for("SM1", "whatsapp:+15550000001", "link")
+
+    assert store.claim(key) is None
+    assert store.claim(key) == {"state": PROCESSING, "result": None}
+    # a job that failed releases its key, so the next delivery is processed
+    store.release(key)
+    assert store.claim(key) is None
+
+
+def test_entries_expire_after_their_window():
+    clock = FakeClock()
+    store = DedupStore(window=600, fallback_window=30, clock=clock)
+    by_sid = store.key_for("SM1", "whatsapp:+15550000001", "link")
+    by_body = store.key_for(None, "whatsapp:+15550000001", "link")
+    store.claim(by_sid)
+    store.claim(by_body)
+
+    clock.now = 31
+    assert store.claim(by_body) is None
+    assert store.claim(by_sid) is not None
+    clock.now = 601
+    assert store.claim(by_sid) is None
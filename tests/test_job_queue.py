@@ -0,0 +1,36 @@
+import asyncio
+
+from job_queue import JobQueue
+
+
+def test_worker_survives_a_job_that_raises_cancelled_error():
+    async def main():
+        queue = JobQueue(concurrency=1, max_depth=10)
+        await queue.start()
+        done = []
+
+        async def leaks_cancellation():
+            raise asyncio.CancelledError()
+
+        async def job():
+            done.append("ran")
+
+        queue.submit(leaks_cancellation)
+        queue.submit(job)
+        await asyncio.wait_for(queue.stop(), 1)
+        return done, queue.stats()
+
+    done, stats = asyncio.run(main())
+    assert done == ["ran"]
+    assert (stats["failed"], stats["completed"]) == (1, 1)
+
+
+def test_stop_cancels_the_workers():
+    async def main():
+        queue = JobQueue(concurrency=2, max_depth=10)
+        await queue.start()
+        workers = list(queue._workers)
+        await queue.stop()
+        return workers
+
+    assert all(worker.cancelled() for worker in asyncio.run(main()))
@@ -0,0 +1,29 @@
+import pytest
+
+from keywords import keyword_queries, keyword_terms
+
+
+@pytest.mark.parametrize("title, terms", [
+    ("2024 New Hot Sale Wireless Bluetooth Earbuds Black", ["wireless", "bluetooth", "earbuds"]),
+    ("Xiaomi Redmi Note 13 5G Smartphone 128GB", ["xiaomi", "redmi", "note", "13", "5g", "smartphone"]),
+    ("USB C Fast Charging Cable 2m", ["usb", "c", "charging", "cable"]),
+    ("Type C to Lightning Adapter", ["type", "c", "lightning", "adapter"]),
+    ("Organic Green Tea 500g Loose Leaf", ["organic", "tea", "loose", "leaf"]),
+    ("Men's Cotton T Shirt XL Summer", ["cotton", "shirt", "summer"]),
+    ("New Hot Sale", ["new", "hot", "sale"]),
+])
+def test_keyword_terms(title, terms):
+    assert keyword_terms(title) == terms
+
+
+@pytest.mark.parametrize("title, queries", [
+    ("Xiaomi Redmi Note 13 5G Smartphone 128GB",
+     ["13 5g note redmi smartphone xiaomi", "note redmi xiaomi", "redmi xiaomi"]),
+    ("USB C Fast Charging Cable 2m", ["c cable charging usb", "c usb"]),
+    # word order, filler and colors don't change the queries
+    ("Red Wireless Bluetooth Earbuds", ["bluetooth earbuds wireless", "bluetooth wireless"]),
+    ("Bluetooth Wireless Earbuds 2024 Hot Sale", ["bluetooth earbuds wireless", "bluetooth wireless"]),
+    ("Earbuds", ["earbuds"]),
+])
+def test_keyword_queries(title, queries):
+    assert keyword_queries(title) == queries
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from quota import BACKGROUND, INTERACTIVE, QuotaScheduler
+
+METHOD = "aliexpress.affiliate.product.query"
+
+
+def test_calls_rotate_over_the_keys():
+    async def main():
+        quota = QuotaScheduler(["a", "b", "c"], rate=1, burst=10)
+        return [await quota.acquire(METHOD) for _ in range(4)]
+
+    assert asyncio.run(main()) == ["a", "b", "c", "a"]
+
+
+def test_waiters_are_granted_by_priority():
+    async def main():
+        quota = QuotaScheduler(["a"], rate=20, burst=1)
+        await quota.acquire(METHOD)
+        granted = []
+
+        async def call(name, priority):
+            await quota.acquire(METHOD, priority)
+            granted.append(name)
+
+        # queued first, but background work waits behind interactive lookups
+        background = asyncio.create_task(call("refresh", BACKGROUND))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call("lookup", INTERACTIVE))
+        await asyncio.gather(background, interactive)
+        return granted
+
+    assert asyncio.run(main()) == ["lookup", "refresh"]
+
+
+def test_a_cancelled_waiter_gives_up_its_turn():
+    async def main():
+        quota = QuotaScheduler(["a"], rate=20, burst=1)
+        await quota.acquire(METHOD)
+        abandoned = asyncio.create_task(quota.acquire(METHOD, INTERACTIVE))
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        waiting = asyncio.create_task(quota.acquire(METHOD, BACKGROUND))
+        await asyncio.sleep(0)
+        abandoned.cancel()
+        await waiting
+        return time.monotonic() - started, quota.stats()
+
+    waited, stats = asyncio.run(main())
+    # the token the cancelled caller would have had goes to the next waiter
+    assert waited < 0.09
+    assert stats["granted"] == 2
+    assert stats["waiting"] == {}
+
+
+def test_a_banned_key_is_skipped_until_its_ban_expires():
+    async def main():
+        quota = QuotaScheduler(["a", "b"], rate=1, burst=10)
+        quota.ban("a", 0.1)
+        during = [await quota.acquire(METHOD) for _ in range(3)]
+        await asyncio.sleep(0.12)
+        after = [await quota.acquire(METHOD) for _ in range(2)]
+        return during, after, quota.stats()
+
+    during, after, stats = asyncio.run(main())
+    assert during == ["b", "b", "b"]
+    assert sorted(after) == ["a", "b"]
+    assert stats["bans"] == 1 and stats["banned_keys"] == 0
+
+
+def test_try_acquire_never_waits_or_jumps_the_queue():
+    async def main():
+        quota = QuotaScheduler(["a"], rate=20, burst=1)
+        first = quota.try_acquire(METHOD)
+        empty = quota.try_acquire(METHOD)
+        waiting = asyncio.create_task(quota.acquire(METHOD))
+        await asyncio.sleep(0)
+        # a token that turns up while a caller is queued is the caller's
+        quota._bucket(0, METHOD)._tokens = 1
+        queued = quota.try_acquire(METHOD)
+        return first, empty, queued, await waiting
+
+    assert asyncio.run(main()) == ("a", None, None, "a")
@@ -0,0 +1,59 @@
+import asyncio
+
+from aliexpress_client import AliExpressClient
+from catalog import ProductCatalog
+
+
+def product(product_id, title, price):
+    return {"product_id": product_id, "product_title": title, "target_sale_price": str(price),
+            "product_detail_url": f"https://www.aliexpress.com/item/{product_id}.html"}
+
+
+def test_catalog_answers_skip_accessories():
+    client = AliExpressClient(api_key="key", affiliate_id="affiliate", app_secret="secret")
+    client.catalog = ProductCatalog(":memory:")
+    client.catalog.upsert([
+        product("a1", "Wireless Bluetooth Earbuds Headphones Silicone Ear Tips Replacement Cover", 1),
+        product("a2", "Wireless Bluetooth Earbuds Headphones Charging Cable USB Adapter", 2),
+        product("a3", "Wireless Bluetooth Earbuds Headphones Protective Case Shell Strap", 3),
+        product("e1", "Wireless Bluetooth Earbuds Noise Cancelling Headphones", 10),
+        product("e2", "Wireless Bluetooth Earbuds Noise Cancelling Stereo Headphones", 11),
+        product("e3", "Noise Cancelling Wireless Bluetooth Earbuds Headphones Bass", 12),
+    ], "USD")
+
+    original = product("1", "Wireless Bluetooth Earbuds Noise Cancelling Headphones Pro", 20)
+    local = client._similar_from_catalog(original)
+    assert [p["product_id"] for p in local] == ["e1", "e2", "e3"]
+    # a hit needs SIMILAR_PRODUCTS_LIMIT relevant matches, not CATALOG_CANDIDATES rows
+    assert (client.catalog.hits, client.catalog.misses) == (1, 0)
+
+
+def test_candidates_sharing_nothing_with_the_title_are_dropped():
+    client = AliExpressClient(api_key="key", affiliate_id="affiliate", app_secret="secret")
+    candidates = [(float(p["target_sale_price"]), p) for p in [
+        product("c1", "Phone case", 1),
+        product("c2", "Screen protector", 2),
+        product("c3", "Tempered Glass Screen Protector Film", 3),
+    ]]
+
+    original = product("1", "Wireless Bluetooth Earbuds Noise Cancelling Headphones Pro", 20)
+    assert client._relevant(original, candidates) == []
+
+
+def test_product_urls_stand_in_for_links_that_failed():
+    client = AliExpressClient(api_key="key", affiliate_id="affiliate", app_secret="secret")
+    client.catalog = ProductCatalog(":memory:")
+    client.catalog.upsert([
+        product("e1", "Wireless Bluetooth Earbuds Noise Cancelling Headphones", 10),
+        product("e2", "Wireless Bluetooth Earbuds Noise Cancelling Stereo Headphones", 11),
+        product("e3", "Noise Cancelling Wireless Bluetooth Earbuds Headphones Bass", 12),
+    ], "USD")
+
+    async def failing_links(urls, deadline=None, priority=None):
+        return {}
+
+    client.generate_affiliate_links_async = failing_links
+    original = product("1", "Wireless Bluetooth Earbuds Noise Cancelling Headphones Pro", 20)
+    results = asyncio.run(client.similar_products_async(original))
+    assert [r["affiliate_url"] for r in results] == [
+        f"https://www.aliexpress.com/item/{product_id}.html" for product_id in ("e1", "e2", "e3")]
@@ -0,0 +1,109 @@
+import asyncio
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from twilio.base.exceptions import TwilioRestException
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from twilio_dispatcher import TwilioDispatcher, is_retryable
+
+SENDER = "whatsapp:+15551112222"
+
+
+class FakeCreate:
+    """Stands in for messages.create: records every call, failing with ``errors`` first."""
+
+    def __init__(self, errors=(), delay=0.0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, **params):
+        with self._lock:
+            self.calls.append((params["to"], params["body"], params["from_"], time.monotonic()))
+            error = self.errors.pop(0) if self.errors else None
+        time.sleep(self.delay() if callable(self.delay) else self.delay)
+        if error is not None:
+            raise error
+        return SimpleNamespace(sid=f"SM{len(self.calls)}")
+
+
+def dispatch(create, messages, **options):
+    """Sends ``messages`` (to, body[, from_]) through a dispatcher; returns each one's sid or exception."""
+    async def main():
+        dispatcher = TwilioDispatcher(create, **options)
+        await dispatcher.start()
+        futures = [dispatcher.enqueue({"to": m[0], "body": m[1], "from_": m[2] if len(m) > 2 else SENDER})
+                   for m in messages]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await dispatcher.stop()
+        return dispatcher, results
+
+    return asyncio.run(main())
+
+
+def test_messages_to_one_recipient_keep_their_order():
+    rng = random.Random(7)
+    create = FakeCreate(delay=lambda: rng.uniform(0, 0.01))
+    messages = [(f"whatsapp:+1555000000{r}", f"message {i}") for i in range(5) for r in range(3)]
+    dispatcher, results = dispatch(create, messages, rate=1000, burst=1000, max_in_flight=3)
+
+    assert all(isinstance(sid, str) for sid in results)
+    for r in range(3):
+        sent = [body for to, body, _, _ in create.calls if to == f"whatsapp:+1555000000{r}"]
+        assert sent == [f"message {i}" for i in range(5)]
+    assert dispatcher.stats()["sent"] == 15
+
+
+def test_retryable_errors_are_retried_with_backoff():
+    create = FakeCreate(errors=[TwilioRestException(429, "/Messages"), TwilioRestException(503, "/Messages")])
+    dispatcher, results = dispatch(create, [("whatsapp:+15550000001", "hello")],
+                                   rate=1000, burst=1000, backoff=0.05)
+
+    assert results == ["SM3"]
+    assert dispatcher.retries == 2
+    times = [t for _, _, _, t in create.calls]
+    # jittered between 0.5x and 1.5x of backoff, then of twice the backoff
+    assert times[1] - times[0] >= 0.025
+    assert times[2] - times[1] >= 0.05
+
+
+def test_non_retryable_errors_fail_at_once():
+    create = FakeCreate(errors=[TwilioRestException(400, "/Messages", "invalid number")])
+    dispatcher, results = dispatch(create, [("whatsapp:+15550000001", "hello")], rate=1000, burst=1000)
+
+    assert len(create.calls) == 1
+    assert isinstance(results[0], TwilioRestException) and results[0].status == 400
+    assert (dispatcher.retries, dispatcher.failed) == (0, 1)
+
+
+def test_each_sender_is_paced_by_its_own_bucket():
+    create = FakeCreate()
+    other = "whatsapp:+15553334444"
+    messages = [(f"whatsapp:+1555000000{i}", "hello") for i in range(5)] + [("whatsapp:+15550000009", "hi", other)]
+    dispatch(create, messages, rate=20, burst=1)
+
+    paced = sorted(t for _, _, sender, t in create.calls if sender == SENDER)
+    # a burst of one at 20/s leaves at least 50ms between sends
+    assert min(b - a for a, b in zip(paced, paced[1:])) >= 0.045
+    # the other sender's message doesn't wait behind the first sender's
+    assert next(t for _, _, sender, t in create.calls if sender == other) < paced[2]
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (TwilioRestException(429, "/Messages"), True),
+    (TwilioRestException(503, "/Messages"), True),
+    (TwilioRestException(400, "/Messages"), False),
+    (requests.ConnectTimeout(), True),
+    (requests.ConnectionError(MaxRetryError(None, "/Messages", NewConnectionError(None, "refused"))), True),
+    # the POST may have reached Twilio: resending could deliver it twice
+    (requests.ReadTimeout(), False),
+    (requests.ConnectionError(ProtocolError("Connection aborted.")), False),
+])
+def test_only_sends_that_cannot_have_arrived_are_retried(error, retryable):
+    assert is_retryable(error) is retryable
@@ -0,0 +1,68 @@
+import asyncio
+
+import httpx
+import pytest
+
+from url_resolver import ProductIdResolver, extract_product_id
+
+
+@pytest.mark.parametrize("url, product_id", [
+    ("https://www.aliexpress.com/item/1005006123456789.html", "1005006123456789"),
+    ("https://he.aliexpress.com/item/1005006123456789.html?spm=a2g0o.productlist", "1005006123456789"),
+    ("https://www.aliexpress.us/item/wireless-earbuds/1005006123456789.html", "1005006123456789"),
+    ("https://m.aliexpress.com/i/1005006123456789.html", "1005006123456789"),
+    ("https://www.aliexpress.com/store/product/earbuds/1234_1005006123456789.html", "1005006123456789"),
+    ("https://sale.aliexpress.com/__mobile/deals.htm?productIds=1005006123456789", "1005006123456789"),
+    ("https://sale.aliexpress.com/__mobile/deals.htm?productIds=1005006123456789,1005001111111111",
+     "1005006123456789"),
+    ("https://www.aliexpress.com/gcp/300000512?productId=1005006123456789&spm=x", "1005006123456789"),
+    # nested, percent-encoded redirect targets
+    ("https://star.aliexpress.com/share/share.htm?redirectUrl=https%3A%2F%2Fwww.aliexpress.com%2Fitem%2F"
+     "1005006123456789.html", "1005006123456789"),
+    ("https://s.click.aliexpress.com/s/?aff_fcid=x&x_object_id%3A1005006123456789", "1005006123456789"),
+    # short links carry no id until they are expanded
+    ("https://s.click.aliexpress.com/e/_DlCy3Yb", None),
+    ("https://a.aliexpress.com/_mKp1Ql8", None),
+    ("https://www.aliexpress.com/category/100003109/women-clothing.html", None),
+])
+def test_extract_product_id(url, product_id):
+    assert extract_product_id(url) == product_id
+
+
+def resolver(redirects, max_hops=5):
+    """A resolver whose HEAD requests follow ``redirects`` (url -> location) and record each hop."""
+    hops = []
+
+    def handler(request):
+        hops.append(str(request.url))
+        location = redirects.get(str(request.url))
+        if location is None:
+            return httpx.Response(200)
+        return httpx.Response(302, headers={"location": location})
+
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return ProductIdResolver(lambda: http, max_hops=max_hops), hops
+
+
+def test_resolution_stops_at_the_first_hop_exposing_an_id():
+    redirects = {
+        "https://s.click.aliexpress.com/e/_short": "https://a.aliexpress.com/_middle",
+        "https://a.aliexpress.com/_middle": "https://www.aliexpress.com/item/1005006123456789.html",
+        "https://www.aliexpress.com/item/1005006123456789.html": "https://www.aliexpress.com/landing",
+    }
+    ids, hops = resolver(redirects)
+
+    assert asyncio.run(ids.resolve("https://s.click.aliexpress.com/e/_short")) == "1005006123456789"
+    assert hops == ["https://s.click.aliexpress.com/e/_short", "https://a.aliexpress.com/_middle"]
+
+    # expanded links are cached
+    assert asyncio.run(ids.resolve("https://s.click.aliexpress.com/e/_short")) == "1005006123456789"
+    assert len(hops) == 2
+
+
+def test_resolution_gives_up_after_max_hops():
+    redirects = {f"https://a.aliexpress.com/_{i}": f"https://a.aliexpress.com/_{i + 1}" for i in range(10)}
+    ids, hops = resolver(redirects, max_hops=3)
+
+    assert asyncio.run(ids.resolve("https://a.aliexpress.com/_0")) is None
+    assert len(hops) == 3
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from watch_scheduler import WatchScheduler
+from watch_store import WatchStore
+
+
+class FakeClient:
+    """Answers multi-id details calls from ``prices``; ids without a price aren't returned."""
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = []
+
+    async def get_products_details_async(self, product_ids, deadline=None, priority=None):
+        self.calls.append(list(product_ids))
+        return {product_id: {"product_id": product_id, "product_title": f"product {product_id}",
+                             "target_sale_price": str(self.prices[product_id])}
+                for product_id in product_ids if product_id in self.prices}
+
+
+def scheduler(prices, **options):
+    store = WatchStore(":memory:")
+    notified = []
+
+    async def notify(drops):
+        notified.extend(drops)
+
+    return WatchScheduler(FakeClient(prices), store, notify, **options), store, notified
+
+
+def test_only_price_drops_are_notified():
+    watches, store, notified = scheduler({"1": 8.0, "2": 10.0, "3": 12.0})
+    for product_id in ("1", "2", "3"):
+        store.add("alice", product_id, 10.0)
+    store.add("bob", "1", 7.5)
+
+    asyncio.run(watches.refresh(["1", "2", "3"]))
+
+    # bob already saw a lower price than the new one
+    assert notified == [("alice", "1", "product 1", 10.0, 8.0)]
+    assert {w["product_id"]: w["last_price"] for w in store.for_user("alice")} == {"1": 8.0, "2": 10.0, "3": 12.0}
+    assert store.for_user("bob")[0]["last_price"] == 8.0
+
+
+def test_drops_are_measured_from_the_last_price_checked():
+    watches, store, notified = scheduler({"1": 12.0})
+    store.add("alice", "1", 10.0)
+
+    asyncio.run(watches.refresh(["1"]))
+    watches.client.prices["1"] = 11.0
+    asyncio.run(watches.refresh(["1"]))
+    asyncio.run(watches.refresh(["1"]))
+
+    # the rise moved the baseline, so 11 is a drop once and then unchanged
+    assert notified == [("alice", "1", "product 1", 12.0, 11.0)]
+    assert watches.drops == 1
+
+
+def test_due_products_are_checkpointed_a_batch_at_a_time():
+    watches, store, _ = scheduler({str(i): 10.0 for i in range(4)}, interval=60, batch_size=2)
+    for i in range(5):
+        store.add("alice", str(i), 10.0)
+    # oldest first, and product 4 is one the gateway no longer returns
+    for age, product_id in enumerate(["4", "0", "1", "2", "3"]):
+        store.mark_checked([product_id], when=time.time() - 3600 + age)
+
+    assert store.due(10, time.time() - 60) == ["4", "0", "1", "2", "3"]
+    assert asyncio.run(watches.refresh_due()) == 2
+    assert asyncio.run(watches.refresh_due()) == 2
+    assert asyncio.run(watches.refresh_due()) == 1
+    assert asyncio.run(watches.refresh_due()) == 0
+
+    assert watches.client.calls == [["4", "0"], ["1", "2"], ["3"]]
+    # the missing product was checkpointed too, so it waits for the next interval
+    assert (watches.refreshed, watches.missing) == (4, 1)
+    assert sorted(store.due(10, time.time() + 1)) == ["0", "1", "2", "3", "4"]
+
+
+def test_ticks_spread_the_watched_products_over_the_interval():
+    watches, _, _ = scheduler({}, interval=3600, batch_size=50, min_tick=5)
+
+    assert watches.tick_seconds(0) == 3600
+    assert watches.tick_seconds(500) == 360
+    # tens of thousands of products are still one call per tick, just closer together
+    assert watches.tick_seconds(100000) == 5
@@ -0,0 +1,162 @@
+from collections import defaultdict, deque
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+from catalog import lookup_query
+
+# gateway parameters that identify us rather than the request
+PRIVATE_PARAMS = ("tracking_id",)
+FLUSH_INTERVAL = 1.0
+
+
+class TrafficRecorder:
+    """Appends sanitized webhooks and gateway calls to a JSONL file for replay.
+
+    One compact JSON object per line, with a ``type`` of ``webhook`` or ``iop``
+    and the wall clock time ``t``, and ``catalog`` for product catalog lookups
+    when the catalog is on. Gateway calls the app cancelled are kept
+    with ``cancelled`` instead of a body. Sender numbers are replaced by a salted
+    hash, so a user's messages stay linked without the number being stored.
+    Writes are buffered and flushed within a second.
+    """
+
+    def __init__(self, path: str, salt: Optional[str] = None):
+        self.path = path
+        self._salt = (salt or os.urandom(16).hex()).encode()
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self.records = 0
+
+    def anonymize(self, number: str) -> str:
+        channel, _, _ = number.rpartition(":")
+        digest = hashlib.sha256(self._salt + number.encode()).hexdigest()[:16]
+        return f"{channel}:anon-{digest}" if channel else f"anon-{digest}"
+
+    def record_webhook(self, from_number: str, body: str, message_sid: Optional[str]) -> None:
+        # only what the lookup uses; profile names, account sids and geo fields are never written
+        form = {"From": self.anonymize(from_number), "Body": body}
+        if message_sid:
+            form["MessageSid"] = message_sid
+        self._write({"type": "webhook", "form": form})
+
+    def record_iop(self, method: str, params: Dict[str, Any], body: Optional[Dict], error: Optional[Exception],
+                   seconds: float) -> None:
+        """IopClient recorder hook."""
+        record = {
+            "type": "iop",
+            "method": method,
+            "params": {k: v for k, v in params.items() if k not in PRIVATE_PARAMS},
+            "seconds": round(seconds, 4),
+        }
+        if isinstance(error, asyncio.CancelledError):
+            # no response, but a replay has to see the call to cancel it again
+            record["cancelled"] = True
+        elif error is not None:
+            record["error"] = str(error) or type(error).__name__
+        else:
+            record["body"] = body
+        self._write(record)
+
+    def record_catalog(self, query: Dict, results: List[Dict]) -> None:
+        """ProductCatalog recorder hook."""
+        self._write({"type": "catalog", "query": query, "results": results})
+
+    def _write(self, record: Dict) -> None:
+        line = json.dumps(dict(t=round(time.time(), 3), **record), separators=(",", ":"), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self.records += 1
+            # the first unflushed record schedules a flush, so a quiet period
+            # doesn't leave the last records sitting in the buffer
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_timer = None
+            if not self._file.closed:
+                self._file.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "records": self.records}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._file.close()
+
+
+def read_traffic(path: str) -> Iterator[Dict]:
+    """Records of a traffic log in file order; a line cut off by a crash is skipped."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def _catalog_key(query: Dict) -> str:
+    return json.dumps(query, sort_keys=True)
+
+
+class RecordedCatalog:
+    """Stands in for ProductCatalog, answering lookups with the ``catalog`` records of a traffic log.
+
+    What a live catalog holds depends on how earlier lookups interleaved, so
+    a replay gets each lookup's recorded answer instead: the same query gets
+    its answers in recorded order, and the last one again once they run out.
+    A lookup the log doesn't have finds nothing, as it would have in a log
+    recorded without the catalog. Writes are ignored.
+    """
+
+    def __init__(self, records: Iterable[Dict]):
+        self._answers = defaultdict(deque)
+        for record in records:
+            if record.get("type") == "catalog":
+                self._answers[_catalog_key(record["query"])].append(record["results"])
+        self.hits = 0
+        self.misses = 0
+        self.unmatched = 0
+
+    def upsert(self, products: Iterable[Dict], currency: str) -> int:
+        return 0
+
+    def prune(self) -> int:
+        return 0
+
+    def set_affiliate_links(self, links: Dict[str, str]) -> None:
+        pass
+
+    def cheaper_matching(self, tokens: Sequence[str], max_price: float, currency: str, max_age: float,
+                         limit: int, min_overlap: float = 0.6, exclude: Optional[str] = None) -> List[Dict]:
+        answers = self._answers.get(_catalog_key(lookup_query(tokens, max_price, currency, limit, min_overlap, exclude)))
+        if not answers:
+            self.unmatched += 1
+            return []
+        results = answers.popleft() if len(answers) > 1 else answers[0]
+        return copy.deepcopy(results)
+
+    def record_lookup(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"recorded_queries": len(self._answers), "hits": self.hits, "misses": self.misses,
+                "unmatched": self.unmatched}
+
+    def close(self) -> None:
+        pass
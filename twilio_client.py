@@ -1,13 +1,15 @@
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
+from twilio_dispatcher import TwilioDispatcher
+from metrics import TWILIO_SEND_SECONDS
 import os
 from dotenv import load_dotenv
 import json
+from log_pipeline import PAYLOAD
 import logging
+import time
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
@@ -17,17 +19,59 @@ twilio_auth_token = os.getenv("TWILIO_AUTH_TOKEN")
 from_whatsapp = os.getenv("FROM_WHATSAPP")
 ADMIN_WHATSAPP = os.getenv("ADMIN_WHATSAPP")
 
-client = Client(twilio_sid, twilio_auth_token)
+TWILIO_API_URL = os.getenv("TWILIO_API_URL", "https://api.twilio.com")
+TWILIO_POOL_SIZE = int(os.getenv("TWILIO_POOL_SIZE", "20"))
+TWILIO_TIMEOUT = float(os.getenv("TWILIO_TIMEOUT", "10"))
+# warm-up failures aren't fatal, so startup doesn't wait the full TWILIO_TIMEOUT for them
+TWILIO_WARM_UP_TIMEOUT = 3
+
+http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT)
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TWILIO_POOL_SIZE)
+http_client.session.mount("https://", adapter)
+http_client.session.mount("http://", adapter)
+
+client = Client(twilio_sid, twilio_auth_token, http_client=http_client)
+# the benchmarks point this at a local stand-in of the Messages API
+client.api.base_url = TWILIO_API_URL
+
+def _create(**params):
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        message = client.messages.create(**params)
+        outcome = "ok"
+        return message
+    finally:
+        TWILIO_SEND_SECONDS.observe(time.monotonic() - started, outcome)
+
+dispatcher = TwilioDispatcher(
+    _create,
+    rate=float(os.getenv("TWILIO_SENDER_RATE", "10")),
+    burst=float(os.getenv("TWILIO_SENDER_BURST", "10")),
+    max_in_flight=int(os.getenv("TWILIO_MAX_IN_FLIGHT", "16")),
+    max_retries=int(os.getenv("TWILIO_MAX_RETRIES", "4")),
+)
+
+def _send(to_number, **params):
+    # on the event loop the dispatcher queues the message and a future with the
+    # sid is returned; elsewhere (scripts, threads) the message is sent inline
+    params = dict(from_=from_whatsapp, to=to_number, **params)
+    if dispatcher.running:
+        return dispatcher.enqueue(params)
+    return _create(**params).sid
+
+def warm_up():
+    # opens a keep-alive connection to the Twilio API so the first send skips the handshake
+    try:
+        http_client.session.head(TWILIO_API_URL, timeout=TWILIO_WARM_UP_TIMEOUT)
+    except Exception as e:
+        logger.warning("Twilio warm up failed: %s", e)
 
 def send_result_message(to_number,original_price, product_title_1, product_title_2, product_title_3,
                             product_url_1, product_url_2, product_url_3,
                             product_price_1, product_price_2, product_price_3):
     message_text = f"Here are 3 cheaper products I found for you! 💰\nOriginal product price: {original_price} 💵 \n1. {product_title_1} - {product_price_1} - {product_url_1} \n2. {product_title_2} - {product_price_2} - {product_url_2} \n3. {product_title_3} - {product_price_3} - {product_url_3}"
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body=message_text
-    )
+    return _send(to_number, body=message_text)
 
 def send_template_message(to_number, product_title_1, product_title_2, product_title_3,
                           product_url_1, product_url_2, product_url_3,
@@ -45,78 +89,50 @@ def send_template_message(to_number, product_title_1, product_title_2, product_t
         "9": product_url_3,
     })
 
-    logger.info(f"Sending message to {to_number} with content variables: {content_variables}")
+    logger.info("Sending message to %s with content variables: %s", to_number, content_variables, extra=PAYLOAD)
 
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
+    return _send(
+        to_number,
         content_sid="HXca4fbd21c71303d99c99a6fecc097647",
         content_variables=content_variables
     )
-    
-    return message.sid
+
+def send_partial_result_message(to_number, original_price, products):
+    found = "is 1 cheaper product" if len(products) == 1 else f"are {len(products)} cheaper products"
+    lines = [f"{i}. {p['title']} - {p['price']} - {p['affiliate_url'] or p['url']}" for i, p in enumerate(products, 1)]
+    message_text = f"Here {found} I found for you! 💰\nOriginal product price: {original_price} 💵 \n" + " \n".join(lines)
+    return _send(to_number, body=message_text)
 
 def send_thinking_message(to_number):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body="Thinking... 💭"
-    )
-    
-    return message.sid
+    return _send(to_number, body="Thinking... 💭")
 
 def send_generic_error_message(to_number):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body="Oops! ❌"
-    )
-    
-    return message.sid
+    return _send(to_number, body="Oops! ❌")
 
 def send_input_error_message(to_number):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body="Oops! ❌ I didn't understand that. Please send a valid product link The best link to search look like this ✅https://www.aliexpress.com/item/1234567890.html"
-    )
-    
-    return message.sid
+    return _send(to_number, body="Oops! ❌ I didn't understand that. Please send a valid product link The best link to search look like this ✅https://www.aliexpress.com/item/1234567890.html")
 
 def send_cant_find_product_message(to_number):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body="I couldn't find the product you were looking for. Please try again with a different link."
-    )
-    
-    return message.sid
+    return _send(to_number, body="I couldn't find the product you were looking for. Please try again with a different link.")
 
 def send_instruction_message(to_number):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body=" Hi! 👋 I'm Price Hunt " \
-        "Just send me your Aliexpress product link and I'll find 3 cheaper products for you"
-    )
-    
-    return message.sid
+    return _send(to_number, body=" Hi! 👋 I'm Price Hunt " \
+        "Just send me your Aliexpress product link and I'll find 3 cheaper products for you")
 
 def send_cant_find_product(to_number, url):
-    message = client.messages.create(
-        from_=from_whatsapp,
-        to=to_number,
-        body="I couldn't find cheaper prices. Probabaly yours is the cheapest. " + url 
-    )
-    
-    return message.sid
+    return _send(to_number, body="I couldn't find cheaper prices. Probabaly yours is the cheapest. " + url)
 
 def send_user_messaged_bot(user_number, message):
     if user_number != ADMIN_WHATSAPP:
-        message = client.messages.create(
-        from_=from_whatsapp,
-        to=ADMIN_WHATSAPP,
-        body="Phone number: " + user_number + " messaged the bot with the following message: " + message
-        )
-        return message.sid
-    return 
\ No newline at end of file
+        return _send(ADMIN_WHATSAPP, body="Phone number: " + user_number + " messaged the bot with the following message: " + message)
+    return 
+
+
+def send_watch_started_message(to_number, product_title, price):
+    return _send(to_number, body=f"👀 Watching {product_title} (now {price}). I'll message you when the price drops. Send \"unwatch <link>\" to stop.")
+
+def send_watch_stopped_message(to_number, count):
+    return _send(to_number, body=f"Stopped watching {count} product(s).")
+
+def send_price_drop_message(to_number, product_title, old_price, new_price, product_url):
+    return _send(to_number, body=f"📉 Price drop! {product_title} went from {old_price} to {new_price} 💰 {product_url}")
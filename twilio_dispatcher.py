@@ -0,0 +1,161 @@
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+from collections import deque
+import asyncio
+import logging
+import random
+
+from twilio.base.exceptions import TwilioRestException
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DispatcherFullError(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether resending can't deliver the message twice.
+
+    messages.create isn't idempotent: after a read timeout or a dropped
+    connection Twilio may already have accepted the message, so only error
+    responses and failures to connect at all are retried.
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status in RETRYABLE_STATUSES
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # refused or unresolvable: urllib3's MaxRetryError wraps the NewConnectionError
+        reason = getattr(error.args[0], "reason", error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class TwilioDispatcher:
+    """Outbound message queue in front of the blocking Twilio client.
+
+    Messages to the same recipient are sent one at a time in enqueue order.
+    Each sender number is throttled by its own token bucket, and 429/5xx
+    responses are retried with exponential backoff. enqueue() returns a future
+    with the message sid, so callers can await delivery or move on.
+    """
+
+    def __init__(self, create: Callable[..., Any], rate: float = 10, burst: float = 10,
+                 max_in_flight: int = 16, max_pending: int = 10000,
+                 max_retries: int = 4, backoff: float = 0.5, max_backoff: float = 10):
+        self._create = create
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._max_in_flight = max_in_flight
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, Deque[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    @property
+    def running(self) -> bool:
+        """True when called from the event loop the dispatcher was started on."""
+        if self._loop is None:
+            return False
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self._max_in_flight)
+
+    async def stop(self, timeout: float = 10) -> None:
+        if self._workers:
+            done, pending = await asyncio.wait(list(self._workers.values()), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"Stopping Twilio dispatcher with {self.pending} messages unsent")
+        self._loop = None
+
+    def enqueue(self, params: Dict[str, Any]) -> asyncio.Future:
+        """Queues one messages.create call; must be called from the dispatcher's event loop."""
+        if self.pending >= self.max_pending:
+            raise DispatcherFullError(f"{self.pending} Twilio messages already pending")
+
+        future = self._loop.create_future()
+        recipient = params["to"]
+        self._queues.setdefault(recipient, deque()).append((params, future))
+        self.pending += 1
+        if recipient not in self._workers:
+            self._workers[recipient] = self._loop.create_task(self._drain(recipient))
+        return future
+
+    def _bucket(self, sender: str) -> TokenBucket:
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            bucket = self._buckets[sender] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def _drain(self, recipient: str) -> None:
+        # one worker per recipient with queued messages, which keeps them in order
+        queue = self._queues[recipient]
+        try:
+            while queue:
+                params, future = queue.popleft()
+                try:
+                    sid = await self._send(params)
+                    self.sent += 1
+                    if not future.done():
+                        future.set_result(sid)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Failed to send Twilio message to {recipient}: {e}")
+                    if not future.done():
+                        future.set_exception(e)
+                        # nobody may be awaiting a fire-and-forget send
+                        future.exception()
+                finally:
+                    self.pending -= 1
+        finally:
+            del self._workers[recipient]
+            if not queue:
+                del self._queues[recipient]
+
+    async def _send(self, params: Dict[str, Any]) -> str:
+        attempt = 0
+        while True:
+            await self._bucket(params["from_"]).acquire()
+            try:
+                async with self._semaphore:
+                    message = await asyncio.to_thread(self._create, **params)
+                return message.sid
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Twilio send failed ({e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "recipients": len(self._queues),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
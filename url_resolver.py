@@ -0,0 +1,128 @@
+from typing import Callable, Optional
+from urllib.parse import unquote, urljoin
+import logging
+import re
+import time
+
+import httpx
+
+from cache import TTLCache
+from deadline import Deadline, DeadlineExceeded
+from metrics import REDIRECT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# AliExpress product ids are long numeric ids; in the looser shapes shorter
+# numbers are usually category or store ids
+_ID = r"(\d{8,20})"
+
+# Known product URL shapes, most specific first. They are matched against the
+# percent-decoded URL so ids inside nested redirect parameters are found too.
+PRODUCT_ID_PATTERNS = [
+    # www./he./m. and localized domains: /item/<id>.html, /item/<slug>/<id>.html
+    re.compile(r"/item/(?:[^/?#]+/)?(\d+)\.html"),
+    # mobile: m.aliexpress.com/i/<id>.html
+    re.compile(r"/i/" + _ID + r"\.html"),
+    # legacy store links: /store/product/<slug>/<store>_<id>.html
+    re.compile(r"/store/product/[^/?#]+/\d+_" + _ID + r"\.html"),
+    # /item-<id>, /product-<id> path segments
+    re.compile(r"/(?:item|product)-" + _ID + r"(?:[./?#-]|$)"),
+    # query strings: productId=, productIds= (the first of the list), product_id=, itemId=, objectId=
+    re.compile(r"[?&](?:productIds?|product_id|itemId|objectId)=" + _ID, re.IGNORECASE),
+    # affiliate trace parameters: x_object_id=<id> or x_object_id:<id>
+    re.compile(r"x_object_id[=:]" + _ID),
+]
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+def extract_product_id(url: str) -> Optional[str]:
+    """Finds a product id in any known AliExpress URL shape without network access."""
+    if not url:
+        return None
+    candidates = [url]
+    decoded = unquote(url)
+    # nested redirect targets can be encoded more than once
+    while decoded != candidates[-1]:
+        candidates.append(decoded)
+        decoded = unquote(decoded)
+    for pattern in PRODUCT_ID_PATTERNS:
+        for candidate in candidates:
+            match = pattern.search(candidate)
+            if match:
+                return match.group(1)
+    return None
+
+
+class ProductIdResolver:
+    """Resolves product ids locally first, then by following redirects with HEAD requests.
+
+    Redirect chains are followed one hop at a time so resolution stops as soon
+    as any hop's Location carries a product id, without downloading the final
+    page. Expanded links are kept in a bounded cache.
+    """
+
+    def __init__(self, http: Callable[[], httpx.AsyncClient], max_hops: int = 5,
+                 cache_size: int = 4096, cache_ttl: float = 86400, hop_timeout: float = 10):
+        self._http = http
+        self.max_hops = max_hops
+        self.hop_timeout = hop_timeout
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def extract(self, url: str) -> Optional[str]:
+        return extract_product_id(url)
+
+    async def resolve(self, url: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        product_id = extract_product_id(url)
+        if product_id:
+            return product_id
+
+        product_id = self.cache.get(url)
+        if product_id:
+            return product_id
+
+        started = time.monotonic()
+        try:
+            product_id = await self._expand(url, deadline)
+        except DeadlineExceeded:
+            REDIRECT_SECONDS.observe(time.monotonic() - started, "deadline_exceeded")
+            raise
+        REDIRECT_SECONDS.observe(time.monotonic() - started, "resolved" if product_id else "unresolved")
+        if product_id:
+            self.cache.set(url, product_id)
+        return product_id
+
+    async def _expand(self, url: str, deadline: Optional[Deadline]) -> Optional[str]:
+        client = self._http()
+        current = url
+        for hop in range(self.max_hops):
+            timeout = deadline.timeout(self.hop_timeout) if deadline else self.hop_timeout
+            kwargs = {"follow_redirects": False, "timeout": timeout}
+            try:
+                response = await client.head(current, **kwargs)
+                if response.status_code == 405:
+                    # some shorteners reject HEAD; read the headers of a GET instead
+                    async with client.stream("GET", current, **kwargs) as response:
+                        pass
+            except httpx.TimeoutException as e:
+                if deadline and deadline.expired:
+                    raise DeadlineExceeded(f"deadline exceeded expanding {url}") from e
+                logger.error(f"Timed out expanding {current}: {e}")
+                return None
+            except httpx.HTTPError as e:
+                logger.error(f"Error expanding {current}: {e}")
+                return None
+
+            if response.status_code not in REDIRECT_STATUSES:
+                return extract_product_id(str(response.url))
+
+            location = response.headers.get("location")
+            if not location:
+                return None
+            current = urljoin(current, location)
+            product_id = extract_product_id(current)
+            if product_id:
+                return product_id
+
+        logger.warning(f"Gave up expanding {url} after {self.max_hops} redirects")
+        return None
@@ -0,0 +1,106 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import math
+import time
+
+from quota import BACKGROUND
+from watch_store import WatchStore
+
+logger = logging.getLogger(__name__)
+
+
+class WatchScheduler:
+    """Refreshes watched products in batches and reports price drops.
+
+    Every product is refreshed about once per ``interval``. Each tick takes the
+    ``batch_size`` stalest products and fetches them with one multi-id details
+    call, and ticks are spaced so the whole set is covered once per interval
+    instead of in a burst. ``notify`` is awaited once per batch with a
+    (user, product_id, title, old_price, new_price) tuple for every watch whose
+    price went down since it was last checked.
+    """
+
+    def __init__(self, client: Any, store: WatchStore,
+                 notify: Callable[[List[Tuple[str, str, str, float, float]]], Awaitable[Any]],
+                 interval: float = 21600, batch_size: int = 50, min_tick: float = 5):
+        self.client = client
+        self.store = store
+        self.notify = notify
+        self.interval = interval
+        self.batch_size = batch_size
+        self.min_tick = min_tick
+        self._task: Optional[asyncio.Task] = None
+        self.refreshed = 0
+        self.missing = 0
+        self.drops = 0
+        self.failed_batches = 0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="watch-scheduler")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def tick_seconds(self, products: int) -> float:
+        """Time between batches that spreads ``products`` over one interval."""
+        batches = max(1, math.ceil(products / self.batch_size))
+        return min(self.interval, max(self.min_tick, self.interval / batches))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                self.failed_batches += 1
+                logger.exception(f"Watch refresh failed: {e}")
+            products = (await asyncio.to_thread(self.store.stats))["products"]
+            await asyncio.sleep(self.tick_seconds(products))
+
+    async def refresh_due(self) -> int:
+        """Refreshes one batch of the stalest products; returns how many were due."""
+        due = await asyncio.to_thread(self.store.due, self.batch_size, time.time() - self.interval)
+        if due:
+            await self.refresh(due)
+        return len(due)
+
+    async def refresh(self, product_ids: List[str]) -> None:
+        products = await self.client.get_products_details_async(product_ids, priority=BACKGROUND)
+        self.refreshed += len(products)
+        self.missing += len(product_ids) - len(products)
+
+        updates, drops = [], []
+        for user, product_id, title, last_price in await asyncio.to_thread(self.store.watchers, product_ids):
+            product = products.get(product_id)
+            if not product or not product.get('target_sale_price'):
+                continue
+            price = float(product['target_sale_price'])
+            if price < last_price:
+                drops.append((user, product_id, product.get('product_title') or title, last_price, price))
+            if price != last_price:
+                updates.append((user, product_id, price))
+
+        if drops:
+            self.drops += len(drops)
+            try:
+                await self.notify(drops)
+            except Exception as e:
+                logger.error(f"Failed to notify {len(drops)} price drops: {e}")
+        await asyncio.to_thread(self.store.update_prices, updates)
+        # products the gateway didn't return are retried next interval, not next tick
+        await asyncio.to_thread(self.store.mark_checked, product_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            self.store.stats(),
+            running=self._task is not None,
+            refreshed=self.refreshed,
+            missing=self.missing,
+            drops=self.drops,
+            failed_batches=self.failed_batches,
+        )
@@ -0,0 +1,109 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watches (
+    user TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    title TEXT,
+    last_price REAL NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (user, product_id)
+);
+CREATE INDEX IF NOT EXISTS watches_product_id ON watches (product_id);
+CREATE TABLE IF NOT EXISTS watched_products (
+    product_id TEXT PRIMARY KEY,
+    last_checked REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS watched_products_last_checked ON watched_products (last_checked);
+"""
+
+
+class WatchStore:
+    """SQLite store of price-watch subscriptions.
+
+    Each (user, product) watch remembers the price the user last saw. Products
+    are tracked once however many users watch them, with the time they were
+    last refreshed, so the scheduler can pick the stalest ones in batches.
+    """
+
+    def __init__(self, path: str = "watches.db"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, user: str, product_id: str, price: float, title: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO watches (user, product_id, title, last_price, created_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user, product_id) DO UPDATE SET title = excluded.title, last_price = excluded.last_price",
+                (user, product_id, title, price, now))
+            # the price was just looked up, so the product isn't due for a while
+            self._conn.execute(
+                "INSERT INTO watched_products (product_id, last_checked) VALUES (?, ?) "
+                "ON CONFLICT (product_id) DO UPDATE SET last_checked = excluded.last_checked",
+                (product_id, now))
+
+    def remove(self, user: str, product_id: Optional[str] = None) -> int:
+        """Removes one of the user's watches, or all of them; returns how many were removed."""
+        with self._lock, self._conn:
+            if product_id is None:
+                removed = self._conn.execute("DELETE FROM watches WHERE user = ?", (user,)).rowcount
+            else:
+                removed = self._conn.execute(
+                    "DELETE FROM watches WHERE user = ? AND product_id = ?", (user, product_id)).rowcount
+            self._conn.execute(
+                "DELETE FROM watched_products WHERE product_id NOT IN (SELECT product_id FROM watches)")
+        return removed
+
+    def for_user(self, user: str) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT product_id, title, last_price FROM watches WHERE user = ? ORDER BY created_at",
+                (user,)).fetchall()
+        return [{"product_id": product_id, "title": title, "last_price": price} for product_id, title, price in rows]
+
+    def due(self, limit: int, older_than: float) -> List[str]:
+        """Up to ``limit`` watched products last refreshed before ``older_than``, stalest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT product_id FROM watched_products WHERE last_checked < ? ORDER BY last_checked LIMIT ?",
+                (older_than, limit)).fetchall()
+        return [product_id for product_id, in rows]
+
+    def watchers(self, product_ids: Sequence[str]) -> List[Tuple[str, str, Optional[str], float]]:
+        """(user, product_id, title, last_price) of every watch on the given products."""
+        if not product_ids:
+            return []
+        placeholders = ",".join("?" * len(product_ids))
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT user, product_id, title, last_price FROM watches WHERE product_id IN ({placeholders})",
+                list(product_ids)).fetchall()
+
+    def update_prices(self, prices: Sequence[Tuple[str, str, float]]) -> None:
+        """Records the latest price each (user, product_id) watch was compared against."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE watches SET last_price = ? WHERE user = ? AND product_id = ?",
+                [(price, user, product_id) for user, product_id, price in prices])
+
+    def mark_checked(self, product_ids: Sequence[str], when: Optional[float] = None) -> None:
+        when = time.time() if when is None else when
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE watched_products SET last_checked = ? WHERE product_id = ?",
+                [(when, product_id) for product_id in product_ids])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            watches, = self._conn.execute("SELECT COUNT(*) FROM watches").fetchone()
+            products, = self._conn.execute("SELECT COUNT(*) FROM watched_products").fetchone()
+        return {"watches": watches, "products": products}
+
+    def close(self) -> None:
+        self._conn.close()